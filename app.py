@@ -3,7 +3,7 @@ Unified Service: Calculator + CRM
 Объединённый сервис калькулятора и CRM для Railway
 """
 
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory, stream_with_context
 from flask_cors import CORS
 from datetime import datetime, timedelta
 import os
@@ -40,16 +40,30 @@ Session = scoped_session(SessionLocal)
 def get_session():
     return Session()
 
-# ==================== TRONSCAN CACHE ====================
-TRONSCAN_CACHE = {
-    'incoming': {'data': None, 'timestamp': 0},
-    'outgoing': {'data': None, 'timestamp': 0},
-    'balances': {} # address -> {'data': data, 'timestamp': 0}
-}
+# ==================== SHARED CACHE ====================
+from shared_cache import cache_from_env
+
+# Курсы и данные TronScan кэшируются в общем файле хоста, чтобы воркеры gunicorn
+# не дублировали запросы к внешним API (каждый ключ обновляет один воркер)
+shared_cache = cache_from_env()
 CACHE_TTL = 300 # 5 минут
 
+# Базовые адреса внешних API - переопределяются, чтобы гонять сервис на локальных заглушках (fake_upstreams.py)
+TRONSCAN_API = os.getenv('TRONSCAN_API_URL', 'https://apilist.tronscanapi.com/api').rstrip('/')
+TELEGRAM_API = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+# Все запросы к TronScan - через один клиент: keep-alive пул, повторы 429/5xx и общий лимит
+# TRONSCAN_RATE запросов в секунду на процесс (на заглушках можно off)
+from tronscan import BalanceRefresher, client_from_env, limiter_from_env
+tronscan_limiter = limiter_from_env()
+tronscan_client = client_from_env(TRONSCAN_API, tronscan_limiter)
+
+# Запись/воспроизведение ответов внешних API (CASSETTE_MODE=record|replay, см. cassettes.py)
+from cassettes import install_from_env as install_cassette_from_env
+install_cassette_from_env()
+
 # ==================== MODELS ====================
-from sqlalchemy import Column, Integer, String, Float, DateTime, Boolean, Text, ForeignKey, Enum as SQLEnum
+from sqlalchemy import Column, Integer, BigInteger, String, Float, DateTime, Boolean, Text, ForeignKey, Index, Enum as SQLEnum
+from sqlalchemy import event as sa_event, inspect as sa_inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from enum import Enum
@@ -241,10 +255,11 @@ class Transaction(Base):
     id = Column(Integer, primary_key=True)
     tx_hash = Column(String(100), unique=True, nullable=False)
     blockchain = Column(String(20), default='TRON')
-    from_address = Column(String(100))
-    to_address = Column(String(100))
+    from_address = Column(String(100), index=True)
+    to_address = Column(String(100), index=True)
     amount_usdt = Column(Float)
     timestamp = Column(DateTime)
+    block_ts = Column(BigInteger, index=True)  # время блока TronScan, мс
     confirmed = Column(Boolean, default=False)
     deal_id = Column(Integer, ForeignKey('deals.id'), nullable=True)
     deal = relationship("Deal", back_populates="transactions")
@@ -259,6 +274,16 @@ class Wallet(Base):
     active = Column(Boolean, default=True)
     is_monitored = Column(Boolean, default=True)  # Виден во вкладке Транзакции
     is_balance = Column(Boolean, default=False)   # Виден во вкладке Баланс (Binance)
+    # Курсоры индексатора TronScan (block_ts, мс): до какого перевода синхронизированы новые
+    # и с какого догружается история; None - кошелёк ещё не проиндексирован
+    indexed_block_ts = Column(BigInteger)
+    backfill_block_ts = Column(BigInteger)
+    backfill_done = Column(Boolean, default=False)
+    indexed_at = Column(DateTime)
+    # Новые переводы не влезли в один проход: до какого block_ts (сверху вниз) ещё не дочитано
+    # и самый новый из уже прочитанных (станет indexed_block_ts, когда окно дочитается)
+    forward_gap_ts = Column(BigInteger)
+    forward_head_ts = Column(BigInteger)
     operations = relationship("WalletOperation", back_populates="wallet", cascade="all, delete-orphan")
     
     def to_dict(self, session=None):
@@ -278,6 +303,7 @@ class Wallet(Base):
             'active': self.active,
             'is_monitored': self.is_monitored,
             'is_balance': self.is_balance,
+            'indexed': self.indexed_block_ts is not None,
             'system_balance': round(system_balance, 2)
         }
 
@@ -355,6 +381,7 @@ class Deal(Base):
     custom_payout_currency = Column(String(10))
     custom_payout_amount = Column(Float)
     custom_payout_rate = Column(Float)
+    quote_id = Column(String(40))
     notes = Column(Text)
     transactions = relationship("Transaction", back_populates="deal")
     cash_allocations = relationship("CashAllocation", back_populates="deal")
@@ -402,11 +429,104 @@ class Deal(Base):
             'custom_payout_amount': self.custom_payout_amount,
             'custom_payout_rate': self.custom_payout_rate,
             'notes': self.notes,
+            'quote_id': self.quote_id,
             'reimbursement_id': self.reimbursement_id,
             'reimbursement': self.reimbursement.to_dict() if self.reimbursement else None,
             'is_reimbursed': self.reimbursement_id is not None
         }
 
+class RateTick(Base):
+    """Сырые значения курсов (хранятся ограниченное время, для истории не читаются)"""
+    __tablename__ = 'rate_ticks'
+    id = Column(Integer, primary_key=True)
+    pair = Column(String(20), nullable=False)  # 'usdt_thb' / 'rub_usdt'
+    ts = Column(Integer, nullable=False)       # unix timestamp, секунды
+    value = Column(Float, nullable=False)
+    __table_args__ = (Index('ix_rate_ticks_pair_ts', 'pair', 'ts'),)
+
+class RateBar(Base):
+    """OHLC бакеты курсов (1m и 1h), из них отдаётся история"""
+    __tablename__ = 'rate_bars'
+    id = Column(Integer, primary_key=True)
+    pair = Column(String(20), nullable=False)
+    resolution = Column(String(4), nullable=False)  # '1m' / '1h'
+    bucket_ts = Column(Integer, nullable=False)     # начало бакета, unix timestamp
+    open = Column(Float, nullable=False)
+    high = Column(Float, nullable=False)
+    low = Column(Float, nullable=False)
+    close = Column(Float, nullable=False)
+    count = Column(Integer, default=1)
+    __table_args__ = (Index('ix_rate_bars_pair_res_bucket', 'pair', 'resolution', 'bucket_ts', unique=True),)
+    
+    def to_dict(self):
+        return {'ts': self.bucket_ts, 'open': self.open, 'high': self.high,
+                'low': self.low, 'close': self.close, 'count': self.count}
+
+class PricingVersion(Base):
+    """Версии таблиц ценообразования Doverka (действует последняя)"""
+    __tablename__ = 'pricing_versions'
+    id = Column(Integer, primary_key=True)  # номер версии
+    data = Column(Text, nullable=False)     # JSON: levels + margin_curve
+    comment = Column(String(255))
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class UsedTxHash(Base):
+    """Хэши транзакций, уже занятых сделками, возмещениями и операциями кошельков (ведутся событиями ORM)"""
+    __tablename__ = 'used_tx_hashes'
+    id = Column(Integer, primary_key=True)
+    tx_hash = Column(String(100), nullable=False, index=True)
+    source = Column(String(30), nullable=False)   # transaction / deal_payin / deal_doverka / reimbursement / wallet_operation
+    source_id = Column(Integer, nullable=False)
+    __table_args__ = (Index('ix_used_tx_hashes_source', 'source', 'source_id', unique=True),)
+
+# Откуда берутся занятые хэши: модель -> [(source, колонки-триггеры (первая не NULL у занятых), хэш записи или None)]
+USED_HASH_SOURCES = {
+    Transaction: [('transaction', ('deal_id', 'tx_hash'), lambda t: t.tx_hash if t.deal_id is not None else None)],
+    Deal: [('deal_payin', ('payin_tx_hash',), lambda d: d.payin_tx_hash),
+           ('deal_doverka', ('doverka_payout_hash',), lambda d: d.doverka_payout_hash)],
+    Reimbursement: [('reimbursement', ('tx_hash',), lambda r: r.tx_hash)],
+    WalletOperation: [('wallet_operation', ('tx_hash',), lambda op: op.tx_hash)],
+}
+
+def _write_used_hash(connection, source, source_id, tx_hash):
+    table = UsedTxHash.__table__
+    connection.execute(table.delete().where(table.c.source == source, table.c.source_id == source_id))
+    if tx_hash:
+        connection.execute(table.insert().values(tx_hash=tx_hash, source=source, source_id=source_id))
+
+def _used_hash_inserted(mapper, connection, target):
+    for source, _, value in USED_HASH_SOURCES[mapper.class_]:
+        if value(target):
+            _write_used_hash(connection, source, target.id, value(target))
+
+def _used_hash_updated(mapper, connection, target):
+    state = sa_inspect(target)
+    for source, columns, value in USED_HASH_SOURCES[mapper.class_]:
+        if any(state.attrs[column].history.has_changes() for column in columns):
+            _write_used_hash(connection, source, target.id, value(target))
+
+def _used_hash_deleted(mapper, connection, target):
+    for source, _, _ in USED_HASH_SOURCES[mapper.class_]:
+        _write_used_hash(connection, source, target.id, None)
+
+# Пишется в той же транзакции, что и сама запись. Массовые query().update()/delete() событий не вызывают -
+# для этих моделей используем session.delete()/присваивание атрибутов
+for _model in USED_HASH_SOURCES:
+    sa_event.listen(_model, 'after_insert', _used_hash_inserted)
+    sa_event.listen(_model, 'after_update', _used_hash_updated)
+    sa_event.listen(_model, 'after_delete', _used_hash_deleted)
+
+def rebuild_used_tx_hashes(session):
+    """Пересобрать used_tx_hashes из исходных таблиц (при первом запуске на старой базе)"""
+    session.query(UsedTxHash).delete()
+    for model, sources in USED_HASH_SOURCES.items():
+        for source, columns, value in sources:
+            for row in session.query(model).filter(getattr(model, columns[0]) != None).all():
+                if value(row):
+                    session.add(UsedTxHash(tx_hash=value(row), source=source, source_id=row.id))
+    session.commit()
+    return session.query(UsedTxHash).count()
+
 # Создание таблиц
 Base.metadata.create_all(bind=engine)
 
@@ -419,6 +539,14 @@ try:
             conn.execute(text("ALTER TABLE deals ADD COLUMN IF NOT EXISTS payout_wallet_id INTEGER REFERENCES wallets(id)"))
             conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS is_monitored BOOLEAN DEFAULT TRUE"))
             conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS is_balance BOOLEAN DEFAULT FALSE"))
+            conn.execute(text("ALTER TABLE deals ADD COLUMN IF NOT EXISTS quote_id VARCHAR(40)"))
+            conn.execute(text("ALTER TABLE transactions ADD COLUMN IF NOT EXISTS block_ts BIGINT"))
+            conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS indexed_block_ts BIGINT"))
+            conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS backfill_block_ts BIGINT"))
+            conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS backfill_done BOOLEAN DEFAULT FALSE"))
+            conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS indexed_at TIMESTAMP"))
+            conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS forward_gap_ts BIGINT"))
+            conn.execute(text("ALTER TABLE wallets ADD COLUMN IF NOT EXISTS forward_head_ts BIGINT"))
         # Для SQLite
         else:
             try: conn.execute(text("ALTER TABLE deals ADD COLUMN payout_wallet_id INTEGER"))
@@ -427,11 +555,40 @@ try:
             except: pass
             try: conn.execute(text("ALTER TABLE wallets ADD COLUMN is_balance BOOLEAN DEFAULT FALSE"))
             except: pass
+            try: conn.execute(text("ALTER TABLE deals ADD COLUMN quote_id VARCHAR(40)"))
+            except: pass
+            for ddl in ("ALTER TABLE transactions ADD COLUMN block_ts BIGINT",
+                        "ALTER TABLE wallets ADD COLUMN indexed_block_ts BIGINT",
+                        "ALTER TABLE wallets ADD COLUMN backfill_block_ts BIGINT",
+                        "ALTER TABLE wallets ADD COLUMN backfill_done BOOLEAN DEFAULT FALSE",
+                        "ALTER TABLE wallets ADD COLUMN indexed_at DATETIME",
+                        "ALTER TABLE wallets ADD COLUMN forward_gap_ts BIGINT",
+                        "ALTER TABLE wallets ADD COLUMN forward_head_ts BIGINT"):
+                try: conn.execute(text(ddl))
+                except: pass
+        # Индексы для выборок индексатора TronScan (в старых базах таблица уже была без них)
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_block_ts ON transactions (block_ts)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_from_address ON transactions (from_address)"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_transactions_to_address ON transactions (to_address)"))
         conn.commit()
     print("✅ Database migration successful")
 except Exception as e:
     print(f"ℹ️ Migration info: {e}")
 
+# Таблица занятых хэшей появилась позже остальных - на старой базе заполняем её один раз
+_session = Session()
+try:
+    if _session.query(UsedTxHash.id).first() is None:
+        rebuilt = rebuild_used_tx_hashes(_session)
+        if rebuilt:
+            print(f"✅ used_tx_hashes rebuilt: {rebuilt} hashes")
+except Exception as e:
+    # Соседний воркер gunicorn заполнил таблицу одновременно с нами
+    _session.rollback()
+    print(f"ℹ️ used_tx_hashes rebuild skipped: {e}")
+finally:
+    _session.close()
+
 print("✅ Database initialized")
 
 # ==================== WEBHOOK CONFIG ====================
@@ -458,7 +615,224 @@ def send_deal_completed_webhook(deal):
     send_webhook_async(WEBHOOK_URL, data)
 
 # ==================== CALCULATOR IMPORTS ====================
-from calculator import ExchangeRateProvider, ExchangeCalculator
+from calculator import ExchangeRateProvider, env_seconds, pricing_store
+from pricing import PricingTables
+from batch_calculator import batch_size, calculate_batch
+from operations import OPERATIONS, resolve
+from risk import PAIRS, history_returns, position_from_result, simulate_book, simulate_factors
+from margin_sweep import SOLVE_MAX_MARGIN, SOLVE_MIN_MARGIN, SOLVE_STEP, solve_margin, sweep
+from pricing_spec import available_spec, build_pricing_spec, compare_results
+from quotes import QuoteStore, quote_deal_fields
+from rate_refresher import RateRefresher, RateSnapshot
+from response_cache import ResponseCache
+from tron_indexer import TransferIndexer
+from transfer_cache import TransferWindowCache
+
+# Курсы обновляются в фоне, эндпоинты читают готовый снапшот из памяти
+rate_refresher = RateRefresher(cache=shared_cache)
+
+# Результаты расчётов, по которым можно создать сделку без пересчёта
+quote_store = QuoteStore(cache=shared_cache)
+
+# Готовые ответы /api/calculate по нормализованному запросу и версии курсов/таблиц
+calculate_cache = ResponseCache()
+
+# ==================== PRICING ====================
+
+def load_pricing_version(current_version: int):
+    """Загрузчик для pricing_store: последняя версия таблиц из БД, если она отличается от текущей"""
+    from sqlalchemy import func
+    session = get_session()
+    try:
+        latest = session.query(func.max(PricingVersion.id)).scalar() or 0
+        if latest == current_version:
+            return None
+        if latest == 0:
+            # Версии удалены - возвращаемся к значениям из кода
+            return 0, pricing_store.defaults.to_dict()
+        row = session.get(PricingVersion, latest)
+        return row.id, json.loads(row.data)
+    finally:
+        session.close()
+
+pricing_store.set_loader(load_pricing_version)
+
+@app.route('/api/pricing', methods=['GET'])
+def get_pricing():
+    tables = pricing_store.current()
+    return jsonify({'success': True, 'pricing': tables.to_dict()})
+
+@app.route('/api/pricing', methods=['PUT'])
+def update_pricing():
+    """
+    Новая версия таблиц ценообразования (levels и/или margin_curve)
+    Остальные воркеры подхватят её в течение PRICING_RELOAD_INTERVAL
+    """
+    data = request.get_json() or {}
+    current = pricing_store.current().to_dict()
+    payload = {
+        'levels': data.get('levels', current['levels']),
+        'margin_curve': data.get('margin_curve', current['margin_curve'])
+    }
+    try:
+        PricingTables.from_dict(payload)
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({'success': False, 'error': f'Invalid pricing: {e}'}), 400
+
+    session = get_session()
+    try:
+        row = PricingVersion(data=json.dumps(payload), comment=data.get('comment'))
+        session.add(row)
+        session.commit()
+        tables = PricingTables.from_dict(payload, row.id)
+        pricing_store.publish(tables)
+        print(f"💱 Pricing tables v{row.id} published")
+        return jsonify({'success': True, 'pricing': tables.to_dict()})
+    except Exception as e:
+        session.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        session.close()
+
+# Спецификация для расчёта в браузере: сколько она действует и где лежат выданные с ней курсы
+PRICING_SPEC_TTL = float(os.environ.get('PRICING_SPEC_TTL', 300))
+PRICING_RATES_PREFIX = 'pricing:rates:'
+
+# Перевод калькуляторов и сверка - один раз при старте, а не в первом запросе
+available_spec(pricing_store.current())
+
+@app.route('/api/pricing/spec', methods=['GET'])
+def get_pricing_spec():
+    """
+    Модель ценообразования для calculator.js: формулы (из кода калькуляторов), округление,
+    таблицы комиссий, снапшот курсов и срок действия. Результат перепроверяется в POST /api/deals.
+    """
+    try:
+        snapshot = rate_refresher.get()
+        spec = build_pricing_spec(snapshot, pricing_store.current(), PRICING_SPEC_TTL,
+                                  stale=rate_refresher.is_stale(snapshot))
+        if spec is None:
+            # Калькуляторы не переводятся в спецификацию - клиент считает через /api/calculate
+            return jsonify({'success': False, 'error': 'Pricing spec unavailable'}), 503
+        # Курсы, по которым клиент может считать до expires_at, должны найтись у любого воркера
+        shared_cache.set(PRICING_RATES_PREFIX + str(snapshot.version),
+                         {'snapshot': snapshot.to_dict(), 'expires_at': spec['expires_at']})
+        shared_cache.purge(PRICING_RATES_PREFIX, spec['issued_at'] - PRICING_SPEC_TTL)
+        return jsonify({'success': True, 'spec': spec})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+def verify_local_pricing(pricing):
+    """
+    Перепроверка расчёта из браузера перед созданием сделки
+
+    Returns:
+        tuple: (quote, error) - котировка по пересчитанному результату или текст ошибки (409)
+    """
+    spec = available_spec(pricing_store.current())
+    if spec is None:
+        return None, 'Расчёт в браузере недоступен, пересчитайте сделку'
+    spec_version = spec['spec_version']
+    if pricing.get('spec_version') != spec_version:
+        return None, 'Модель ценообразования обновилась, пересчитайте сделку'
+    stored, _ = shared_cache.get(PRICING_RATES_PREFIX + str(pricing.get('rates_version')))
+    if not stored or stored['expires_at'] < time.time():
+        return None, 'Курсы расчёта устарели, пересчитайте сделку'
+
+    operation = resolve(pricing.get('method'), pricing.get('scenario'), pricing.get('direction'))
+    amount = float(pricing.get('amount', 0))
+    if operation is None or amount <= 0:
+        return None, 'Некорректные параметры расчёта'
+    snapshot = RateSnapshot.from_dict(stored['snapshot'])
+    custom_rub_usdt, profit_margin = operation_inputs(operation, pricing)
+    result = operation.run(operation.calculator(snapshot, custom_rub_usdt, profit_margin), amount, profit_margin)
+
+    client_result = pricing.get('result') or {}
+    if operation.result_field not in client_result:
+        return None, f'В расчёте нет поля {operation.result_field}'
+    mismatched = compare_results(client_result, result)
+    if mismatched:
+        return None, f"Расчёт не совпал с сервером: {', '.join(mismatched)}"
+
+    result['rates_version'] = snapshot.version
+    quote = quote_store.issue(
+        {'method': operation.method, 'scenario': operation.scenario, 'direction': operation.direction,
+         'amount': amount,
+         'profit_margin': profit_margin,
+         'custom_rub_usdt': custom_rub_usdt,
+         'spec_version': spec_version},
+        result, snapshot.version
+    )
+    return quote, None
+
+# ==================== RATE HISTORY ====================
+
+# Базовые разрешения хранятся в rate_bars, остальные собираются из них
+RATE_BAR_SECONDS = {'1m': 60, '1h': 3600}
+RATE_HISTORY_RESOLUTIONS = {
+    '1m': ('1m', 60), '5m': ('1m', 300), '15m': ('1m', 900),
+    '1h': ('1h', 3600), '4h': ('1h', 14400), '1d': ('1h', 86400)
+}
+# Сколько дней хранить сырые значения и минутные бакеты (часовые - без ограничения)
+RATE_TICKS_RETENTION_DAYS = int(os.environ.get('RATE_TICKS_RETENTION_DAYS', 2))
+RATE_1M_RETENTION_DAYS = int(os.environ.get('RATE_1M_RETENTION_DAYS', 30))
+
+def record_rate_ticks(rates, fetched_at):
+    """Сохранить полученные курсы и обновить OHLC бакеты (вызывается только воркером, который их получил)"""
+    session = get_session()
+    try:
+        ts = int(fetched_at)
+        new_hour = False
+        for pair in ('usdt_thb', 'rub_usdt'):
+            value = rates.get(pair)
+            if not value:
+                continue
+            session.add(RateTick(pair=pair, ts=ts, value=value))
+            for resolution, seconds in RATE_BAR_SECONDS.items():
+                bucket_ts = ts - ts % seconds
+                bar = session.query(RateBar).filter(
+                    RateBar.pair == pair, RateBar.resolution == resolution, RateBar.bucket_ts == bucket_ts
+                ).first()
+                if bar is None:
+                    session.add(RateBar(pair=pair, resolution=resolution, bucket_ts=bucket_ts,
+                                        open=value, high=value, low=value, close=value, count=1))
+                    new_hour = new_hour or resolution == '1h'
+                else:
+                    bar.high = max(bar.high, value)
+                    bar.low = min(bar.low, value)
+                    bar.close = value
+                    bar.count = (bar.count or 0) + 1
+        
+        # Чистка по retention раз в час (при открытии нового часового бакета)
+        if new_hour:
+            session.query(RateTick).filter(RateTick.ts < ts - RATE_TICKS_RETENTION_DAYS * 86400).delete()
+            session.query(RateBar).filter(
+                RateBar.resolution == '1m', RateBar.bucket_ts < ts - RATE_1M_RETENTION_DAYS * 86400
+            ).delete()
+        session.commit()
+    except Exception as e:
+        session.rollback()
+        print(f"⚠️ Rate history error: {e}")
+    finally:
+        session.close()
+
+rate_refresher.add_fetch_listener(record_rate_ticks)
+
+def parse_history_time(value, default):
+    """Unix timestamp (секунды) или ISO дата/время из query string"""
+    if not value:
+        return default
+    try:
+        return int(float(value))
+    except ValueError:
+        return int(datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp())
+
+def auto_history_resolution(from_ts, to_ts):
+    """Самое мелкое разрешение, при котором в ответе не больше ~500 точек"""
+    for name, (_, seconds) in RATE_HISTORY_RESOLUTIONS.items():
+        if (to_ts - from_ts) / seconds <= 500:
+            return name
+    return '1d'
 
 # ==================== PAGES ====================
 
@@ -481,13 +855,122 @@ def crm_index():
 @app.route('/api/rates', methods=['GET'])
 def get_rates():
     try:
-        rates = asyncio.run(ExchangeRateProvider.get_all_rates())
-        usdt_thb = rates.get('usdt_thb') or 35.20
-        rub_usdt = rates.get('rub_usdt') or 86.50
-        return jsonify({'usdt_thb': usdt_thb, 'rub_usdt': rub_usdt, 'success': True})
+        snapshot = rate_refresher.get()
+        return jsonify({
+            'usdt_thb': snapshot.usdt_thb, 'rub_usdt': snapshot.rub_usdt,
+            'version': snapshot.version, 'fetched_at': snapshot.fetched_at, 'source': snapshot.source,
+            'stale': rate_refresher.is_stale(snapshot),
+            'success': 'fallback' not in snapshot.source.values()
+        })
     except Exception as e:
         return jsonify({'error': str(e), 'usdt_thb': 35.20, 'rub_usdt': 86.50, 'success': False})
 
+# Как часто слать heartbeat в SSE и сколько держать одно соединение (клиент переподключится сам)
+RATES_STREAM_HEARTBEAT = 15
+RATES_STREAM_MAX_AGE = 600
+# Каждый поток держит поток gthread-воркера, поэтому одновременных потоков заметно меньше --threads
+# (Procfile: 16), чтобы API и CRM не вставали в очередь. Сверх лимита - 503, калькулятор опрашивает /api/rates
+RATES_STREAM_MAX = int(os.getenv('RATES_STREAM_MAX', 4))
+rates_stream_slots = threading.BoundedSemaphore(RATES_STREAM_MAX)
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/rates/stream', methods=['GET'])
+def rates_stream():
+    """SSE поток курсов: снапшот при подключении, дальше только изменения"""
+    if not rates_stream_slots.acquire(blocking=False):
+        response = jsonify({'success': False, 'error': 'Too many rate streams, poll /api/rates'})
+        response.status_code = 503
+        response.headers['Retry-After'] = str(RATES_STREAM_MAX_AGE)
+        return response
+    
+    def generate():
+        snapshot = rate_refresher.get()
+        data = snapshot.to_dict()
+        data['stale'] = rate_refresher.is_stale(snapshot)
+        yield "retry: 5000\n" + sse_event('snapshot', data)
+        
+        opened_at = time.time()
+        while time.time() - opened_at < RATES_STREAM_MAX_AGE:
+            current = rate_refresher.wait_for_change(snapshot.version, RATES_STREAM_HEARTBEAT)
+            heartbeat = {'version': current.version, 'fetched_at': current.fetched_at,
+                         'stale': rate_refresher.is_stale(current)}
+            if current.version == snapshot.version:
+                yield sse_event('heartbeat', heartbeat)
+                continue
+            # Отправляем только изменившиеся поля
+            delta = heartbeat
+            for field in ('usdt_thb', 'rub_usdt', 'source'):
+                if getattr(current, field) != getattr(snapshot, field):
+                    delta[field] = getattr(current, field)
+            snapshot = current
+            yield sse_event('delta', delta)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+    # Слот освобождается при закрытии ответа - и когда клиент ушёл до первого события
+    response.call_on_close(rates_stream_slots.release)
+    return response
+
+@app.route('/api/rates/history', methods=['GET'])
+def get_rates_history():
+    """История курса из готовых OHLC бакетов (сырые значения не читаются)"""
+    session = get_session()
+    try:
+        pair = request.args.get('pair', 'usdt_thb')
+        if pair not in ('usdt_thb', 'rub_usdt'):
+            return jsonify({'success': False, 'error': 'Invalid pair'}), 400
+        
+        now = int(time.time())
+        try:
+            to_ts = parse_history_time(request.args.get('to'), now)
+            from_ts = parse_history_time(request.args.get('from'), to_ts - 86400)
+        except ValueError:
+            return jsonify({'success': False, 'error': 'Invalid from/to'}), 400
+        if from_ts >= to_ts:
+            return jsonify({'success': False, 'error': 'from must be less than to'}), 400
+        
+        resolution = request.args.get('resolution', 'auto')
+        if resolution == 'auto':
+            resolution = auto_history_resolution(from_ts, to_ts)
+        if resolution not in RATE_HISTORY_RESOLUTIONS:
+            return jsonify({'success': False, 'error': f"resolution must be one of: auto, {', '.join(RATE_HISTORY_RESOLUTIONS)}"}), 400
+        base_resolution, seconds = RATE_HISTORY_RESOLUTIONS[resolution]
+        
+        bars = session.query(RateBar).filter(
+            RateBar.pair == pair, RateBar.resolution == base_resolution,
+            RateBar.bucket_ts >= from_ts - from_ts % seconds, RateBar.bucket_ts < to_ts
+        ).order_by(RateBar.bucket_ts).all()
+        
+        # Склеиваем базовые бакеты в запрошенное разрешение
+        points = []
+        for bar in bars:
+            bucket_ts = bar.bucket_ts - bar.bucket_ts % seconds
+            if points and points[-1]['ts'] == bucket_ts:
+                point = points[-1]
+                point['high'] = max(point['high'], bar.high)
+                point['low'] = min(point['low'], bar.low)
+                point['close'] = bar.close
+                point['count'] += bar.count or 0
+            else:
+                point = bar.to_dict()
+                point['ts'] = bucket_ts
+                points.append(point)
+        
+        return jsonify({'success': True, 'pair': pair, 'resolution': resolution,
+                        'from': from_ts, 'to': to_ts, 'points': points})
+    finally:
+        session.close()
+
+def operation_inputs(operation, data):
+    """(custom_rub_usdt, profit_margin) из запроса: у брокера есть значения по умолчанию, у Doverka пустая маржа - None"""
+    if operation.method == 'broker':
+        return float(data.get('custom_rub_usdt', 80.9)), float(data.get('profit_margin', 4.0))
+    return None, float(data.get('profit_margin')) if data.get('profit_margin') else None
+
 @app.route('/api/calculate', methods=['POST'])
 def calculate():
     try:
@@ -500,43 +983,177 @@ def calculate():
         if amount <= 0:
             return jsonify({'error': 'Invalid amount'}), 400
         
-        rates = asyncio.run(ExchangeRateProvider.get_all_rates())
-        
-        if method == 'broker':
-            from broker_detailed import BrokerCalculatorDetailed
-            custom_rub_usdt = float(data.get('custom_rub_usdt', 80.9))
-            profit_margin = float(data.get('profit_margin', 4.0))
-            broker_calc = BrokerCalculatorDetailed(rates['usdt_thb'], custom_rub_usdt, profit_margin)
-            
-            if scenario == 'rub-to-thb':
-                result = broker_calc.rub_to_thb_target(amount) if direction == 'target' else broker_calc.rub_to_thb_amount(amount)
-            elif scenario == 'thb-to-usdt':
-                result = broker_calc.thb_to_usdt_target(amount) if direction == 'target' else broker_calc.thb_to_usdt_amount(amount)
-            elif scenario == 'usdt-to-thb':
-                result = broker_calc.usdt_to_thb_target(amount) if direction == 'target' else broker_calc.usdt_to_thb_amount(amount)
-            elif scenario == 'rub-to-usdt':
-                result = broker_calc.rub_to_usdt_target(amount) if direction == 'target' else broker_calc.rub_to_usdt_amount(amount)
-            else:
-                return jsonify({'error': 'Invalid scenario'}), 400
-        else:
-            calculator = ExchangeCalculator(rates['usdt_thb'], rates['rub_usdt'])
-            profit_margin = float(data.get('profit_margin')) if data.get('profit_margin') else None
-            
-            if scenario == 'rub-to-thb':
-                result = calculator.rub_to_thb_target(amount, custom_profit_margin=profit_margin) if direction == 'target' else calculator.rub_to_thb(amount, custom_profit_margin=profit_margin)
-            elif scenario == 'thb-to-usdt':
-                result = calculator.thb_to_usdt_target(amount, custom_profit_margin=profit_margin) if direction == 'target' else calculator.thb_to_usdt(amount, custom_profit_margin=profit_margin)
-            elif scenario == 'usdt-to-thb':
-                result = calculator.usdt_to_thb_target(amount, custom_profit_margin=profit_margin) if direction == 'target' else calculator.usdt_to_thb(amount, custom_profit_margin=profit_margin)
-            elif scenario == 'rub-to-usdt':
-                result = calculator.rub_to_usdt_target(amount, custom_profit_margin=profit_margin) if direction == 'target' else calculator.rub_to_usdt_amount(amount, custom_profit_margin=profit_margin)
-            else:
-                return jsonify({'error': 'Invalid scenario'}), 400
-        
+        operation = resolve(method, scenario, direction)
+        if operation is None:
+            return jsonify({'error': 'Invalid scenario'}), 400
+        
+        snapshot = rate_refresher.get()
+        custom_rub_usdt, profit_margin = operation_inputs(operation, data)
+        
+        # Тот же расчёт при тех же курсах и таблицах отдаём готовым, вместе с уже выданной котировкой
+        cache_key = (operation.key, amount, profit_margin, custom_rub_usdt)
+        cache_version = (snapshot.version, pricing_store.current().version)
+        entry = calculate_cache.get(cache_key, cache_version)
+        if entry is not None:
+            return cached_json_response(entry, 'HIT')
+        
+        calculator = operation.calculator(snapshot, custom_rub_usdt, profit_margin)
+        result = operation.run(calculator, amount, profit_margin)
+        
+        result['rates_version'] = snapshot.version
+        quote = quote_store.issue(
+            {'method': operation.method, 'scenario': operation.scenario, 'direction': operation.direction,
+             'amount': amount,
+             'profit_margin': profit_margin,
+             'custom_rub_usdt': custom_rub_usdt},
+            result, snapshot.version
+        )
+        result['quote_id'] = quote['quote_id']
+        result['quote_expires_at'] = quote['expires_at']
+        entry = calculate_cache.put(cache_key, cache_version, app.json.dumps(result).encode(), quote['expires_at'])
+        return cached_json_response(entry, 'MISS')
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def cached_json_response(entry, cache_status):
+    """Ответ из записи calculate_cache: 304, если у клиента тот же ETag (If-None-Match)"""
+    if request.if_none_match.contains(entry['etag'].strip('"')):
+        calculate_cache.not_modified()
+        response = Response(status=304)
+    else:
+        response = Response(entry['body'], mimetype='application/json')
+    response.headers['ETag'] = entry['etag']
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.headers['X-Cache'] = cache_status
+    return response
+
+@app.route('/api/calculate/cache', methods=['GET'])
+def calculate_cache_stats():
+    """Статистика кэша ответов /api/calculate этого воркера (hit ratio, размер) для настройки CALC_CACHE_SIZE"""
+    return jsonify({'success': True, 'cache': calculate_cache.stats()})
+
+# Ограничение размера пакета для /api/calculate/batch
+BATCH_MAX_SIZE = int(os.getenv('BATCH_MAX_SIZE', 100000))
+
+@app.route('/api/calculate/batch', methods=['POST'])
+def calculate_batch_endpoint():
+    """
+    Пакетный расчёт (NumPy) для прайс-листов и свипов по суммам
+
+    Поля как у /api/calculate, каждое - скаляр для всего пакета или список по элементам.
+    format=columns отдаёт колонки вместо списка результатов. Котировки не выпускаются.
+    """
+    try:
+        data = request.get_json() or {}
+        count = batch_size(data)
+        if count > BATCH_MAX_SIZE:
+            return jsonify({'error': f'Batch too large (max {BATCH_MAX_SIZE})'}), 400
+
+        snapshot = rate_refresher.get()
+        columnar = (request.args.get('format') or data.get('format')) == 'columns'
+        results = calculate_batch(data, snapshot.usdt_thb, snapshot.rub_usdt, columnar=columnar)
+        response = {'success': True, 'count': count, 'rates_version': snapshot.version}
+        response['columns' if columnar else 'results'] = results
+        return jsonify(response)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/calculate/matrix', methods=['POST'])
+def calculate_matrix():
+    """
+    Все сценарии × направления × методы для одной суммы за один запрос
+
+    Калькуляторы берутся из кэша реестра (курсы продажи брокера посчитаны один раз на калькулятор),
+    общая часть выдачи THB для операций target считается один раз.
+    profit_margin - как в /api/calculate для каждого метода, doverka_profit_margin переопределяет его для Doverka.
+    Котировки не выпускаются: для сделки нужен /api/calculate по выбранной ячейке.
+    """
+    try:
+        data = request.get_json() or {}
+        amount = float(data.get('amount', 0))
+        if amount <= 0:
+            return jsonify({'error': 'Invalid amount'}), 400
+
+        snapshot = rate_refresher.get()
+        custom_rub_usdt = float(data.get('custom_rub_usdt', 80.9))
+        broker_margin = float(data.get('profit_margin', 4.0))
+        doverka_margin = data.get('doverka_profit_margin', data.get('profit_margin'))
+        doverka_margin = float(doverka_margin) if doverka_margin else None
+
+        results = {}
+        for operation in OPERATIONS.values():
+            margin = broker_margin if operation.method == 'broker' else doverka_margin
+            # Ошибка одной ячейки (например, деление на ноль на маленькой сумме) не ломает остальные
+            try:
+                calculator = operation.calculator(snapshot, custom_rub_usdt, margin)
+                cell = operation.run(calculator, amount, margin)
+            except Exception as e:
+                cell = {'error': str(e)}
+            results.setdefault(operation.method, {}).setdefault(operation.scenario, {})[operation.direction] = cell
+
+        return jsonify({'success': True, 'amount': amount, 'rates_version': snapshot.version, 'results': results})
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/calculate/sweep', methods=['POST'])
+def calculate_sweep():
+    """
+    Свип маржи брокера по сетке маржа × курс USDT-THB × кастомный RUB-USDT × сумма (NumPy)
+
+    Каждая ось - число, список или {'from', 'to', 'step'}. usdt_thb по умолчанию из снапшота,
+    operations - список 'scenario/direction' (по умолчанию все 8 операций брокера).
+    """
+    try:
+        data = request.get_json() or {}
+        if data.get('amount') is None:
+            return jsonify({'error': 'Invalid amount'}), 400
+        snapshot = rate_refresher.get()
+        result = sweep(
+            data.get('profit_margin', {'from': 0.5, 'to': 6.0, 'step': 0.1}),
+            data.get('usdt_thb', snapshot.usdt_thb),
+            data.get('custom_rub_usdt', 80.9),
+            data['amount'],
+            operations=data.get('operations'),
+            max_size=BATCH_MAX_SIZE
+        )
+        result.update({'success': True, 'rates_version': snapshot.version})
         return jsonify(result)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
+@app.route('/api/calculate/solve-margin', methods=['POST'])
+def calculate_solve_margin():
+    """Маржа брокера, при которой итоговый курс клиента равен (или не хуже) target_rate"""
+    try:
+        data = request.get_json() or {}
+        snapshot = rate_refresher.get()
+        operation = f"{data.get('scenario', 'rub-to-thb')}/{'target' if data.get('direction') == 'target' else 'amount'}"
+        solved = solve_margin(
+            operation,
+            float(data.get('usdt_thb', snapshot.usdt_thb)),
+            float(data.get('custom_rub_usdt', 80.9)),
+            float(data.get('amount', 0)),
+            float(data.get('target_rate', 0)),
+            min_margin=float(data.get('min_margin', SOLVE_MIN_MARGIN)),
+            max_margin=float(data.get('max_margin', SOLVE_MAX_MARGIN)),
+            step=float(data.get('step', SOLVE_STEP))
+        )
+        solved.update({'success': True, 'operation': operation, 'rates_version': snapshot.version})
+        return jsonify(solved)
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/api/quotes/<quote_id>', methods=['GET'])
+def get_quote(quote_id):
+    quote = quote_store.get(quote_id)
+    if not quote:
+        return jsonify({'success': False, 'error': 'Котировка не найдена или истекла'}), 404
+    return jsonify({'success': True, 'quote': quote})
+
 # ==================== CRM API - DEALS ====================
 
 @app.route('/api/deals', methods=['GET'])
@@ -571,6 +1188,13 @@ def create_deal():
     try:
         data = request.get_json()
         
+        # Расчёт из браузера (по /api/pricing/spec): пересчитываем на сервере и выпускаем котировку
+        if data.get('pricing') and not data.get('quote_id'):
+            quote, error = verify_local_pricing(data['pricing'])
+            if error:
+                return jsonify({'success': False, 'error': error}), 409
+            data['quote_id'] = quote['quote_id']
+        
         # Парсим дату если передана
         created_at = None
         if data.get('created_at'):
@@ -599,6 +1223,23 @@ def create_deal():
             else:
                 client_id = existing_client.id
         
+        # Сделка по котировке калькулятора: суммы и курс клиента берём из неё без пересчёта
+        quote_id = data.get('quote_id')
+        if quote_id:
+            quote = quote_store.get(quote_id)
+            if not quote:
+                return jsonify({'success': False, 'error': 'Котировка не найдена или истекла'}), 400
+            locked, defaults = quote_deal_fields(quote)
+            data.update({field: value for field, value in locked.items() if value is not None})
+            payout_usdt = data.get('payout_amount_usdt')
+            if payout_usdt is not None and data.get('profit_usdt') is None and data.get('payin_amount_usdt') is not None:
+                # Себестоимость выплаты указана вручную - прибыль считаем от неё, как форма CRM
+                data['profit_usdt'] = round(data['payin_amount_usdt'] - payout_usdt, 2)
+                data['profit_percent'] = round(data['profit_usdt'] / payout_usdt * 100, 2) if payout_usdt > 0 else 0
+            for field, value in defaults.items():
+                if data.get(field) is None:
+                    data[field] = value
+        
         deal = Deal(
             created_at=created_at,
             manager_name=data.get('manager_name'),
@@ -608,6 +1249,7 @@ def create_deal():
             client_name=client_name,
             payin_method=PayInMethod(data['payin_method']) if data.get('payin_method') else None,
             payin_amount_rub=data.get('payin_amount_rub'),
+            payin_amount_thb=data.get('payin_amount_thb'),
             payin_amount_usdt=data.get('payin_amount_usdt'),
             payin_rate_rub_usdt=data.get('payin_rate_rub_usdt'),
             payin_tx_hash=data.get('payin_tx_hash'),
@@ -623,6 +1265,7 @@ def create_deal():
             referrer_percent=data.get('referrer_percent'),
             profit_usdt=data.get('profit_usdt'),
             profit_percent=data.get('profit_percent'),
+            exchange_rate=data.get('exchange_rate'),
             net_profit_usdt=data.get('net_profit_usdt'),
             is_custom=data.get('is_custom', False),
             custom_payin_currency=data.get('custom_payin_currency'),
@@ -631,6 +1274,7 @@ def create_deal():
             custom_payout_currency=data.get('custom_payout_currency'),
             custom_payout_amount=data.get('custom_payout_amount'),
             custom_payout_rate=data.get('custom_payout_rate'),
+            quote_id=quote_id,
             notes=data.get('notes')
         )
         session.add(deal)
@@ -765,7 +1409,8 @@ def delete_deal(deal_id):
         reimbursement_id = deal.reimbursement_id
         
         # Удаляем связанные операции по кошелькам (Binance списания)
-        session.query(WalletOperation).filter(WalletOperation.deal_id == deal_id).delete()
+        for op in session.query(WalletOperation).filter(WalletOperation.deal_id == deal_id).all():
+            session.delete(op)
 
         session.delete(deal)
         session.flush()
@@ -789,6 +1434,132 @@ def delete_deal(deal_id):
     finally:
         session.close()
 
+# ==================== RISK ====================
+
+# Ограничение числа путей Монте-Карло на запрос
+RISK_MAX_PATHS = int(os.environ.get('RISK_MAX_PATHS', 100000))
+# Метод калькулятора для сделок без котировки (by_method группирует по методам калькулятора)
+PAYIN_CALC_METHODS = {PayInMethod.SPP_DOVERKA: 'doverka'}
+
+def load_rate_closes(resolution, from_ts):
+    """Закрытия бакетов обеих пар из rate_bars: {pair: [(bucket_ts, close), ...]}"""
+    session = get_session()
+    try:
+        rows = session.query(RateBar.pair, RateBar.bucket_ts, RateBar.close).filter(
+            RateBar.resolution == resolution, RateBar.bucket_ts >= from_ts
+        ).order_by(RateBar.bucket_ts).all()
+        closes = {}
+        for pair, bucket_ts, close in rows:
+            closes.setdefault(pair, []).append((bucket_ts, close))
+        return closes
+    finally:
+        session.close()
+
+def open_deal_positions():
+    """Позиции по сделкам в статусе pending: ноги в USDT из сделки, валюты - по заполненным суммам"""
+    session = get_session()
+    try:
+        positions, skipped = [], 0
+        for deal in session.query(Deal).filter(Deal.status == DealStatus.PENDING).all():
+            if deal.payin_amount_usdt is None or deal.payout_amount_usdt is None:
+                skipped += 1
+                continue
+            quote = quote_store.get(deal.quote_id)
+            if quote:
+                method = quote['params'].get('method')
+            else:
+                method = PAYIN_CALC_METHODS.get(deal.payin_method, 'unknown')
+            positions.append({
+                'incoming_usdt': deal.payin_amount_usdt,
+                'incoming_currency': 'RUB' if deal.payin_amount_rub else 'THB' if deal.payin_amount_thb else 'USDT',
+                'outgoing_usdt': deal.payout_amount_usdt,
+                'outgoing_currency': 'THB' if deal.payout_amount_thb else 'USDT',
+                'manager': deal.manager_name, 'method': method, 'deal_id': deal.id
+            })
+        return positions, skipped
+    finally:
+        session.close()
+
+@app.route('/api/risk/simulate', methods=['POST'])
+def simulate_risk():
+    """
+    Монте-Карло P&L незакрытых сделок по движению курсов USDT-THB и RUB-USDT
+
+    deals: 'open' (сделки pending) или гипотетическая книга - список запросов как у /api/calculate
+    (+ manager_name), они оцениваются калькулятором по текущему снапшоту.
+    model: 'bootstrap' (доходности из rate_bars) или 'parametric' (volatility - σ за сутки по парам,
+    по умолчанию оценивается по истории). horizon - секунды до исполнения сделок.
+    """
+    try:
+        data = request.get_json() or {}
+        paths = int(data.get('paths', 10000))
+        if not 0 < paths <= RISK_MAX_PATHS:
+            return jsonify({'error': f'paths must be between 1 and {RISK_MAX_PATHS}'}), 400
+        horizon = float(data.get('horizon', 86400))
+        confidence = [float(c) for c in data.get('confidence', [0.95, 0.99])]
+        if horizon <= 0 or not all(0 < c < 1 for c in confidence):
+            return jsonify({'error': 'Invalid horizon or confidence'}), 400
+
+        deals = data.get('deals', 'open')
+        if deals != 'open' and not (isinstance(deals, list) and all(isinstance(item, dict) for item in deals)):
+            return jsonify({'error': "deals must be 'open' or a list of deals"}), 400
+
+        snapshot = rate_refresher.get()
+        skipped = 0
+        if deals == 'open':
+            positions, skipped = open_deal_positions()
+        else:
+            positions = []
+            for item in deals:
+                operation = resolve(item.get('method', 'doverka'), item.get('scenario', 'rub-to-thb'),
+                                    item.get('direction', 'amount'))
+                amount = float(item.get('amount', 0))
+                if operation is None or amount <= 0:
+                    return jsonify({'error': f'Invalid deal: {item}'}), 400
+                custom_rub_usdt, profit_margin = operation_inputs(operation, item)
+                calculator = operation.calculator(snapshot, custom_rub_usdt, profit_margin)
+                result = operation.run(calculator, amount, profit_margin)
+                positions.append(position_from_result(result, operation.scenario, item.get('manager_name'),
+                                                      operation.method))
+        if not positions:
+            return jsonify({'error': 'No deals to simulate'}), 400
+
+        # Шаг истории: минутные бакеты для коротких горизонтов, часовые для длинных
+        resolution = data.get('resolution') or ('1m' if horizon < 6 * 3600 else '1h')
+        if resolution not in RATE_BAR_SECONDS:
+            return jsonify({'error': f"resolution must be one of: {', '.join(RATE_BAR_SECONDS)}"}), 400
+        step_seconds = RATE_BAR_SECONDS[resolution]
+        lookback_days = float(data.get('lookback_days', 30))
+        returns = history_returns(load_rate_closes(resolution, int(time.time() - lookback_days * 86400)))
+
+        model = data.get('model', 'bootstrap')
+        volatility = None
+        if model == 'parametric':
+            daily = data.get('volatility')
+            if daily:
+                volatility = [float(daily[pair]) * (step_seconds / 86400) ** 0.5 for pair in PAIRS]
+            elif len(returns) > 2:
+                volatility = returns.std(axis=0).tolist()
+            else:
+                return jsonify({'error': 'Not enough rate history, pass volatility'}), 400
+        elif model != 'bootstrap':
+            return jsonify({'error': "model must be 'bootstrap' or 'parametric'"}), 400
+
+        started = time.perf_counter()
+        factors = simulate_factors(paths, horizon / step_seconds, returns, volatility=volatility,
+                                   correlation=data.get('correlation'), seed=data.get('seed'))
+        report = simulate_book(positions, factors, confidence)
+        report.update({
+            'success': True, 'model': model, 'horizon': horizon, 'resolution': resolution,
+            'history_returns': len(returns), 'skipped_deals': skipped, 'rates_version': snapshot.version,
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1)
+        })
+        return jsonify(report)
+    except (ValueError, TypeError, KeyError) as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 # ==================== CRM API - CASH BATCHES ====================
 
 @app.route('/api/cash/batches', methods=['GET'])
@@ -888,79 +1659,69 @@ def create_manager():
 
 # ==================== CRM API - WALLETS ====================
 
+def fetch_wallet_balance(address):
+    """Баланс USDT/TRX кошелька с TronScan (None, если TronScan не ответил)"""
+    usdt_balance = 0
+    trx_balance = 0
+    balance_resp = tronscan_client.get('account', params={'address': address}, timeout=5)
+    if balance_resp.status_code == 200:
+        balance_data = balance_resp.json()
+        trx_balance = float(balance_data.get('balance', 0)) / 1_000_000
+        for token in balance_data.get('trc20token_balances', []):
+            if token.get('tokenId') == 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t':
+                usdt_balance = float(token.get('balance', 0)) / 1_000_000
+                break
+        return {'usdt': usdt_balance, 'trx': trx_balance}
+    
+    # Если ошибка, попробуем альтернативный эндпоинт баланса
+    alt_resp = tronscan_client.get('account/tokens', params={'address': address}, timeout=5)
+    if alt_resp.status_code == 200:
+        alt_data = alt_resp.json()
+        for token in alt_data.get('data', []):
+            if token.get('tokenId') == 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t':
+                usdt_balance = float(token.get('balance', 0)) / 1_000_000
+                break
+        # Кэшируем даже если TRX тут не нашли
+        return {'usdt': usdt_balance, 'trx': trx_balance}
+    return None
+
+# Балансы обновляются параллельно в фоне; страница ждёт их не дольше TRONSCAN_BALANCE_WAIT секунд,
+# не успевшие приходят с прошлым значением и pending - фронтенд дозапрашивает их
+balance_refresher = BalanceRefresher(fetch_wallet_balance, shared_cache, CACHE_TTL,
+                                     max_workers=int(os.getenv('TRONSCAN_BALANCE_WORKERS', 8)))
+TRONSCAN_BALANCE_WAIT = float(os.getenv('TRONSCAN_BALANCE_WAIT', 2))
+
 @app.route('/api/wallets', methods=['GET'])
 def get_wallets():
     session = get_session()
     try:
         force_refresh = request.args.get('force_refresh', 'false').lower() == 'true'
-        current_time = time.time()
         
         # Возвращаем только те, что для мониторинга
         wallets = session.query(Wallet).filter(Wallet.active == True, Wallet.is_monitored == True).order_by(Wallet.created_at.desc()).all()
         wallets_with_balance = []
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Apple) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
+        balances = balance_refresher.balances([w.address for w in wallets], TRONSCAN_BALANCE_WAIT, force=force_refresh)
+        pending = 0
         for wallet in wallets:
             wallet_data = wallet.to_dict()
-            
-            # Проверяем кэш для данного кошелька
-            cache_entry = TRONSCAN_CACHE['balances'].get(wallet.address)
-            if not force_refresh and cache_entry and (current_time - cache_entry['timestamp'] < CACHE_TTL):
-                wallet_data['usdt_balance'] = cache_entry['usdt']
-                wallet_data['trx_balance'] = cache_entry['trx']
-                wallet_data['cached'] = True
-                wallets_with_balance.append(wallet_data)
-                continue
-
             wallet_data['usdt_balance'] = 0
             wallet_data['trx_balance'] = 0
             
-            # Получаем баланс с TronScan
-            try:
-                balance_url = f'https://apilist.tronscanapi.com/api/account?address={wallet.address}'
-                balance_resp = requests.get(balance_url, headers=headers, timeout=5)
-                if balance_resp.status_code == 200:
-                    balance_data = balance_resp.json()
-                    wallet_data['trx_balance'] = float(balance_data.get('balance', 0)) / 1_000_000
-                    for token in balance_data.get('trc20token_balances', []):
-                        if token.get('tokenId') == 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t':
-                            wallet_data['usdt_balance'] = float(token.get('balance', 0)) / 1_000_000
-                            break
-                    
-                    # Обновляем кэш
-                    TRONSCAN_CACHE['balances'][wallet.address] = {
-                        'usdt': wallet_data['usdt_balance'],
-                        'trx': wallet_data['trx_balance'],
-                        'timestamp': current_time
-                    }
-                else:
-                    # Если ошибка, попробуем альтернативный эндпоинт баланса
-                    alt_url = f'https://apilist.tronscanapi.com/api/account/tokens?address={wallet.address}'
-                    alt_resp = requests.get(alt_url, headers=headers, timeout=5)
-                    if alt_resp.status_code == 200:
-                        alt_data = alt_resp.json()
-                        for token in alt_data.get('data', []):
-                            if token.get('tokenId') == 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t':
-                                wallet_data['usdt_balance'] = float(token.get('balance', 0)) / 1_000_000
-                                break
-                        
-                        # Обновляем кэш (даже если TRX не нашли тут)
-                        TRONSCAN_CACHE['balances'][wallet.address] = {
-                            'usdt': wallet_data['usdt_balance'],
-                            'trx': wallet_data['trx_balance'],
-                            'timestamp': current_time
-                        }
-                # Небольшая пауза между кошельками
-                time.sleep(0.3)
-            except:
-                pass
+            state = balances[wallet.address]
+            balance = state['balance']
+            if balance:
+                wallet_data['usdt_balance'] = balance['usdt']
+                wallet_data['trx_balance'] = balance['trx']
+                if state['cached']:
+                    wallet_data['cached'] = True
+            if state['pending']:
+                wallet_data['pending'] = True
+                pending += 1
             
             wallets_with_balance.append(wallet_data)
         
-        return jsonify({'success': True, 'wallets': wallets_with_balance})
+        return jsonify({'success': True, 'wallets': wallets_with_balance, 'pending': pending})
     finally:
         session.close()
 
@@ -992,27 +1753,19 @@ def add_wallet():
         )
         session.add(wallet)
         session.commit()
+        if wallet.is_monitored:
+            transfer_indexer.wake()
         
         # Frontend ожидает usdt_balance и trx_balance
         wallet_data = wallet.to_dict()
         wallet_data['usdt_balance'] = 0
         wallet_data['trx_balance'] = 0
         
-        # Попробуем получить реальный баланс
-        try:
-            balance_url = f'https://apilist.tronscanapi.com/api/account?address={address}'
-            balance_resp = requests.get(balance_url, timeout=5)
-            if balance_resp.status_code == 200:
-                balance_data = balance_resp.json()
-                # TRX баланс
-                wallet_data['trx_balance'] = float(balance_data.get('balance', 0)) / 1_000_000
-                # USDT баланс (ищем в trc20token_balances)
-                for token in balance_data.get('trc20token_balances', []):
-                    if token.get('tokenId') == 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t':
-                        wallet_data['usdt_balance'] = float(token.get('balance', 0)) / 1_000_000
-                        break
-        except:
-            pass
+        # Попробуем получить реальный баланс (через общий лимит, заодно попадёт в кэш)
+        balance = balance_refresher.balances([address], TRONSCAN_BALANCE_WAIT, force=True)[address]['balance']
+        if balance:
+            wallet_data['usdt_balance'] = balance['usdt']
+            wallet_data['trx_balance'] = balance['trx']
         
         return jsonify({'success': True, 'wallet': wallet_data})
     except Exception as e:
@@ -1042,31 +1795,193 @@ def delete_wallet(wallet_id):
     finally:
         session.close()
 
-def get_used_transaction_hashes(session):
-    """Собрать все хэши транзакций, которые уже используются в системе"""
+def get_used_transaction_hashes(session, tx_hashes):
+    """Какие из tx_hashes уже используются в системе (поиск по индексу used_tx_hashes)"""
+    tx_hashes = list({tx_hash for tx_hash in tx_hashes if tx_hash})
     used_hashes = set()
+    # Порциями, чтобы не упереться в лимит параметров SQLite
+    for n in range(0, len(tx_hashes), 500):
+        rows = session.query(UsedTxHash.tx_hash).filter(UsedTxHash.tx_hash.in_(tx_hashes[n:n + 500])).all()
+        used_hashes.update(row[0] for row in rows)
+    return used_hashes
+
+def parse_date_filters():
+    """start_date/end_date из query string в миллисекундные timestamp (как block_ts у TronScan)"""
+    start_date_str = request.args.get('start_date')
+    end_date_str = request.args.get('end_date')
     
-    # 1. Из таблицы Transaction
-    db_txs = session.query(Transaction.tx_hash).filter(Transaction.deal_id != None).all()
-    for tx in db_txs: used_hashes.add(tx[0])
-    
-    # 2. Из полей payin_tx_hash в Deal
-    deals_payin = session.query(Deal.payin_tx_hash).filter(Deal.payin_tx_hash != None).all()
-    for d in deals_payin: used_hashes.add(d[0])
-    
-    # 3. Из полей doverka_payout_hash в Deal
-    deals_doverka = session.query(Deal.doverka_payout_hash).filter(Deal.doverka_payout_hash != None).all()
-    for d in deals_doverka: used_hashes.add(d[0])
-    
-    # 4. Из полей tx_hash в Reimbursement
-    reimb_txs = session.query(Reimbursement.tx_hash).filter(Reimbursement.tx_hash != None).all()
-    for r in reimb_txs: used_hashes.add(r[0])
-    
-    # 5. Из таблицы WalletOperation
-    wallet_ops = session.query(WalletOperation.tx_hash).filter(WalletOperation.tx_hash != None).all()
-    for op in wallet_ops: used_hashes.add(op[0])
+    start_ts = None
+    if start_date_str:
+        try:
+            start_ts = int(datetime.strptime(start_date_str, '%Y-%m-%d').timestamp() * 1000)
+        except: pass
+        
+    end_ts = None
+    if end_date_str:
+        try:
+            end_ts = int((datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1)).timestamp() * 1000)
+        except: pass
+    return start_ts, end_ts
+
+def live_wallet_transfers(addresses, start_ts, end_ts, force_refresh=False):
+    """
+    Переводы кошельков напрямую из TronScan через кэш окон (одна запись на кошелёк для обеих вкладок)
+
+    Returns:
+        tuple: (переводы в окне дат без дублей - перевод между своими кошельками считается входящим,
+                когда TronScan проверялся последним из кошельков, все ли кошельки взяты из кэша)
+    """
+    merged = {}
+    oldest, all_cached = None, True
+    for address in addresses:
+        transfers, checked_at, cached = transfer_windows.window(address, start_ts, end_ts, force=force_refresh)
+        all_cached = all_cached and cached
+        if checked_at and (oldest is None or checked_at < oldest):
+            oldest = checked_at
+        for tx in transfers:
+            known = merged.get(tx['tx_hash'])
+            if known is None:
+                merged[tx['tx_hash']] = dict(tx)
+            elif tx['is_incoming']:
+                known['is_incoming'] = True
+    return sorted(merged.values(), key=lambda x: x['timestamp'], reverse=True), oldest, all_cached
+
+# ==================== TRONSCAN INDEX ====================
+
+def fetch_tronscan_page(address, start, limit, start_ts=None, end_ts=None):
+    """Страница USDT переводов кошелька с TronScan, от новых к старым (исключение, если TronScan не ответил)"""
+    params = {
+        'relatedAddress': address,
+        'contract_address': 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t',
+        'limit': limit,
+        'start': start,
+        't': int(time.time())
+    }
+    if start_ts is not None:
+        params['start_timestamp'] = start_ts
+    if end_ts is not None:
+        params['end_timestamp'] = end_ts
+    response = tronscan_client.get('token_trc20/transfers', params=params, timeout=10)
+    response.raise_for_status()
+    return response.json().get('token_transfers', [])
+
+# Непроиндексированные кошельки: окна переводов по кошелькам и датам в памяти воркера (LRU),
+# из TronScan докачиваются только недостающие диапазоны
+transfer_windows = TransferWindowCache(fetch_tronscan_page, CACHE_TTL)
+
+# Переводы отслеживаемых кошельков синхронизируются в transactions в фоне (TRONSCAN_INDEX_INTERVAL=off - выключить);
+# пока кошелёк не проиндексирован (или индекс давно не обновлялся), эндпоинты ходят в TronScan напрямую
+transfer_indexer = TransferIndexer(get_session, Wallet, Transaction, fetch_tronscan_page,
+                                   interval=env_seconds('TRONSCAN_INDEX_INTERVAL', 60), cache=shared_cache)
+
+# Сколько последних переводов читать из индекса на запрос
+INDEX_QUERY_LIMIT = 5000
+# Сколько секунд force_refresh может догружать индекс внутри запроса
+TRONSCAN_REFRESH_WAIT = float(os.environ.get('TRONSCAN_REFRESH_WAIT', 3))
+
+def split_indexed_wallets(wallets, force_refresh=False):
+    """
+    (адреса для чтения из индекса, адреса для TronScan напрямую)
+
+    Из индекса - только пока фоновая синхронизация включена и недавно проходила по кошельку.
+    С force_refresh новые переводы проиндексированных кошельков сначала догружаются в индекс,
+    но не дольше TRONSCAN_REFRESH_WAIT секунд: дальше отвечаем тем, что уже проиндексировано.
+    """
+    transfer_indexer.start()
+    indexed = [w.address for w in wallets if transfer_indexer.is_fresh(w)]
+    live = [w.address for w in wallets if w.address not in indexed]
+    if force_refresh:
+        transfer_indexer.refresh(indexed, TRONSCAN_REFRESH_WAIT)
+    return indexed, live
+
+def indexed_transfers(session, addresses, start_ts, end_ts, outgoing_only=False, own=None):
+    """
+    Переводы проиндексированных кошельков из transactions в формате ответа TronScan-эндпоинтов
+
+    own: Все кошельки запроса (индекс + TronScan) - is_incoming считается относительно них
+    """
+    if not addresses:
+        return []
+    from sqlalchemy import or_
+    query = session.query(Transaction.tx_hash, Transaction.from_address, Transaction.to_address,
+                          Transaction.amount_usdt, Transaction.timestamp, Transaction.block_ts, Transaction.confirmed)
+    if outgoing_only:
+        query = query.filter(Transaction.from_address.in_(addresses))
+    else:
+        query = query.filter(or_(Transaction.to_address.in_(addresses), Transaction.from_address.in_(addresses)))
+    if start_ts:
+        query = query.filter(Transaction.block_ts >= start_ts)
+    if end_ts:
+        query = query.filter(Transaction.block_ts <= end_ts)
+    rows = query.order_by(Transaction.block_ts.desc()).limit(INDEX_QUERY_LIMIT).all()
     
-    return used_hashes
+    own = {address.lower() for address in (own or addresses)}
+    transfers = []
+    for tx_hash, from_address, to_address, amount, timestamp, block_ts, confirmed in rows:
+        tx = {
+            'tx_hash': tx_hash,
+            'from_address': from_address,
+            'to_address': to_address,
+            'amount_usdt': amount,
+            'timestamp': timestamp.isoformat() if timestamp else None,
+            'block_ts': block_ts,
+            'confirmed': bool(confirmed)
+        }
+        if not outgoing_only:
+            tx['is_incoming'] = (to_address or '').lower() in own
+        transfers.append(tx)
+    return transfers
+
+def merge_transfers(indexed, live, live_addresses):
+    """Индекс + живые данные TronScan по непроиндексированным кошелькам, без дублей, от новых к старым"""
+    live_set = set(live_addresses)
+    seen = {tx['tx_hash']: tx for tx in indexed}
+    merged = list(indexed)
+    for tx in live:
+        if tx['to_address'] not in live_set and tx['from_address'] not in live_set:
+            continue
+        if tx['tx_hash'] in seen:
+            # Перевод между проиндексированным и живым кошельком: входящий, если входящий для любого из них
+            known = seen[tx['tx_hash']]
+            if 'is_incoming' in known:
+                known['is_incoming'] = known['is_incoming'] or tx.get('is_incoming', False)
+            continue
+        seen[tx['tx_hash']] = tx
+        merged.append(tx)
+    merged.sort(key=lambda x: x['timestamp'] or '', reverse=True)
+    return merged
+
+@app.route('/api/transactions/index', methods=['GET'])
+def get_transactions_index():
+    """Состояние индекса: курсоры по кошелькам и число переводов в transactions"""
+    session = get_session()
+    try:
+        transfer_indexer.start()
+        wallets = session.query(Wallet).filter(Wallet.active == True).all()
+        return jsonify({
+            'success': True,
+            'interval': transfer_indexer.interval,
+            'last_run': transfer_indexer.last_run,
+            'transactions': session.query(Transaction).count(),
+            'wallets': [{
+                'address': w.address,
+                'is_monitored': w.is_monitored,
+                'indexed_block_ts': w.indexed_block_ts,
+                'backfill_block_ts': w.backfill_block_ts,
+                'backfill_done': bool(w.backfill_done),
+                'forward_gap_ts': w.forward_gap_ts,
+                'indexed_at': w.indexed_at.isoformat() if w.indexed_at else None
+            } for w in wallets]
+        })
+    finally:
+        session.close()
+
+@app.route('/api/transactions/index/sync', methods=['POST'])
+def sync_transactions_index():
+    """Синхронизировать индекс сейчас (все отслеживаемые кошельки или один wallet)"""
+    data = request.get_json(silent=True) or {}
+    report = transfer_indexer.sync_all(data.get('wallet'))
+    return jsonify({'success': True, 'wallets': report})
 
 @app.route('/api/transactions/incoming', methods=['GET'])
 def get_incoming_transactions():
@@ -1075,133 +1990,45 @@ def get_incoming_transactions():
     try:
         # Получаем фильтры
         wallet_filter = request.args.get('wallet')
-        start_date_str = request.args.get('start_date')
-        end_date_str = request.args.get('end_date')
-        
-        start_ts = None
-        if start_date_str:
-            try:
-                start_ts = int(datetime.strptime(start_date_str, '%Y-%m-%d').timestamp() * 1000)
-            except: pass
-            
-        end_ts = None
-        if end_date_str:
-            try:
-                end_ts = int((datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1)).timestamp() * 1000)
-            except: pass
+        start_ts, end_ts = parse_date_filters()
+        force_refresh = request.args.get('force_refresh', 'false').lower() == 'true'
         
         if wallet_filter:
             wallets = session.query(Wallet).filter(Wallet.address == wallet_filter, Wallet.active == True).all()
         else:
             wallets = session.query(Wallet).filter(Wallet.active == True, Wallet.is_monitored == True).all()
+        wallets_checked = [w.address for w in wallets]
         
-        # Проверяем кэш
-        force_refresh = request.args.get('force_refresh', 'false').lower() == 'true'
-        cache_key = wallet_filter or 'all'
-        current_time = time.time()
-        
-        # Если не форсируем и есть свежий кэш
-        if not force_refresh and TRONSCAN_CACHE['incoming']['data'] and (current_time - TRONSCAN_CACHE['incoming']['timestamp'] < CACHE_TTL):
-            # Фильтруем кэшированные данные по кошельку, если нужно
-            cached_data = TRONSCAN_CACHE['incoming']['data']
-            if wallet_filter:
-                cached_data = [tx for tx in cached_data if tx['to_address'] == wallet_filter]
-            
-            # Получаем актуальные использованные хэши
-            used_hashes = get_used_transaction_hashes(session)
-            
-            available = [tx for tx in cached_data if tx['tx_hash'] not in used_hashes and tx.get('is_incoming')]
-            used = [tx for tx in cached_data if tx['tx_hash'] in used_hashes]
-            
-            return jsonify({
-                'success': True,
-                'available': available[:1000],
-                'used': used[:200],
-                'cached': True,
-                'cache_time': TRONSCAN_CACHE['incoming']['timestamp']
-            })
-
-        all_incoming = []
-        wallets_checked = []
-        
-        usdt_contract = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Apple) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
+        # Проиндексированные кошельки читаем из transactions, остальные - из TronScan, как раньше
+        indexed, live = split_indexed_wallets(wallets, force_refresh)
         
-        for wallet in wallets:
-            wallets_checked.append(wallet.address)
-            
-            try:
-                # По просьбе пользователя: сначала 1 страница (50 транзакций), если не хватит - можно расширить
-                for page in range(2):  # Было 10, стало 2 (100 транзакций на кошелек)
-                    url = f'https://apilist.tronscanapi.com/api/token_trc20/transfers'
-                    params = {
-                        'relatedAddress': wallet.address,
-                        'contract_address': usdt_contract,
-                        'limit': 50,
-                        'start': page * 50,
-                        't': int(time.time())
-                    }
-                    
-                    response = requests.get(url, params=params, headers=headers, timeout=5)
-                    if response.status_code == 200:
-                        data = response.json()
-                        transfers = data.get('token_transfers', [])
-                        if not transfers:
-                            break
-                            
-                        reached_start_ts = False
-                        for tx in transfers:
-                            tx_ts = tx.get('block_ts', 0)
-                            
-                            # Фильтр по дате (если задан)
-                            if start_ts and tx_ts < start_ts:
-                                reached_start_ts = True
-                                continue
-                            if end_ts and tx_ts > end_ts:
-                                continue
-                                
-                            amount = float(tx.get('quant', 0)) / 1_000_000
-                            
-                            all_incoming.append({
-                                'tx_hash': tx.get('transaction_id'),
-                                'from_address': tx.get('from_address'),
-                                'to_address': tx.get('to_address'),
-                                'amount_usdt': amount,
-                                'timestamp': datetime.fromtimestamp(tx_ts / 1000).isoformat(),
-                                'confirmed': tx.get('confirmed', False),
-                                'is_incoming': tx.get('to_address', '').lower() == wallet.address.lower()
-                            })
-                        
-                        if reached_start_ts:
-                            break
-                        # Пауза между страницами, чтобы не триггерить лимиты
-                        time.sleep(0.3)
-                    else:
-                        break
-            except Exception as e:
-                print(f"[DEBUG] TronScan request error for {wallet.address}: {e}")
-        
-        # Сортируем все транзакции по времени
-        all_incoming.sort(key=lambda x: x['timestamp'], reverse=True)
-        
-        # Обновляем кэш
-        if not wallet_filter: # Кэшируем только общий список
-            TRONSCAN_CACHE['incoming']['data'] = all_incoming
-            TRONSCAN_CACHE['incoming']['timestamp'] = current_time
+        live_incoming, cache_time, cached = [], None, False
+        if live:
+            live_incoming, cache_time, cached = live_wallet_transfers(live, start_ts, end_ts, force_refresh)
+        all_incoming = merge_transfers(indexed_transfers(session, indexed, start_ts, end_ts, own=wallets_checked),
+                                       live_incoming, live)
         
-        used_hashes = get_used_transaction_hashes(session)
+        used_hashes = get_used_transaction_hashes(session, [tx['tx_hash'] for tx in all_incoming])
         
         # Фильтруем: available = входящие и не использованные
         available = [tx for tx in all_incoming if tx['tx_hash'] not in used_hashes and tx.get('is_incoming')]
         used = [tx for tx in all_incoming if tx['tx_hash'] in used_hashes]
         
+        if cached:
+            return jsonify({
+                'success': True,
+                'available': available[:1000],
+                'used': used[:200],
+                'indexed_wallets': len(indexed),
+                'cached': True,
+                'cache_time': cache_time
+            })
         return jsonify({
             'success': True,
             'available': available[:1000],
             'used': used[:200],
             'wallets_checked': wallets_checked,
+            'indexed_wallets': len(indexed),
             'cached': False
         })
     except Exception as e:
@@ -1217,37 +2044,9 @@ def get_outgoing_transactions():
     try:
         # Получаем фильтры
         wallet_filter = request.args.get('wallet')
-        start_date_str = request.args.get('start_date')
-        end_date_str = request.args.get('end_date')
-        
-        start_ts = None
-        if start_date_str:
-            try:
-                start_ts = int(datetime.strptime(start_date_str, '%Y-%m-%d').timestamp() * 1000)
-            except: pass
-            
-        end_ts = None
-        if end_date_str:
-            try:
-                end_ts = int((datetime.strptime(end_date_str, '%Y-%m-%d') + timedelta(days=1)).timestamp() * 1000)
-            except: pass
-
-        # Проверяем кэш
+        start_ts, end_ts = parse_date_filters()
         force_refresh = request.args.get('force_refresh', 'false').lower() == 'true'
-        current_time = time.time()
         
-        if not force_refresh and TRONSCAN_CACHE['outgoing']['data'] and (current_time - TRONSCAN_CACHE['outgoing']['timestamp'] < CACHE_TTL):
-            cached_data = TRONSCAN_CACHE['outgoing']['data']
-            if wallet_filter:
-                cached_data = [tx for tx in cached_data if tx['from_address'] == wallet_filter]
-            
-            return jsonify({
-                'success': True,
-                'available': cached_data[:1000],
-                'cached': True,
-                'cache_time': TRONSCAN_CACHE['outgoing']['timestamp']
-            })
-
         if wallet_filter:
             wallets = session.query(Wallet).filter(Wallet.address == wallet_filter, Wallet.active == True).all()
         else:
@@ -1256,72 +2055,27 @@ def get_outgoing_transactions():
         if not wallets:
             return jsonify({'success': True, 'available': []})
         
-        all_outgoing = []
-        usdt_contract = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Apple) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        }
-        
-        for wallet in wallets:
-            try:
-                for page in range(2): # Было 10
-                    url = 'https://apilist.tronscanapi.com/api/token_trc20/transfers'
-                    params = {
-                        'relatedAddress': wallet.address,
-                        'contract_address': usdt_contract,
-                        'limit': 50,
-                        'start': page * 50,
-                        't': int(time.time())
-                    }
-                    
-                    response = requests.get(url, params=params, headers=headers, timeout=5)
-                    if response.status_code == 200:
-                        data = response.json()
-                        transfers = data.get('token_transfers', [])
-                        if not transfers:
-                            break
-                            
-                        reached_start_ts = False
-                        for tx in transfers:
-                            tx_ts = tx.get('block_ts', 0)
-                            
-                            # Фильтр по дате (если задан)
-                            if start_ts and tx_ts < start_ts:
-                                reached_start_ts = True
-                                continue
-                            if end_ts and tx_ts > end_ts:
-                                continue
-
-                            # Только исходящие (from_address == наш кошелёк)
-                            if tx.get('from_address') == wallet.address:
-                                amount = float(tx.get('quant', 0)) / 1_000_000
-                                all_outgoing.append({
-                                    'tx_hash': tx.get('transaction_id'),
-                                    'from_address': tx.get('from_address'),
-                                    'to_address': tx.get('to_address'),
-                                    'amount_usdt': amount,
-                                    'timestamp': datetime.fromtimestamp(tx_ts / 1000).isoformat(),
-                                    'confirmed': tx.get('confirmed', False)
-                                })
-                        
-                        if reached_start_ts:
-                            break
-                        time.sleep(0.3)
-                    else:
-                        break
-            except Exception as e:
-                print(f"[DEBUG] TronScan outgoing error for {wallet.address}: {e}")
+        # Проиндексированные кошельки читаем из transactions, остальные - из TronScan, как раньше
+        indexed, live = split_indexed_wallets(wallets, force_refresh)
         
-        all_outgoing.sort(key=lambda x: x['timestamp'], reverse=True)
+        live_outgoing, cache_time, cached = [], None, False
+        if live:
+            live_outgoing, cache_time, cached = live_wallet_transfers(live, start_ts, end_ts, force_refresh)
+        all_outgoing = merge_transfers(indexed_transfers(session, indexed, start_ts, end_ts, outgoing_only=True),
+                                       [tx for tx in live_outgoing if tx['from_address'] in live], live)
         
-        # Обновляем кэш
-        if not wallet_filter:
-            TRONSCAN_CACHE['outgoing']['data'] = all_outgoing
-            TRONSCAN_CACHE['outgoing']['timestamp'] = current_time
-
+        if cached:
+            return jsonify({
+                'success': True,
+                'available': all_outgoing[:1000],
+                'indexed_wallets': len(indexed),
+                'cached': True,
+                'cache_time': cache_time
+            })
         return jsonify({
             'success': True, 
             'available': all_outgoing[:1000],
+            'indexed_wallets': len(indexed),
             'cached': False
         })
     except Exception as e:
@@ -1339,8 +2093,7 @@ def verify_transaction_post():
         if not tx_hash:
             return jsonify({'success': False, 'error': 'Не указан хэш транзакции'}), 400
         
-        url = f'https://apilist.tronscanapi.com/api/transaction-info?hash={tx_hash}'
-        response = requests.get(url, timeout=10)
+        response = tronscan_client.get('transaction-info', params={'hash': tx_hash}, timeout=10)
         
         if response.status_code != 200:
             return jsonify({'success': False, 'error': 'Транзакция не найдена'}), 404
@@ -1368,13 +2121,18 @@ def verify_transaction_post():
 
 # ==================== TRONSCAN API (legacy) ====================
 
+@app.route('/api/tronscan/stats', methods=['GET'])
+def get_tronscan_stats():
+    """Счётчики клиента TronScan этого воркера: запросы, ошибки, повторы, задержки по эндпоинтам"""
+    return jsonify({'success': True, 'endpoints': tronscan_client.stats(), 'limiter': tronscan_limiter.stats(),
+                    'transfer_cache': transfer_windows.stats()})
+
 @app.route('/api/tronscan/transactions/<address>', methods=['GET'])
 def get_tronscan_transactions(address):
     """Получить USDT транзакции с TronScan API"""
     try:
         # TronScan API для TRC20 транзакций (USDT)
         usdt_contract = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
-        url = f'https://apilist.tronscanapi.com/api/token_trc20/transfers'
         params = {
             'relatedAddress': address,
             'contract_address': usdt_contract,
@@ -1382,7 +2140,7 @@ def get_tronscan_transactions(address):
             'start': 0
         }
         
-        response = requests.get(url, params=params, timeout=10)
+        response = tronscan_client.get('token_trc20/transfers', params=params, timeout=10)
         if response.status_code != 200:
             return jsonify({'success': False, 'error': f'TronScan API error: {response.status_code}'}), 500
         
@@ -1418,8 +2176,7 @@ def get_tronscan_transactions(address):
 def verify_transaction(tx_hash):
     """Проверить транзакцию по хэшу"""
     try:
-        url = f'https://apilist.tronscanapi.com/api/transaction-info?hash={tx_hash}'
-        response = requests.get(url, timeout=10)
+        response = tronscan_client.get('transaction-info', params={'hash': tx_hash}, timeout=10)
         
         if response.status_code != 200:
             return jsonify({'success': False, 'error': 'Транзакция не найдена'}), 404
@@ -1851,7 +2608,7 @@ def send_telegram_notification(text):
     if not token or not chat_id:
         return False
     try:
-        response = requests.post(f"https://api.telegram.org/bot{token}/sendMessage",
+        response = requests.post(f"{TELEGRAM_API}/bot{token}/sendMessage",
                                 json={"chat_id": chat_id, "text": text, "parse_mode": "HTML"}, timeout=10)
         return response.status_code == 200
     except:
@@ -1925,6 +2682,7 @@ def health_check():
         'success': True, 'status': 'ok',
         'service': 'CalcCRM Unified Service',
         'database': 'postgresql' if 'postgresql' in DATABASE_URL else 'sqlite',
+        'rate_sources': ExchangeRateProvider.SOURCE_STATS,
         'timestamp': datetime.now().isoformat()
     })
 
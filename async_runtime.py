@@ -0,0 +1,109 @@
+"""
+Долгоживущий event loop для асинхронных запросов к внешним API
+Один поток с loop на воркер gunicorn + общие keep-alive сессии aiohttp
+"""
+
+import asyncio
+import atexit
+import os
+import threading
+
+import aiohttp
+
+
+class AsyncRuntime:
+    """Event loop в фоновом потоке с пулом HTTP-сессий"""
+
+    # Параметры пула соединений для каждой сессии
+    CONNECTION_LIMIT = int(os.getenv('HTTP_POOL_LIMIT', 20))
+    KEEPALIVE_TIMEOUT = 60
+    DNS_CACHE_TTL = 300
+
+    def __init__(self):
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Запустить поток с loop (идемпотентно; после fork создаётся заново)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._sessions = {}
+            self._loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._loop, ready),
+                                            name='async-runtime', daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run(self, loop, ready):
+        asyncio.set_event_loop(loop)
+        loop.call_soon(ready.set)
+        loop.run_forever()
+
+    def in_loop(self) -> bool:
+        """Выполняется ли текущий код внутри нашего loop"""
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def run(self, coro, timeout: float = None):
+        """
+        Синхронный мост: выполнить корутину в общем loop и дождаться результата
+
+        Вызывается из обычных потоков (Flask view, фоновые потоки), не из самого loop.
+        """
+        self.start()
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def http_session(self, name: str = 'default') -> aiohttp.ClientSession:
+        """
+        Общая keep-alive сессия для заданного upstream
+
+        Вызывать только из корутин, выполняющихся в loop рантайма.
+        """
+        session = self._sessions.get(name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.CONNECTION_LIMIT,
+                keepalive_timeout=self.KEEPALIVE_TIMEOUT,
+                ttl_dns_cache=self.DNS_CACHE_TTL
+            )
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[name] = session
+        return session
+
+    async def _close_sessions(self):
+        for session in list(self._sessions.values()):
+            if not session.closed:
+                await session.close()
+        self._sessions = {}
+
+    def close(self):
+        """Закрыть сессии и остановить loop"""
+        if self._loop is None or self._pid != os.getpid() or not self._loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._close_sessions(), self._loop).result(5)
+        except Exception:
+            pass
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+runtime = AsyncRuntime()
+atexit.register(runtime.close)
+
+
+def run_sync(coro, timeout: float = None):
+    """Выполнить корутину в общем loop воркера"""
+    return runtime.run(coro, timeout)
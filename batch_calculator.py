@@ -0,0 +1,823 @@
+"""
+Пакетный расчёт калькулятора на NumPy
+Те же формулы, что в ExchangeCalculator и BrokerCalculatorDetailed, но сразу для массива сумм.
+Порядок операций повторяет скалярный код, поэтому результаты совпадают побитово.
+"""
+
+import math
+from collections import OrderedDict
+
+import numpy as np
+
+from broker_detailed import BrokerCalculatorDetailed
+from calculator import ExchangeCalculator, pricing_store
+from money import excel_round, excel_round_array
+
+SCENARIOS = ('rub-to-thb', 'thb-to-usdt', 'usdt-to-thb', 'rub-to-usdt')
+
+
+def _guarded(values: np.ndarray, condition: np.ndarray):
+    """Значение с условием `... if condition else 0`: (массив, маска где скаляр вернул бы int 0)"""
+    return np.where(condition, values, 0.0), ~condition
+
+
+# ==================== DOVERKA ====================
+
+def _doverka_commissions(margin: np.ndarray, rub_amount: np.ndarray):
+    """Векторный ExchangeCalculator._get_commissions: (usdt_comm, bonus, level_name)"""
+    tables = pricing_store.current().arrays
+    mins, maxs = tables['level_mins'], tables['level_maxs']
+    level = np.searchsorted(mins, rub_amount, side='right') - 1
+    inside = (level >= 0) & (rub_amount < maxs[level.clip(0)])
+    level = np.where(inside, level, len(mins) - 1)
+    usdt_default = tables['level_usdt_thb_commission'][level]
+    bonus = tables['level_bonus_percent'][level]
+
+    custom = ~np.isnan(margin)
+    xs, ys = tables['curve_xs'], tables['curve_ys']
+    t = np.where(custom, margin, xs[0])
+    i = np.clip(np.searchsorted(xs, t, side='right') - 1, 0, len(xs) - 2)
+    x1, x2, y1, y2 = xs[i], xs[i + 1], ys[i], ys[i + 1]
+    usdt_comm = y1 + (y2 - y1) * (t - x1) / (x2 - x1)
+    usdt_comm = np.where(t > xs[-1], ys[-1], np.where(t < xs[0], ys[0], usdt_comm))
+    exact = np.searchsorted(xs, t).clip(0, len(xs) - 1)
+    usdt_comm = np.where(xs[exact] == t, ys[exact], usdt_comm)
+
+    usdt_comm = np.where(custom, usdt_comm, usdt_default)
+    level_name = [f"Индивидуальный ({m}%)" if not math.isnan(m) else "Стандартный" for m in margin.tolist()]
+    return usdt_comm, bonus, level_name
+
+
+def _doverka_target_profit(margin: np.ndarray, default: float):
+    target_profit = np.where(np.isnan(margin), default, margin)
+    return target_profit, [f"Doverka ({t}%)" for t in target_profit.tolist()]
+
+
+def _doverka_rub_to_thb(U, R, rub_amount, margin):
+    er = excel_round_array
+    usdt_comm, bonus, level_name = _doverka_commissions(margin, rub_amount)
+    rub_comm = 0.0
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    usdt_amount = rub_amount / rub_usdt_rate_sell
+    usdt_thb_rate_sell = U * (1 - usdt_comm)
+    thb_to_exchange = usdt_amount * usdt_thb_rate_sell
+    withdrawal_percent_fee = er(thb_to_exchange * 0.0025, 2)
+    thb_to_receive = er(thb_to_exchange - withdrawal_percent_fee - 20, 2)
+    final_rate = er(rub_amount / thb_to_receive, 6)
+    bonus_usdt = er(usdt_amount * bonus, 2)
+    incoming_usdt = er(usdt_amount + bonus_usdt, 2)
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent = _guarded(er((profit_usdt / outgoing_usdt) * 100, 2), outgoing_usdt > 0)
+    return OrderedDict([
+        ('scenario', 'RUB → THB'),
+        ('direction', 'amount'),
+        ('rub_amount', rub_amount),
+        ('rub_paid', rub_amount),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', excel_round(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', excel_round(rub_usdt_rate_sell, 4)),
+        ('usdt_amount', er(usdt_amount, 2)),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 4)),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('withdrawal_fixed', 20),
+        ('thb_received', thb_to_receive),
+        ('final_rate', final_rate),
+        ('bonus_usdt', bonus_usdt),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', profit_percent),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_rub_to_thb_target(U, R, thb_target, margin):
+    er = excel_round_array
+    estimated_rub = thb_target * (R / U) * 1.05
+    usdt_comm, bonus, level_name = _doverka_commissions(margin, estimated_rub)
+    rub_comm = 0.0
+    thb_to_exchange = (thb_target + 20) / (1 - 0.0025)
+    withdrawal_percent_fee = er(thb_to_exchange - thb_target - 20, 2)
+    usdt_thb_rate_sell = U * (1 - usdt_comm)
+    usdt_amount = thb_to_exchange / usdt_thb_rate_sell
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    rub_amount = er(usdt_amount * rub_usdt_rate_sell, 2)
+    final_rate = er(rub_amount / thb_target, 6)
+    bonus_usdt = er(usdt_amount * bonus, 2)
+    incoming_usdt = er(usdt_amount + bonus_usdt, 2)
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent = er((profit_usdt / outgoing_usdt) * 100, 2)
+    return OrderedDict([
+        ('scenario', 'RUB → THB'),
+        ('direction', 'target'),
+        ('thb_target', thb_target),
+        ('thb_received', thb_target),
+        ('withdrawal_fixed', 20),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 4)),
+        ('usdt_amount', er(usdt_amount, 2)),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', excel_round(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', excel_round(rub_usdt_rate_sell, 4)),
+        ('rub_amount', rub_amount),
+        ('rub_to_pay', rub_amount),
+        ('final_rate', final_rate),
+        ('bonus_usdt', bonus_usdt),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', profit_percent),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_thb_to_usdt(U, R, thb_amount, margin):
+    er = excel_round_array
+    target_profit, level_name = _doverka_target_profit(margin, 3.0)
+    usdt_comm = target_profit / 100.0
+    usdt_thb_rate_sell = U * (1 + usdt_comm)
+    usdt_before_commission = thb_amount / usdt_thb_rate_sell
+    usdt_received = er(usdt_before_commission - 1, 2)
+    final_rate = er(thb_amount / usdt_received, 6)
+    incoming_usdt = er(thb_amount / U, 2)
+    outgoing_usdt = usdt_received
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    return OrderedDict([
+        ('scenario', 'THB → USDT'),
+        ('direction', 'amount'),
+        ('thb_amount', thb_amount),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('usdt_amount', er(usdt_before_commission, 2)),
+        ('withdrawal_fixed', 1),
+        ('thb_received', usdt_received),
+        ('usdt_received', usdt_received),
+        ('final_rate', final_rate),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', target_profit),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_thb_to_usdt_target(U, R, usdt_target, margin):
+    er = excel_round_array
+    target_profit, level_name = _doverka_target_profit(margin, 3.0)
+    usdt_comm = target_profit / 100.0
+    usdt_before_commission = usdt_target + 1
+    usdt_thb_rate_sell = U * (1 + usdt_comm)
+    thb_amount = er(usdt_before_commission * usdt_thb_rate_sell, 2)
+    final_rate = er(thb_amount / usdt_target, 6)
+    incoming_usdt = er(thb_amount / U, 2)
+    outgoing_usdt = usdt_target
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    return OrderedDict([
+        ('scenario', 'THB → USDT'),
+        ('direction', 'target'),
+        ('usdt_target', usdt_target),
+        ('withdrawal_fixed', 1),
+        ('usdt_amount', usdt_before_commission),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('thb_amount', thb_amount),
+        ('thb_to_pay', thb_amount),
+        ('final_rate', final_rate),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', target_profit),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_usdt_to_thb(U, R, usdt_amount, margin):
+    er = excel_round_array
+    target_profit, level_name = _doverka_target_profit(margin, 4.0)
+    usdt_comm = target_profit / 100.0
+    usdt_thb_rate_sell = U * (1 - usdt_comm)
+    thb_to_exchange = usdt_amount * usdt_thb_rate_sell
+    withdrawal_percent_fee = er(thb_to_exchange * 0.0025, 2)
+    thb_to_receive = er(thb_to_exchange - withdrawal_percent_fee - 20, 2)
+    final_rate = er(thb_to_receive / usdt_amount, 4)
+    incoming_usdt = usdt_amount
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    return OrderedDict([
+        ('scenario', 'USDT → THB'),
+        ('direction', 'amount'),
+        ('usdt_amount', usdt_amount),
+        ('usdt_paid', usdt_amount),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('withdrawal_fixed', 20),
+        ('thb_received', thb_to_receive),
+        ('final_rate', final_rate),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', target_profit),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_usdt_to_thb_target(U, R, thb_target, margin):
+    er = excel_round_array
+    target_profit, level_name = _doverka_target_profit(margin, 4.0)
+    usdt_comm = target_profit / 100.0
+    thb_to_exchange = (thb_target + 20) / (1 - 0.0025)
+    withdrawal_percent_fee = er(thb_to_exchange - thb_target - 20, 2)
+    usdt_thb_rate_sell = U * (1 - usdt_comm)
+    usdt_amount = er(thb_to_exchange / usdt_thb_rate_sell, 2)
+    final_rate = er(thb_target / usdt_amount, 4)
+    incoming_usdt = usdt_amount
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    return OrderedDict([
+        ('scenario', 'USDT → THB'),
+        ('direction', 'target'),
+        ('thb_target', thb_target),
+        ('thb_received', thb_target),
+        ('withdrawal_fixed', 20),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('usdt_amount', usdt_amount),
+        ('usdt_to_pay', usdt_amount),
+        ('final_rate', final_rate),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', target_profit),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_rub_to_usdt_target(U, R, usdt_target, margin):
+    er = excel_round_array
+    target_profit, level_name = _doverka_target_profit(margin, 3.0)
+    rub_comm = target_profit / 100.0
+    bonus = 0.024
+    usdt_before_commission = usdt_target + 1
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    rub_amount = er(usdt_before_commission * rub_usdt_rate_sell, 2)
+    final_rate = er(rub_amount / usdt_target, 6)
+    bonus_usdt = er(usdt_before_commission * bonus, 2)
+    incoming_usdt = er(usdt_before_commission + bonus_usdt, 2)
+    outgoing_usdt = usdt_before_commission
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    return OrderedDict([
+        ('scenario', 'RUB → USDT'),
+        ('direction', 'target'),
+        ('usdt_target', usdt_target),
+        ('withdrawal_fixed', 1),
+        ('usdt_amount', usdt_before_commission),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', er(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', er(rub_usdt_rate_sell, 4)),
+        ('rub_amount', rub_amount),
+        ('rub_to_pay', rub_amount),
+        ('final_rate', final_rate),
+        ('bonus_usdt', bonus_usdt),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', target_profit),
+        ('commission_level', level_name)
+    ])
+
+
+def _doverka_rub_to_usdt_amount(U, R, rub_amount, margin):
+    er = excel_round_array
+    target_profit, level_name = _doverka_target_profit(margin, 3.0)
+    rub_comm = target_profit / 100.0
+    bonus = 0.024
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    usdt_before_commission = rub_amount / rub_usdt_rate_sell
+    usdt_received = er(usdt_before_commission - 1, 2)
+    final_rate = er(rub_amount / usdt_received, 6)
+    bonus_usdt = er(usdt_before_commission * bonus, 2)
+    incoming_usdt = er(usdt_before_commission + bonus_usdt, 2)
+    outgoing_usdt = usdt_before_commission
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    return OrderedDict([
+        ('scenario', 'RUB → USDT'),
+        ('direction', 'amount'),
+        ('rub_amount', rub_amount),
+        ('rub_paid', rub_amount),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', er(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', er(rub_usdt_rate_sell, 4)),
+        ('usdt_amount', er(usdt_before_commission, 2)),
+        ('withdrawal_fixed', 1),
+        ('usdt_received', usdt_received),
+        ('final_rate', final_rate),
+        ('bonus_usdt', bonus_usdt),
+        ('incoming_usdt', incoming_usdt),
+        ('outgoing_usdt', outgoing_usdt),
+        ('profit_usdt', profit_usdt),
+        ('profit_percent_actual', target_profit),
+        ('commission_level', level_name)
+    ])
+
+
+# ==================== BROKER ====================
+
+def _broker_commissions(target_profit: np.ndarray):
+    """Векторный BrokerCalculatorDetailed.commissions: (rub_comm, usdt_comm, thb_usdt_comm, usdt_thb_direct, name)"""
+    rub_comm = (target_profit / 100.0) / 2.0
+    usdt_comm = rub_comm
+    thb_usdt_comm = (target_profit / 100.0) * 1.025
+    usdt_thb_direct = target_profit / 100.0
+    for level, values in reversed(list(BrokerCalculatorDetailed.PRESETS.items())):
+        match = np.abs(target_profit - level) < BrokerCalculatorDetailed.PRESET_TOLERANCE
+        rub_comm = np.where(match, values[0], rub_comm)
+        usdt_comm = np.where(match, values[1], usdt_comm)
+        thb_usdt_comm = np.where(match, values[2], thb_usdt_comm)
+        usdt_thb_direct = np.where(match, values[3], usdt_thb_direct)
+    name = [f"Брокер ({t}%)" for t in target_profit.tolist()]
+    return rub_comm, usdt_comm, thb_usdt_comm, usdt_thb_direct, name
+
+
+def _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt, profit_percent_actual):
+    columns['commission_level'] = name
+    columns['profit_percent'] = target_profit
+    columns['incoming_usdt'] = incoming_usdt
+    columns['outgoing_usdt'] = outgoing_usdt
+    columns['profit_usdt'] = profit_usdt
+    columns['profit_percent_actual'] = profit_percent_actual
+    return columns
+
+
+def _broker_rub_to_thb_target(U, R, thb_target, target_profit):
+    er = excel_round_array
+    rub_comm, usdt_comm, _, _, name = _broker_commissions(target_profit)
+    thb_to_exchange = (thb_target + 20) / (1 - 0.0025)
+    withdrawal_percent_fee = er(thb_to_exchange - thb_target - 20, 2)
+    usdt_thb_rate_sell = U * (1 - usdt_comm)
+    usdt_amount = thb_to_exchange / usdt_thb_rate_sell
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    rub_amount = er(usdt_amount * rub_usdt_rate_sell, 2)
+    final_rate = er(rub_amount / thb_target, 6)
+    incoming_usdt = er(usdt_amount * (1 + rub_comm), 2)
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / outgoing_usdt) * 100, 2), outgoing_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '1'),
+        ('operation_name', 'Обменять сумму в рублях на конкретную сумму THB'),
+        ('direction', 'target'),
+        ('scenario', 'RUB → THB'),
+        ('thb_target', thb_target),
+        ('withdrawal_fixed', 20),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 4)),
+        ('usdt_amount', er(usdt_amount, 2)),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', er(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', er(rub_usdt_rate_sell, 2)),
+        ('rub_amount', rub_amount),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_rub_to_thb_amount(U, R, rub_amount, target_profit):
+    er = excel_round_array
+    rub_comm, usdt_comm, _, _, name = _broker_commissions(target_profit)
+    # Для amount комиссии переставлены местами (как в скалярном калькуляторе)
+    rub_usdt_rate_sell = R * (1 + usdt_comm)
+    usdt_amount = rub_amount / rub_usdt_rate_sell
+    usdt_thb_rate_sell = U * (1 - rub_comm)
+    thb_to_exchange = usdt_amount * usdt_thb_rate_sell
+    withdrawal_percent_fee = er(thb_to_exchange * 0.0025, 2)
+    thb_to_receive = er(thb_to_exchange - withdrawal_percent_fee - 20, 2)
+    final_rate = er(rub_amount / thb_to_receive, 6)
+    incoming_usdt = er(usdt_amount * (1 + usdt_comm), 2)
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / outgoing_usdt) * 100, 2), outgoing_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '2'),
+        ('operation_name', 'Обменять конкретную сумму в рублях на THB'),
+        ('direction', 'amount'),
+        ('scenario', 'RUB → THB'),
+        ('rub_amount', rub_amount),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', er(usdt_comm * 100, 2)),
+        ('rub_usdt_rate_sell', er(rub_usdt_rate_sell, 2)),
+        ('usdt_amount', er(usdt_amount, 2)),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(rub_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 4)),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('withdrawal_fixed', 20),
+        ('thb_received', thb_to_receive),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_thb_to_usdt_target(U, R, usdt_target, target_profit):
+    er = excel_round_array
+    _, _, thb_usdt_comm, _, name = _broker_commissions(target_profit)
+    usdt_before_commission = usdt_target + 1
+    usdt_thb_rate_sell = U * (1 + thb_usdt_comm)
+    thb_amount = er(usdt_before_commission * usdt_thb_rate_sell, 2)
+    final_rate = er(thb_amount / usdt_target, 6)
+    incoming_usdt = er(thb_amount / U, 2)
+    outgoing_usdt = usdt_target
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / incoming_usdt) * 100, 2), incoming_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '3'),
+        ('operation_name', 'Обменять сумму в THB на конкретную сумму в USDT'),
+        ('direction', 'target'),
+        ('scenario', 'THB → USDT'),
+        ('usdt_target', usdt_target),
+        ('withdrawal_commission', 1),
+        ('usdt_before_commission', usdt_before_commission),
+        ('usdt_thb_rate', U),
+        ('thb_usdt_commission', er(thb_usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('thb_amount', thb_amount),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_thb_to_usdt_amount(U, R, thb_amount, target_profit):
+    er = excel_round_array
+    _, _, thb_usdt_comm, _, name = _broker_commissions(target_profit)
+    usdt_thb_rate_sell = U * (1 + thb_usdt_comm)
+    usdt_before_commission = thb_amount / usdt_thb_rate_sell
+    usdt_to_receive = er(usdt_before_commission - 1, 2)
+    final_rate = er(thb_amount / usdt_to_receive, 6)
+    incoming_usdt = er(thb_amount / U, 2)
+    outgoing_usdt = usdt_to_receive
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / incoming_usdt) * 100, 2), incoming_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '4'),
+        ('operation_name', 'Обменять конкретную сумму в THB на USDT'),
+        ('direction', 'amount'),
+        ('scenario', 'THB → USDT'),
+        ('thb_amount', thb_amount),
+        ('usdt_thb_rate', U),
+        ('thb_usdt_commission', er(thb_usdt_comm * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('usdt_before_commission', er(usdt_before_commission, 2)),
+        ('withdrawal_commission', 1),
+        ('usdt_received', usdt_to_receive),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_usdt_to_thb_target(U, R, thb_target, target_profit):
+    er = excel_round_array
+    _, _, _, usdt_thb_direct, name = _broker_commissions(target_profit)
+    thb_to_exchange = (thb_target + 20) / (1 - 0.0025)
+    withdrawal_percent_fee = er(thb_to_exchange - thb_target - 20, 2)
+    usdt_thb_rate_sell = U * (1 - usdt_thb_direct)
+    usdt_amount = er(thb_to_exchange / usdt_thb_rate_sell, 2)
+    final_rate = er(thb_target / usdt_amount, 6)
+    incoming_usdt = usdt_amount
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / incoming_usdt) * 100, 2), incoming_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '5'),
+        ('operation_name', 'Обменять сумму в USDT на конкретную сумму THB'),
+        ('direction', 'target'),
+        ('scenario', 'USDT → THB'),
+        ('thb_target', thb_target),
+        ('withdrawal_fixed', 20),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_thb_direct * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('usdt_amount', usdt_amount),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_usdt_to_thb_amount(U, R, usdt_amount, target_profit):
+    er = excel_round_array
+    _, _, _, usdt_thb_direct, name = _broker_commissions(target_profit)
+    usdt_thb_rate_sell = U * (1 - usdt_thb_direct)
+    thb_to_exchange = usdt_amount * usdt_thb_rate_sell
+    withdrawal_percent_fee = er(thb_to_exchange * 0.0025, 2)
+    thb_to_receive = er(thb_to_exchange - withdrawal_percent_fee - 20, 2)
+    final_rate = er(thb_to_receive / usdt_amount, 6)
+    incoming_usdt = usdt_amount
+    outgoing_usdt = er(thb_to_exchange / U, 2)
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / incoming_usdt) * 100, 2), incoming_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '6'),
+        ('operation_name', 'Обменять конкретную сумму в USDT на THB'),
+        ('direction', 'amount'),
+        ('scenario', 'USDT → THB'),
+        ('usdt_amount', usdt_amount),
+        ('usdt_thb_rate', U),
+        ('usdt_thb_commission', er(usdt_thb_direct * 100, 2)),
+        ('usdt_thb_rate_sell', er(usdt_thb_rate_sell, 2)),
+        ('thb_to_exchange', er(thb_to_exchange, 2)),
+        ('withdrawal_percent', withdrawal_percent_fee),
+        ('withdrawal_fixed', 20),
+        ('thb_received', thb_to_receive),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_rub_to_usdt_target(U, R, usdt_target, target_profit):
+    er = excel_round_array
+    rub_comm, _, _, _, name = _broker_commissions(target_profit)
+    usdt_before_commission = usdt_target + 1
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    rub_amount = er(usdt_before_commission * rub_usdt_rate_sell, 2)
+    final_rate = er(rub_amount / usdt_target, 6)
+    incoming_usdt = er(rub_amount / R, 2)
+    outgoing_usdt = usdt_before_commission
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / incoming_usdt) * 100, 2), incoming_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '7'),
+        ('operation_name', 'Обменять сумму в рублях на конкретную сумму USDT'),
+        ('direction', 'target'),
+        ('scenario', 'RUB → USDT'),
+        ('usdt_target', usdt_target),
+        ('withdrawal_commission', 1),
+        ('usdt_before_commission', usdt_before_commission),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', er(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', er(rub_usdt_rate_sell, 4)),
+        ('rub_amount', rub_amount),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+def _broker_rub_to_usdt_amount(U, R, rub_amount, target_profit):
+    er = excel_round_array
+    rub_comm, _, _, _, name = _broker_commissions(target_profit)
+    rub_usdt_rate_sell = R * (1 + rub_comm)
+    usdt_before_commission = rub_amount / rub_usdt_rate_sell
+    usdt_received = er(usdt_before_commission - 1, 2)
+    final_rate = er(rub_amount / usdt_received, 6)
+    incoming_usdt = er(rub_amount / R, 2)
+    outgoing_usdt = usdt_before_commission
+    profit_usdt = er(incoming_usdt - outgoing_usdt, 2)
+    profit_percent_actual = _guarded(er((profit_usdt / incoming_usdt) * 100, 2), incoming_usdt > 0)
+    columns = OrderedDict([
+        ('operation', '8'),
+        ('operation_name', 'Обменять конкретную сумму в рублях на USDT'),
+        ('direction', 'amount'),
+        ('scenario', 'RUB → USDT'),
+        ('rub_amount', rub_amount),
+        ('rub_usdt_rate', R),
+        ('rub_usdt_commission', er(rub_comm * 100, 2)),
+        ('rub_usdt_rate_sell', er(rub_usdt_rate_sell, 4)),
+        ('usdt_before_commission', er(usdt_before_commission, 2)),
+        ('withdrawal_commission', 1),
+        ('usdt_received', usdt_received),
+        ('final_rate', final_rate)
+    ])
+    return _broker_tail(columns, name, target_profit, incoming_usdt, outgoing_usdt, profit_usdt,
+                        profit_percent_actual)
+
+
+# (method, scenario, direction) -> векторная операция (ключи как в реестре operations.py)
+OPERATIONS = {
+    ('doverka', 'rub-to-thb', 'target'): _doverka_rub_to_thb_target,
+    ('doverka', 'rub-to-thb', 'amount'): _doverka_rub_to_thb,
+    ('doverka', 'thb-to-usdt', 'target'): _doverka_thb_to_usdt_target,
+    ('doverka', 'thb-to-usdt', 'amount'): _doverka_thb_to_usdt,
+    ('doverka', 'usdt-to-thb', 'target'): _doverka_usdt_to_thb_target,
+    ('doverka', 'usdt-to-thb', 'amount'): _doverka_usdt_to_thb,
+    ('doverka', 'rub-to-usdt', 'target'): _doverka_rub_to_usdt_target,
+    ('doverka', 'rub-to-usdt', 'amount'): _doverka_rub_to_usdt_amount,
+    ('broker', 'rub-to-thb', 'target'): _broker_rub_to_thb_target,
+    ('broker', 'rub-to-thb', 'amount'): _broker_rub_to_thb_amount,
+    ('broker', 'thb-to-usdt', 'target'): _broker_thb_to_usdt_target,
+    ('broker', 'thb-to-usdt', 'amount'): _broker_thb_to_usdt_amount,
+    ('broker', 'usdt-to-thb', 'target'): _broker_usdt_to_thb_target,
+    ('broker', 'usdt-to-thb', 'amount'): _broker_usdt_to_thb_amount,
+    ('broker', 'rub-to-usdt', 'target'): _broker_rub_to_usdt_target,
+    ('broker', 'rub-to-usdt', 'amount'): _broker_rub_to_usdt_amount,
+}
+
+
+# ==================== ПАКЕТ ====================
+
+# Поля запроса, которые могут быть списками по элементам пакета
+BATCH_FIELDS = ('amount', 'method', 'scenario', 'direction', 'profit_margin', 'custom_rub_usdt')
+
+
+def batch_size(data: dict) -> int:
+    """Размер пакета: самая длинная из списочных колонок (скаляры растягиваются на весь пакет)"""
+    return max([len(data[field]) for field in BATCH_FIELDS if isinstance(data.get(field), (list, tuple))] or [1])
+
+
+def _column(values, n: int, default):
+    """Скаляр или список длины n -> список длины n"""
+    if isinstance(values, (list, tuple)):
+        if len(values) != n:
+            raise ValueError(f"Expected {n} values, got {len(values)}")
+        return list(values)
+    return [default if values is None else values] * n
+
+
+def _to_float(value, default=float('nan')) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _evaluate(op, usdt_thb: float, rub_usdt, amounts: np.ndarray, margins: np.ndarray):
+    """Выполнить операцию над группой: (колонки-списки, маска int 0 по колонкам, маска ошибок)"""
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        columns = op(usdt_thb, rub_usdt, amounts, margins)
+    n = len(amounts)
+    failed = np.zeros(n, dtype=bool)
+    int_zero = {}
+    for key, value in columns.items():
+        if isinstance(value, tuple):
+            value, int_zero[key] = value
+            columns[key] = value
+        if isinstance(value, np.ndarray) and value.dtype.kind == 'f':
+            # Скалярный код упал бы на делении на ноль или округлении inf/nan
+            failed |= ~np.isfinite(value)
+    return columns, int_zero, failed
+
+
+def calculate_batch(data: dict, usdt_thb: float, rub_usdt: float, columnar: bool = False) -> list:
+    """
+    Пакетный расчёт
+
+    Args:
+        data: Поля как у /api/calculate (method, scenario, direction, amount, profit_margin,
+              custom_rub_usdt); каждое - скаляр для всего пакета или список по элементам
+        usdt_thb: Курс USDT-THB из снапшота
+        rub_usdt: Курс RUB-USDT из снапшота (для Doverka)
+        columnar: Вернуть колонки вместо списка результатов
+
+    Returns:
+        list: Результат по каждому элементу (как у /api/calculate) или {'error': ...};
+              при columnar=True - dict {поле: список значений} + 'error'
+    """
+    n = batch_size(data)
+    amounts_raw = _column(data.get('amount'), n, None)
+    methods = _column(data.get('method'), n, 'doverka')
+    scenarios = _column(data.get('scenario'), n, 'rub-to-thb')
+    directions = _column(data.get('direction'), n, 'amount')
+    margins_raw = _column(data.get('profit_margin'), n, None)
+    custom_raw = _column(data.get('custom_rub_usdt'), n, 80.9)
+
+    amounts = np.array([_to_float(a) for a in amounts_raw], dtype=np.float64)
+    errors = [None] * n
+    groups = {}
+    for i in range(n):
+        method = 'broker' if methods[i] == 'broker' else 'doverka'
+        if not amounts[i] > 0:
+            errors[i] = 'Invalid amount'
+            continue
+        key = (method, scenarios[i], 'target' if directions[i] == 'target' else 'amount')
+        if key not in OPERATIONS:
+            errors[i] = 'Invalid scenario'
+            continue
+        groups.setdefault(key, []).append(i)
+
+    results = [None] * n
+    out_columns = OrderedDict()
+    for key, indices in groups.items():
+        idx = np.array(indices)
+        if key[0] == 'broker':
+            margins = np.array([_to_float(margins_raw[i], 4.0) if margins_raw[i] is not None else 4.0
+                                for i in indices])
+            rates = np.array([_to_float(custom_raw[i], 80.9) for i in indices])
+        else:
+            # Как в /api/calculate: пустая или нулевая маржа - стандартные уровни
+            margins = np.array([_to_float(margins_raw[i]) if margins_raw[i] else np.nan for i in indices])
+            rates = rub_usdt
+        columns, int_zero, failed = _evaluate(OPERATIONS[key], usdt_thb, rates, amounts[idx], margins)
+
+        lists = OrderedDict()
+        for name, value in columns.items():
+            if isinstance(value, np.ndarray):
+                value = value.tolist()
+            elif not isinstance(value, list):
+                value = [value] * len(indices)
+            zero = int_zero.get(name)
+            if zero is not None:
+                for j in np.flatnonzero(zero):
+                    value[j] = 0
+            lists[name] = value
+
+        for j, i in enumerate(indices):
+            if failed[j]:
+                errors[i] = 'Calculation error'
+        if columnar:
+            for name, value in lists.items():
+                column = out_columns.setdefault(name, [None] * n)
+                for j, i in enumerate(indices):
+                    if not failed[j]:
+                        column[i] = value[j]
+        else:
+            names = list(lists)
+            for j, row in enumerate(zip(*lists.values())):
+                if not failed[j]:
+                    results[indices[j]] = dict(zip(names, row))
+
+    if columnar:
+        out_columns['error'] = errors
+        return out_columns
+    return [result if result is not None else {'error': errors[i]} for i, result in enumerate(results)]
+
+
+if __name__ == '__main__':
+    # Сверка с скалярными калькуляторами на случайных суммах
+    import random
+    import time
+
+    rnd = random.Random(42)
+    usdt_thb, rub_usdt = 31.12, 80.90
+    calc = ExchangeCalculator(usdt_thb, rub_usdt)
+    doverka_methods = {
+        ('rub-to-thb', True): calc.rub_to_thb_target, ('rub-to-thb', False): calc.rub_to_thb,
+        ('thb-to-usdt', True): calc.thb_to_usdt_target, ('thb-to-usdt', False): calc.thb_to_usdt,
+        ('usdt-to-thb', True): calc.usdt_to_thb_target, ('usdt-to-thb', False): calc.usdt_to_thb,
+        ('rub-to-usdt', True): calc.rub_to_usdt_target, ('rub-to-usdt', False): calc.rub_to_usdt_amount,
+    }
+    broker_methods = {
+        ('rub-to-thb', True): 'rub_to_thb_target', ('rub-to-thb', False): 'rub_to_thb_amount',
+        ('thb-to-usdt', True): 'thb_to_usdt_target', ('thb-to-usdt', False): 'thb_to_usdt_amount',
+        ('usdt-to-thb', True): 'usdt_to_thb_target', ('usdt-to-thb', False): 'usdt_to_thb_amount',
+        ('rub-to-usdt', True): 'rub_to_usdt_target', ('rub-to-usdt', False): 'rub_to_usdt_amount',
+    }
+
+    n = 20000
+    data = {
+        'method': [rnd.choice(['doverka', 'broker']) for _ in range(n)],
+        'scenario': [rnd.choice(SCENARIOS) for _ in range(n)],
+        'direction': [rnd.choice(['amount', 'target']) for _ in range(n)],
+        'amount': [rnd.choice([round(rnd.uniform(1, 3_000_000), rnd.randint(0, 2)), rnd.randint(1, 100)])
+                   for _ in range(n)],
+        'profit_margin': [rnd.choice([None, 1.5, 2.0, 2.5, 3.0, 3.7, 4.0, 5.0, 6.0, 1.0]) for _ in range(n)],
+        'custom_rub_usdt': [rnd.choice([80.9, 81.25, 79.5]) for _ in range(n)],
+    }
+    started = time.perf_counter()
+    batch = calculate_batch(data, usdt_thb, rub_usdt)
+    elapsed = time.perf_counter() - started
+
+    mismatches = 0
+    for i in range(n):
+        method, scenario = data['method'][i], data['scenario'][i]
+        key = (scenario, data['direction'][i] == 'target')
+        amount = float(data['amount'][i])
+        try:
+            if method == 'broker':
+                margin = data['profit_margin'][i] if data['profit_margin'][i] is not None else 4.0
+                broker = BrokerCalculatorDetailed(usdt_thb, data['custom_rub_usdt'][i], margin)
+                expected = getattr(broker, broker_methods[key])(amount)
+            else:
+                expected = doverka_methods[key](amount, custom_profit_margin=data['profit_margin'][i])
+        except Exception:
+            expected = {'error': 'Calculation error'}
+        if batch[i] != expected or list(map(type, batch[i].values())) != list(map(type, expected.values())):
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"❌ #{i}: {expected} != {batch[i]}")
+
+    print(f"Batch of {n}: {elapsed * 1000:.1f} ms, mismatches: {mismatches}")
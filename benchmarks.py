@@ -0,0 +1,309 @@
+"""
+Микробенчмарки калькуляторов с порогом регрессии
+Замеряет все публичные методы ExchangeCalculator, BrokerCalculator, BrokerCalculatorDetailed,
+excel_round и view /api/calculate (через Flask test client), сравнивает с JSON-базой.
+С кассетой (cassettes.py) - ещё загрузку курсов, /api/transactions/incoming и /api/wallets
+на одних и тех же записанных ответах апстримов, без сети.
+
+    python benchmarks.py --save              # записать базу
+    python benchmarks.py                     # сравнить с базой, код 1 при регрессии
+    python benchmarks.py --filter broker --threshold 0.1
+    python benchmarks.py --record-cassette cassettes/bench.json.gz --wallets TXyz...,TAbc...
+    python benchmarks.py --cassette cassettes/bench.json.gz --filter upstream
+"""
+
+import argparse
+import inspect
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+from broker_detailed import BrokerCalculatorDetailed
+from calculator import BrokerCalculator, ExchangeCalculator
+from cassettes import Cassette, install as install_cassette, uninstall as uninstall_cassette
+from money import excel_round, excel_round_array, excel_round_decimal
+
+BASELINE_PATH = os.getenv('BENCHMARK_BASELINE', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                              'benchmark_baseline.json'))
+# Допустимое замедление относительно базы (0.25 = на 25%)
+THRESHOLD = float(os.getenv('BENCHMARK_THRESHOLD', 0.25))
+# Минимальная длительность одного замера и число повторов (берётся лучший)
+MIN_TIME = 0.05
+REPEAT = 5
+# Сколько раз перемерить замеры, превысившие порог, прежде чем считать их регрессией
+CONFIRM_RUNS = 2
+
+USDT_THB, RUB_USDT, CUSTOM_RUB_USDT = 35.2, 86.5, 80.9
+# Сумма по имени первого аргумента метода: rub_amount, thb_target, usdt_amount...
+AMOUNTS = {'rub': 100_000, 'thb': 150_000, 'usdt': 3_000}
+
+
+def _amount(func) -> float:
+    first = list(inspect.signature(func).parameters)[1]
+    return AMOUNTS[first.split('_')[0]]
+
+
+def _public_methods(cls) -> list:
+    """Публичные методы класса в порядке объявления"""
+    return [name for name, member in cls.__dict__.items()
+            if not name.startswith('_') and (inspect.isfunction(member) or isinstance(member, (staticmethod, classmethod)))]
+
+
+def calculator_cases() -> list:
+    """[(имя, функция без аргументов)] для калькуляторов и округления"""
+    doverka = ExchangeCalculator(USDT_THB, RUB_USDT)
+    broker = BrokerCalculator(USDT_THB, CUSTOM_RUB_USDT)
+    detailed = BrokerCalculatorDetailed(USDT_THB, CUSTOM_RUB_USDT, 4.0)
+    cases = [
+        ('ExchangeCalculator.__init__', lambda: ExchangeCalculator(USDT_THB, RUB_USDT)),
+        ('BrokerCalculator.__init__', lambda: BrokerCalculator(USDT_THB, CUSTOM_RUB_USDT)),
+        ('BrokerCalculatorDetailed.__init__', lambda: BrokerCalculatorDetailed(USDT_THB, CUSTOM_RUB_USDT, 3.7)),
+    ]
+    for name in _public_methods(ExchangeCalculator):
+        method = getattr(doverka, name)
+        amount = _amount(getattr(ExchangeCalculator, name))
+        cases.append((f'ExchangeCalculator.{name}', lambda m=method, a=amount: m(a)))
+        cases.append((f'ExchangeCalculator.{name}[margin]', lambda m=method, a=amount: m(a, custom_profit_margin=2.7)))
+    for name in _public_methods(BrokerCalculator):
+        method = getattr(broker, name)
+        cases.append((f'BrokerCalculator.{name}', lambda m=method, a=_amount(method.__func__): m(a)))
+    for name in _public_methods(BrokerCalculatorDetailed):
+        if name in ('commissions', 'default_commissions'):
+            # Пресет и интерполяция между пресетами
+            method = getattr(BrokerCalculatorDetailed, name)
+            cases.append((f'BrokerCalculatorDetailed.{name}[preset]', lambda m=method: m(4.0)))
+            cases.append((f'BrokerCalculatorDetailed.{name}[custom]', lambda m=method: m(3.7)))
+            continue
+        method = getattr(detailed, name)
+        cases.append((f'BrokerCalculatorDetailed.{name}', lambda m=method, a=_amount(method.__func__): m(a)))
+
+    values = np.random.default_rng(1).uniform(0, 10 ** 6, 10_000)
+    cases += [
+        ('excel_round[fast]', lambda: excel_round(12345.678, 2)),
+        ('excel_round[tie]', lambda: excel_round(2.675, 2)),
+        ('excel_round_decimal', lambda: excel_round_decimal(12345.678, 2)),
+        ('excel_round_array[10k]', lambda: excel_round_array(values, 2)),
+    ]
+    return cases
+
+
+# Запросы к /api/calculate: Doverka и брокер, оба направления
+API_PAYLOADS = [
+    {'method': 'doverka', 'scenario': 'rub-to-thb', 'direction': 'amount', 'amount': 100_000},
+    {'method': 'doverka', 'scenario': 'usdt-to-thb', 'direction': 'target', 'amount': 150_000},
+    {'method': 'broker', 'scenario': 'rub-to-thb', 'direction': 'amount', 'amount': 100_000,
+     'custom_rub_usdt': CUSTOM_RUB_USDT, 'profit_margin': 4.0},
+    {'method': 'broker', 'scenario': 'thb-to-usdt', 'direction': 'target', 'amount': 3_000,
+     'custom_rub_usdt': CUSTOM_RUB_USDT, 'profit_margin': 3.7},
+]
+
+
+def _api_name(payload: dict) -> str:
+    return f"api.calculate[{payload['method']}/{payload['scenario']}/{payload['direction']}]"
+
+
+def _app():
+    """Приложение на временной базе и кэше (чтобы кошельки прошлых прогонов не попадали в замеры)"""
+    if 'app' in sys.modules:
+        return sys.modules['app']
+    workdir = tempfile.mkdtemp(prefix='calccrm_bench_')
+    # Всегда временные: бенчмарк пишет кошельки в /api/wallets, экспортированная рабочая база не должна пострадать
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    os.environ['SHARED_CACHE_PATH'] = os.path.join(workdir, 'shared_cache.db')
+    os.environ.setdefault('RATES_FETCH_TIMEOUT', '1')
+    os.environ.setdefault('TRONSCAN_RATE', 'off')
+    # api.calculate меряет расчёт, а не попадания в кэш ответов (один и тот же payload в цикле)
+    os.environ.setdefault('CALC_CACHE_SIZE', '0')
+    import app as app_module
+    return app_module
+
+
+def api_cases(name_filter: str = None) -> list:
+    """[(имя, функция)] для /api/calculate через test client; app импортируется, только если есть что мерить"""
+    payloads = [p for p in API_PAYLOADS if not name_filter or name_filter in _api_name(p)]
+    if not payloads:
+        return []
+    client = _app().app.test_client()
+    cases = []
+    for payload in payloads:
+        response = client.post('/api/calculate', json=payload)
+        if response.status_code != 200:
+            raise RuntimeError(f"/api/calculate {payload}: {response.status_code} {response.get_json()}")
+        cases.append((_api_name(payload), lambda p=payload: client.post('/api/calculate', json=p)))
+    return cases
+
+
+UPSTREAM_CASES = ('upstream.get_all_rates', 'upstream.api.transactions.incoming', 'upstream.api.wallets')
+
+
+def upstream_cases(wallets: list, name_filter: str = None) -> list:
+    """
+    [(имя, функция)] для путей с внешними API: загрузка курсов, входящие транзакции и кошельки
+    с обходом кэша. Запускать под кассетой, иначе замеряется сеть.
+    """
+    names = [name for name in UPSTREAM_CASES if not name_filter or name_filter in name]
+    if not names:
+        return []
+    app_module = _app()
+    from async_runtime import run_sync
+    from calculator import ExchangeRateProvider
+
+    client = app_module.app.test_client()
+    for address in wallets:
+        client.post('/api/wallets', json={'address': address, 'label': 'bench', 'is_monitored': True})
+    funcs = {
+        'upstream.get_all_rates': lambda: run_sync(ExchangeRateProvider.get_all_rates(), timeout=30),
+        'upstream.api.transactions.incoming': lambda: client.get('/api/transactions/incoming?force_refresh=true'),
+        'upstream.api.wallets': lambda: client.get('/api/wallets?force_refresh=true'),
+    }
+    return [(name, funcs[name]) for name in names]
+
+
+def measure(func, min_time: float = MIN_TIME, repeat: int = REPEAT) -> dict:
+    """Как timeit: подбираем число вызовов под min_time, берём лучший из repeat замеров"""
+    loops = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_time:
+            break
+        loops *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(loops):
+            func()
+        best = min(best, time.perf_counter() - started)
+    return {'ns_per_call': round(best / loops * 1e9, 1), 'loops': loops, 'repeat': repeat}
+
+
+def load_baseline(path: str) -> dict:
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baseline(path: str, results: dict, previous: dict = None):
+    """Записывает базу; при частичном прогоне (--filter) остальные записи сохраняются"""
+    merged = dict(previous['results']) if previous else {}
+    merged.update(results)
+    data = {
+        'meta': {
+            'created_at': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'machine': platform.machine()
+        },
+        'results': dict(sorted(merged.items()))
+    }
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2, ensure_ascii=False)
+        f.write('\n')
+
+
+def slowdown(current: dict, base: dict) -> float:
+    """Относительное замедление: 0.3 = на 30% медленнее базы"""
+    return current['ns_per_call'] / base['ns_per_call'] - 1
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """Имена замеров, которые медленнее базы больше чем на threshold"""
+    return [name for name, current in results.items()
+            if name in baseline['results'] and slowdown(current, baseline['results'][name]) > threshold]
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Calculator micro-benchmarks')
+    parser.add_argument('--save', action='store_true', help='write results as the new baseline')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline JSON path')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='allowed slowdown (0.25 = 25%%)')
+    parser.add_argument('--filter', default=None, help='run only benchmarks whose name contains this substring')
+    parser.add_argument('--min-time', type=float, default=MIN_TIME, help='seconds per measurement')
+    parser.add_argument('--no-api', action='store_true', help='skip /api/calculate benchmarks')
+    parser.add_argument('--cassette', default=None, help='replay upstream responses from this cassette')
+    parser.add_argument('--cassette-timing', type=float, default=0.0,
+                        help='replay latency multiplier (0 = instant, 1 = as recorded)')
+    parser.add_argument('--record-cassette', default=None, help='call real upstreams once and record a cassette')
+    parser.add_argument('--wallets', default='', help='comma-separated wallet addresses for --record-cassette')
+    args = parser.parse_args(argv)
+
+    if args.record_cassette:
+        cassette = install_cassette(Cassette(args.record_cassette, 'record'))
+        cassette.meta['wallets'] = [w.strip() for w in args.wallets.split(',') if w.strip()]
+        for name, func in upstream_cases(cassette.meta['wallets'], args.filter):
+            func()
+        uninstall_cassette()
+        print(f"📼 Recorded {cassette.stats['recorded']} responses to {args.record_cassette}")
+        return 0
+
+    cases = [(name, func) for name, func in calculator_cases() if not args.filter or args.filter in name]
+    if not args.no_api:
+        cases += api_cases(args.filter)
+    cassette = None
+    if args.cassette:
+        cassette = install_cassette(Cassette(args.cassette, 'replay', args.cassette_timing))
+        cases += upstream_cases(cassette.meta.get('wallets', []), args.filter)
+    if not cases:
+        print(f"❌ Нет бенчмарков по фильтру '{args.filter}'")
+        return 2
+
+    print(f"⏱️  {len(cases)} benchmarks, min_time={args.min_time}s, repeat={REPEAT}")
+    results = {}
+    for name, func in cases:
+        func()  # прогрев
+        results[name] = measure(func, args.min_time)
+    if cassette is not None and cassette.stats['misses']:
+        print(f"⚠️  {cassette.stats['misses']} requests were not in the cassette, upstream timings are not reproducible")
+
+    baseline = load_baseline(args.baseline)
+    if args.save:
+        save_baseline(args.baseline, results, baseline)
+        for name, result in results.items():
+            print(f"   {name}: {result['ns_per_call']:,.0f} ns")
+        print(f"💾 Baseline saved to {args.baseline}")
+        return 0
+    if baseline is None:
+        for name, result in results.items():
+            print(f"   {name}: {result['ns_per_call']:,.0f} ns")
+        print(f"⚠️  No baseline at {args.baseline}, run with --save first")
+        return 2
+
+    meta = baseline.get('meta', {})
+    if meta.get('platform') != platform.platform() or meta.get('python') != platform.python_version():
+        print(f"⚠️  Baseline recorded on {meta.get('platform')} / Python {meta.get('python')}, numbers may not compare")
+    regressions = compare(results, baseline, args.threshold)
+    for _ in range(CONFIRM_RUNS):
+        # Шум планировщика даёт одиночные выбросы - подозрительные замеры перемеряем и берём лучший
+        funcs = dict(cases)
+        for name in regressions:
+            again = measure(funcs[name], args.min_time)
+            if again['ns_per_call'] < results[name]['ns_per_call']:
+                results[name] = again
+        regressions = compare(results, baseline, args.threshold)
+
+    for name, current in results.items():
+        base = baseline['results'].get(name)
+        if base is None:
+            print(f"   🆕 {name}: {current['ns_per_call']:,.0f} ns (нет в базе)")
+            continue
+        print(f"   {'❌' if name in regressions else '✅'} {name}: {current['ns_per_call']:,.0f} ns "
+              f"vs {base['ns_per_call']:,.0f} ns ({slowdown(current, base) * 100:+.1f}%)")
+    if regressions:
+        print(f"❌ {len(regressions)} regressions over {args.threshold * 100:g}%: {', '.join(regressions)}")
+        return 1
+    print(f"✅ No regressions over {args.threshold * 100:g}%")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
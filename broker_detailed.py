@@ -1,23 +1,43 @@
 """
 Детальный калькулятор для брокера с полной информацией как в CSV
 """
-from decimal import Decimal, ROUND_HALF_UP
-
-def excel_round(value, decimals=2):
-    """
-    Округление как в Excel (коммерческое округление)
-    0.5 всегда округляется вверх
-    """
-    d = Decimal(str(value))
-    if decimals == 0:
-        return float(d.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
-    else:
-        places = Decimal(10) ** -decimals
-        return float(d.quantize(places, rounding=ROUND_HALF_UP))
+from money import excel_round
+from pricing import thb_payout_leg
 
 class BrokerCalculatorDetailed:
     """Калькулятор брокера с детальными результатами и динамической прибылью"""
     
+    # Точные значения из CSV для основных уровней прибыли:
+    # прибыль % -> (rub_comm, usdt_comm, thb_usdt_comm, usdt_thb_direct)
+    PRESETS = {
+        5.0: (0.0256, 0.0257, 0.0525, 0.0500),
+        4.0: (0.0205, 0.0204, 0.0416, 0.0400),
+        3.0: (0.0155, 0.0150, 0.0308, 0.0300),
+        1.5: (0.0075, 0.0076, 0.0151, 0.0150),
+    }
+    # Насколько прибыль может отличаться от уровня CSV, чтобы взять его значения
+    PRESET_TOLERANCE = 0.1
+    
+    @staticmethod
+    def default_commissions(target_profit: float) -> tuple:
+        """
+        Общая формула для промежуточных значений (например, 2.5%, 3.5%)
+        Распределяем прибыль примерно пополам между двумя этапами
+        """
+        rub_comm = (target_profit / 100.0) / 2.0
+        usdt_comm = rub_comm
+        thb_usdt_comm = (target_profit / 100.0) * 1.025
+        usdt_thb_direct = target_profit / 100.0
+        return rub_comm, usdt_comm, thb_usdt_comm, usdt_thb_direct
+    
+    @classmethod
+    def commissions(cls, target_profit: float) -> tuple:
+        """Комиссии этапов: значения из CSV для основных уровней, для остальных - пропорционально"""
+        for level, values in cls.PRESETS.items():
+            if abs(target_profit - level) < cls.PRESET_TOLERANCE:
+                return values
+        return cls.default_commissions(target_profit)
+    
     def __init__(self, usdt_thb_rate: float, custom_rub_usdt_rate: float, target_profit: float = 4.0):
         """
         Args:
@@ -30,38 +50,17 @@ class BrokerCalculatorDetailed:
         self.target_profit = target_profit
         
         # Расчет комиссий для этапов на основе целевой прибыли (как в CSV)
-        # Мы используем точные значения из CSV для основных шагов, 
-        # а для остальных рассчитываем пропорционально.
-        
-        if abs(target_profit - 5.0) < 0.1:
-            self.rub_comm = 0.0256
-            self.usdt_comm = 0.0257
-            self.thb_usdt_comm = 0.0525
-            self.usdt_thb_direct = 0.0500
-        elif abs(target_profit - 4.0) < 0.1:
-            self.rub_comm = 0.0205
-            self.usdt_comm = 0.0204
-            self.thb_usdt_comm = 0.0416
-            self.usdt_thb_direct = 0.0400
-        elif abs(target_profit - 3.0) < 0.1:
-            self.rub_comm = 0.0155
-            self.usdt_comm = 0.0150
-            self.thb_usdt_comm = 0.0308
-            self.usdt_thb_direct = 0.0300
-        elif abs(target_profit - 1.5) < 0.1:
-            self.rub_comm = 0.0075
-            self.usdt_comm = 0.0076
-            self.thb_usdt_comm = 0.0151
-            self.usdt_thb_direct = 0.0150
-        else:
-            # Общая формула для промежуточных значений (например, 2.5%, 3.5%)
-            # Распределяем прибыль примерно пополам между двумя этапами
-            self.rub_comm = (target_profit / 100.0) / 2.0
-            self.usdt_comm = self.rub_comm
-            self.thb_usdt_comm = (target_profit / 100.0) * 1.025
-            self.usdt_thb_direct = target_profit / 100.0
-            
+        self.rub_comm, self.usdt_comm, self.thb_usdt_comm, self.usdt_thb_direct = self.commissions(target_profit)
+        
         self.commission_name = f"Брокер ({target_profit}%)"
+        
+        # Курсы продажи зависят только от курсов и маржи - считаем один раз на калькулятор
+        self.rub_sell_rate = self.rub_usdt_rate * (1 + self.rub_comm)
+        self.rub_sell_rate_amount = self.rub_usdt_rate * (1 + self.usdt_comm)
+        self.usdt_thb_sell_rate = self.usdt_thb_rate * (1 - self.usdt_comm)
+        self.usdt_thb_sell_rate_amount = self.usdt_thb_rate * (1 - self.rub_comm)
+        self.thb_usdt_sell_rate = self.usdt_thb_rate * (1 + self.thb_usdt_comm)
+        self.usdt_thb_direct_sell_rate = self.usdt_thb_rate * (1 - self.usdt_thb_direct)
 
     def rub_to_thb_target(self, thb_target: float) -> dict:
         """
@@ -70,17 +69,16 @@ class BrokerCalculatorDetailed:
         """
         # Комиссии за выдачу
         withdrawal_fixed = 20
-        thb_to_exchange = (thb_target + withdrawal_fixed) / (1 - 0.0025)
+        thb_to_exchange, withdrawal_percent_fee = thb_payout_leg(thb_target)
         thb_to_exchange_display = excel_round(thb_to_exchange, 2)
-        withdrawal_percent_fee = excel_round(thb_to_exchange - thb_target - withdrawal_fixed, 2)
         
         # Курс продажи USDT-THB
-        usdt_thb_rate_sell = self.usdt_thb_rate * (1 - self.usdt_comm)
+        usdt_thb_rate_sell = self.usdt_thb_sell_rate
         usdt_amount = thb_to_exchange / usdt_thb_rate_sell
         usdt_amount_display = excel_round(usdt_amount, 2)
         
         # Курс продажи RUB-USDT
-        rub_usdt_rate_sell = self.rub_usdt_rate * (1 + self.rub_comm)
+        rub_usdt_rate_sell = self.rub_sell_rate
         rub_amount = excel_round(usdt_amount * rub_usdt_rate_sell, 2)
         
         final_rate = excel_round(rub_amount / thb_target, 6)
@@ -124,11 +122,11 @@ class BrokerCalculatorDetailed:
         Соответствует операциям 2.1-2.3 в CSV
         """
         # Для amount комиссии переставлены местами в CSV!
-        rub_usdt_rate_sell = self.rub_usdt_rate * (1 + self.usdt_comm)
+        rub_usdt_rate_sell = self.rub_sell_rate_amount
         usdt_amount = rub_amount / rub_usdt_rate_sell
         usdt_amount_display = excel_round(usdt_amount, 2)
         
-        usdt_thb_rate_sell = self.usdt_thb_rate * (1 - self.rub_comm)
+        usdt_thb_rate_sell = self.usdt_thb_sell_rate_amount
         thb_to_exchange = usdt_amount * usdt_thb_rate_sell
         thb_to_exchange_display = excel_round(thb_to_exchange, 2)
         
@@ -176,7 +174,7 @@ class BrokerCalculatorDetailed:
         withdrawal_commission = 1
         usdt_before_commission = usdt_target + withdrawal_commission
         
-        usdt_thb_rate_sell = self.usdt_thb_rate * (1 + self.thb_usdt_comm)
+        usdt_thb_rate_sell = self.thb_usdt_sell_rate
         thb_amount = excel_round(usdt_before_commission * usdt_thb_rate_sell, 2)
         
         final_rate = excel_round(thb_amount / usdt_target, 6)
@@ -211,7 +209,7 @@ class BrokerCalculatorDetailed:
         """
         Операция 4: THB → USDT (клиент вносит конкретную сумму THB)
         """
-        usdt_thb_rate_sell = self.usdt_thb_rate * (1 + self.thb_usdt_comm)
+        usdt_thb_rate_sell = self.thb_usdt_sell_rate
         usdt_before_commission = thb_amount / usdt_thb_rate_sell
         usdt_before_commission_display = excel_round(usdt_before_commission, 2)
         
@@ -251,11 +249,10 @@ class BrokerCalculatorDetailed:
         Операция 5: USDT → THB (клиент хочет получить конкретную сумму THB)
         """
         withdrawal_fixed = 20
-        thb_to_exchange = (thb_target + withdrawal_fixed) / (1 - 0.0025)
+        thb_to_exchange, withdrawal_percent_fee = thb_payout_leg(thb_target)
         thb_to_exchange_display = excel_round(thb_to_exchange, 2)
-        withdrawal_percent_fee = excel_round(thb_to_exchange - thb_target - withdrawal_fixed, 2)
         
-        usdt_thb_rate_sell = self.usdt_thb_rate * (1 - self.usdt_thb_direct)
+        usdt_thb_rate_sell = self.usdt_thb_direct_sell_rate
         usdt_amount = excel_round(thb_to_exchange / usdt_thb_rate_sell, 2)
         
         final_rate = excel_round(thb_target / usdt_amount, 6)
@@ -291,7 +288,7 @@ class BrokerCalculatorDetailed:
         """
         Операция 6: USDT → THB (клиент вносит конкретную сумму USDT)
         """
-        usdt_thb_rate_sell = self.usdt_thb_rate * (1 - self.usdt_thb_direct)
+        usdt_thb_rate_sell = self.usdt_thb_direct_sell_rate
         thb_to_exchange = usdt_amount * usdt_thb_rate_sell
         thb_to_exchange_display = excel_round(thb_to_exchange, 2)
         
@@ -338,7 +335,7 @@ class BrokerCalculatorDetailed:
         
         # В CSV для 3% прибыли комиссия 1.55%, для 5% - 2.56%, для 4% - 2.05%
         # Мы используем self.rub_comm, который уже рассчитан в __init__
-        rub_usdt_rate_sell = self.rub_usdt_rate * (1 + self.rub_comm)
+        rub_usdt_rate_sell = self.rub_sell_rate
         rub_amount = excel_round(usdt_before_commission * rub_usdt_rate_sell, 2)
         
         final_rate = excel_round(rub_amount / usdt_target, 6)
@@ -374,7 +371,7 @@ class BrokerCalculatorDetailed:
         Операция 8: RUB → USDT (клиент вносит конкретную сумму RUB)
         Соответствует операциям 2.1-2.4 (второй сет) в CSV
         """
-        rub_usdt_rate_sell = self.rub_usdt_rate * (1 + self.rub_comm)
+        rub_usdt_rate_sell = self.rub_sell_rate
         usdt_before_commission = rub_amount / rub_usdt_rate_sell
         usdt_before_commission_display = excel_round(usdt_before_commission, 2)
         
@@ -413,7 +410,7 @@ class BrokerCalculatorDetailed:
 
 # Тестирование
 if __name__ == '__main__':
-    calc = BrokerCalculatorDetailed(usdt_thb_rate=31.12, custom_rub_usdt_rate=80.90, commission_level='high')
+    calc = BrokerCalculatorDetailed(usdt_thb_rate=31.12, custom_rub_usdt_rate=80.90, target_profit=5.0)
     
     print("Операция 2.1: RUB → THB (amount, 5%)")
     result = calc.rub_to_thb_amount(2741.18)
@@ -4,10 +4,12 @@ Exchange Calculator Bot - Калькулятор обмена RUB-THB
 """
 
 import aiohttp
+import asyncio
 import os
+import time
+from contextlib import asynccontextmanager
 from typing import Dict, Tuple
 from dotenv import load_dotenv
-from decimal import Decimal, ROUND_HALF_UP
 
 # Загружаем переменные окружения
 def load_env():
@@ -31,18 +33,18 @@ def load_env():
 
 load_env()
 
-# Функция округления как в Excel
-def excel_round(value, decimals=2):
-    """
-    Округление как в Excel (коммерческое округление)
-    0.5 всегда округляется вверх
-    """
-    d = Decimal(str(value))
-    if decimals == 0:
-        return float(d.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
-    else:
-        places = Decimal(10) ** -decimals
-        return float(d.quantize(places, rounding=ROUND_HALF_UP))
+def env_seconds(name: str, default: float = None):
+    """Интервал в секундах из переменной окружения ('off' или пусто - выключено)"""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    if value.strip().lower() in ('', 'off', 'none'):
+        return None
+    return float(value)
+
+# Округление как в Excel - общее для всех калькуляторов
+from money import excel_round
+from pricing import PricingStore, PricingTables, thb_payout_leg
 
 # Импорт детального калькулятора брокера
 try:
@@ -53,12 +55,16 @@ except ImportError:
     sys.path.insert(0, os.path.dirname(__file__))
     from broker_detailed import BrokerCalculatorDetailed
 
+from async_runtime import runtime
+
 
 class ExchangeRateProvider:
     """Провайдер курсов валют"""
     
-    BINANCE_API = "https://api.binance.th/api/v1"
-    DOVERKA_API = "https://api.doverkapay.com"
+    # Базовые адреса переопределяются через окружение (локальные заглушки, см. fake_upstreams.py)
+    BINANCE_API = os.getenv('BINANCE_API_URL', "https://api.binance.th/api/v1").rstrip('/')
+    BINANCE_GLOBAL_API = os.getenv('BINANCE_GLOBAL_API_URL', "https://api.binance.com/api/v3").rstrip('/')
+    DOVERKA_API = os.getenv('DOVERKA_API_URL', "https://api.doverkapay.com").rstrip('/')
     
     # API ключи из переменных окружения
     BINANCE_API_KEY = os.getenv('BINANCE_API_KEY', '')
@@ -71,14 +77,31 @@ class ExchangeRateProvider:
     # Альтернативные источники для RUB-USDT, если Doverka API не работает
     FALLBACK_RUB_USDT = 92.50  # Фоллбэк курс (обновлен 20.01.2026)
     
+    # Через сколько секунд без ответа от Binance TH параллельно спрашивать Binance Global
+    # (BINANCE_HEDGE_DELAY=off - только последовательный фоллбэк)
+    BINANCE_HEDGE_DELAY = env_seconds('BINANCE_HEDGE_DELAY', 1.5)
+    
+    # Время ответа и счётчики по каждому источнику курсов
+    SOURCE_STATS = {}
+    
     @staticmethod
-    async def get_binance_rate(symbol: str = "USDTTHB") -> float:
+    @asynccontextmanager
+    async def _session(name: str):
         """
-        Получить курс от Binance (сначала TH, потом Global как фоллбэк)
+        HTTP-сессия для запроса: общая keep-alive сессия, если мы внутри loop рантайма,
+        иначе временная (например, при запуске через asyncio.run)
         """
-        # 1. Пробуем Binance Thailand
-        try:
+        if runtime.in_loop():
+            yield runtime.http_session(name)
+        else:
             async with aiohttp.ClientSession() as session:
+                yield session
+    
+    @staticmethod
+    async def _fetch_binance_th(symbol: str) -> float:
+        """Курс от Binance Thailand"""
+        try:
+            async with ExchangeRateProvider._session('binance') as session:
                 url = f"{ExchangeRateProvider.BINANCE_API}/ticker/price"
                 params = {"symbol": symbol}
                 headers = {}
@@ -104,11 +127,14 @@ class ExchangeRateProvider:
                                 return float(data["price"])
         except Exception as e:
             print(f"⚠️ Binance TH error: {e}")
-
-        # 2. Фоллбэк на Binance Global
+        return None
+    
+    @staticmethod
+    async def _fetch_binance_global(symbol: str) -> float:
+        """Курс от Binance Global (фоллбэк)"""
         try:
-            async with aiohttp.ClientSession() as session:
-                url = "https://api.binance.com/api/v3/ticker/price"
+            async with ExchangeRateProvider._session('binance_global') as session:
+                url = f"{ExchangeRateProvider.BINANCE_GLOBAL_API}/ticker/price"
                 params = {"symbol": "USDTTHB"}
                 async with session.get(url, params=params, timeout=5) as response:
                     if response.status == 200:
@@ -117,9 +143,65 @@ class ExchangeRateProvider:
                         return float(data['price'])
         except Exception as e:
             print(f"❌ Binance Global error: {e}")
-            
         return None
     
+    @staticmethod
+    async def _timed(source: str, coro):
+        """Выполнить запрос к источнику и записать время ответа в SOURCE_STATS"""
+        stats = ExchangeRateProvider.SOURCE_STATS.setdefault(
+            source, {'last_ms': None, 'ok': 0, 'failed': 0, 'cancelled': 0})
+        started = time.perf_counter()
+        try:
+            result = await coro
+        except asyncio.CancelledError:
+            stats['cancelled'] += 1
+            raise
+        stats['last_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        stats['ok' if result is not None else 'failed'] += 1
+        return result
+    
+    @staticmethod
+    async def _get_binance_rate_with_source(symbol: str = "USDTTHB") -> Tuple[float, str]:
+        """
+        Курс USDT-THB и источник, который его дал
+
+        Binance Global запускается сразу после отказа Thailand, а если задан
+        BINANCE_HEDGE_DELAY - ещё и параллельно, когда Thailand молчит дольше задержки.
+        Берём первый успешный ответ.
+        """
+        timed = ExchangeRateProvider._timed
+        th_task = asyncio.create_task(timed('binance_th', ExchangeRateProvider._fetch_binance_th(symbol)))
+        tasks = {th_task: 'binance_th'}
+        
+        hedge_delay = ExchangeRateProvider.BINANCE_HEDGE_DELAY
+        try:
+            await asyncio.wait({th_task}, timeout=hedge_delay)
+            if th_task.done() and th_task.result() is not None:
+                return th_task.result(), 'binance_th'
+            
+            global_task = asyncio.create_task(timed('binance_global', ExchangeRateProvider._fetch_binance_global(symbol)))
+            tasks[global_task] = 'binance_global'
+            pending = {task for task in tasks if not task.done()}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.result() is not None:
+                        return task.result(), tasks[task]
+        finally:
+            # В том числе при отмене снаружи (таймаут получения курсов) - запросы не должны висеть в фоне
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+        return None, None
+    
+    @staticmethod
+    async def get_binance_rate(symbol: str = "USDTTHB") -> float:
+        """
+        Получить курс от Binance (сначала TH, потом Global как фоллбэк)
+        """
+        rate, _ = await ExchangeRateProvider._get_binance_rate_with_source(symbol)
+        return rate
+    
     @staticmethod
     async def get_doverka_rate() -> float:
         """
@@ -130,7 +212,7 @@ class ExchangeRateProvider:
             return None
         
         try:
-            async with aiohttp.ClientSession() as session:
+            async with ExchangeRateProvider._session('doverka') as session:
                 url = f"{ExchangeRateProvider.DOVERKA_API}/v1/currencies"
                 headers = {
                     'Authorization': f'Bearer {ExchangeRateProvider.DOVERKA_API_KEY}',
@@ -170,20 +252,28 @@ class ExchangeRateProvider:
         Получить все необходимые курсы
         
         Returns:
-            dict: {"usdt_thb": float, "rub_usdt": float}
+            dict: {"usdt_thb": float, "rub_usdt": float, "sources": {...}}
         """
-        usdt_thb = await ExchangeRateProvider.get_binance_rate("USDTTHB")
-        rub_usdt = await ExchangeRateProvider.get_doverka_rate()
+        # Пары независимы - запрашиваем их параллельно
+        (usdt_thb, binance_source), rub_usdt = await asyncio.gather(
+            ExchangeRateProvider._get_binance_rate_with_source("USDTTHB"),
+            ExchangeRateProvider._timed('doverka', ExchangeRateProvider.get_doverka_rate())
+        )
         
         return {
             "usdt_thb": usdt_thb,
-            "rub_usdt": rub_usdt
+            "rub_usdt": rub_usdt,
+            "sources": {
+                "usdt_thb": binance_source,
+                "rub_usdt": 'doverka' if rub_usdt else None
+            }
         }
 
 
 class CommissionCalculator:
     """Расчет комиссий по уровням сумм"""
     
+    # Уровни по умолчанию; актуальные таблицы - в pricing_store
     LEVELS = {
         'до_500к': {
             'min': 0,
@@ -228,58 +318,46 @@ class CommissionCalculator:
         Returns:
             tuple: (название_уровня, параметры_комиссий)
         """
-        for level_name, params in CommissionCalculator.LEVELS.items():
-            if params['min'] <= rub_amount < params['max']:
-                return level_name, params
-        
-        # По умолчанию - последний уровень
-        return 'от_1млн', CommissionCalculator.LEVELS['от_1млн']
+        # Вне всех уровней - последний уровень
+        return pricing_store.current().level(rub_amount)
 
 
 class ExchangeCalculator:
     """Калькулятор обмена валют для режима Doverka (SBP)"""
     
-    def __init__(self, usdt_thb_rate: float, rub_usdt_rate: float):
+    # Точный маппинг от пользователя: Прибыль -> Комиссия USDT-THB
+    # (значения по умолчанию; актуальная кривая - в pricing_store)
+    PROFIT_COMMISSION_MAP = {
+        5.0: 0.0272,
+        4.5: 0.0225,
+        4.0: 0.0170,
+        3.5: 0.0120,
+        3.0: 0.0067,
+        2.4: 0.0,
+        2.0: -0.003,
+        1.5: -0.007
+    }
+    
+    def __init__(self, usdt_thb_rate: float, rub_usdt_rate: float, tables=None):
         """
         Args:
             usdt_thb_rate: Курс USDT-THB от Binance
             rub_usdt_rate: Курс RUB-USDT от Doverka
+            tables: Таблицы комиссий (PricingTables); по умолчанию - текущие из pricing_store
         """
         self.usdt_thb_rate = usdt_thb_rate
         self.rub_usdt_rate = rub_usdt_rate
+        self.tables = tables
     
     def _get_commissions(self, target_profit: float, rub_amount: float = 0):
         """Расчет комиссий для Doverka с фиксированными значениями"""
-        _, default_comm = CommissionCalculator.get_level(rub_amount)
+        tables = self.tables if self.tables is not None else pricing_store.current()
+        _, default_comm = tables.level(rub_amount)
         bonus = default_comm['bonus_percent'] # 0.024
         
         if target_profit is not None:
-            # Точный маппинг от пользователя: Прибыль -> Комиссия USDT-THB
-            mapping = {
-                5.0: 0.0272,
-                4.5: 0.0225,
-                4.0: 0.0170,
-                3.5: 0.0120,
-                3.0: 0.0067,
-                2.4: 0.0,
-                2.0: -0.003,
-                1.5: -0.007
-            }
-            
-            if target_profit in mapping:
-                usdt_comm = mapping[target_profit]
-            else:
-                # Линейная интерполяция для промежуточных значений
-                pts = sorted(mapping.items())
-                for i in range(len(pts) - 1):
-                    x1, y1 = pts[i]
-                    x2, y2 = pts[i+1]
-                    if x1 <= target_profit <= x2:
-                        usdt_comm = y1 + (y2 - y1) * (target_profit - x1) / (x2 - x1)
-                        break
-                else:
-                    usdt_comm = 0.0272 if target_profit > 5 else -0.007
-                    
+            # Точная точка кривой или линейная интерполяция между соседними
+            usdt_comm = tables.usdt_commission(target_profit)
             return 0.0, usdt_comm, bonus, f"Индивидуальный ({target_profit}%)"
         else:
             return 0.0, default_comm['usdt_thb_commission'], bonus, "Стандартный"
@@ -342,8 +420,7 @@ class ExchangeCalculator:
         rub_comm, usdt_comm, bonus, level_name = self._get_commissions(custom_profit_margin, estimated_rub)
         
         # 1. Выдача
-        thb_to_exchange = (thb_target + 20) / (1 - 0.0025)
-        withdrawal_percent_fee = excel_round(thb_to_exchange - thb_target - 20, 2)
+        thb_to_exchange, withdrawal_percent_fee = thb_payout_leg(thb_target)
         
         # 2. USDT-THB
         usdt_thb_rate_sell = self.usdt_thb_rate * (1 - usdt_comm)
@@ -500,8 +577,7 @@ class ExchangeCalculator:
         target_profit = custom_profit_margin if custom_profit_margin is not None else 4.0
         usdt_comm = target_profit / 100.0
         
-        thb_to_exchange = (thb_target + 20) / (1 - 0.0025)
-        withdrawal_percent_fee = excel_round(thb_to_exchange - thb_target - 20, 2)
+        thb_to_exchange, withdrawal_percent_fee = thb_payout_leg(thb_target)
         
         usdt_thb_rate_sell = self.usdt_thb_rate * (1 - usdt_comm)
         usdt_amount = excel_round(thb_to_exchange / usdt_thb_rate_sell, 2)
@@ -616,6 +692,10 @@ class ExchangeCalculator:
         return self.rub_to_thb_target(thb_target, custom_profit_margin)
 
 
+# Таблицы Doverka: по умолчанию из кода, app.py подключает загрузку версий из БД
+pricing_store = PricingStore(PricingTables(CommissionCalculator.LEVELS, ExchangeCalculator.PROFIT_COMMISSION_MAP))
+
+
 class BrokerCalculator:
     """Калькулятор для операций через брокера с кастомными курсами"""
     
@@ -865,12 +945,12 @@ async def test_calculator():
     print("=" * 60)
     result1 = calculator.rub_to_thb(100_000)
     print(f"Сценарий: {result1['scenario']}")
-    print(f"Уровень комиссий: {result1['level']}")
+    print(f"Уровень комиссий: {result1['commission_level']}")
     print(f"Клиент вносит: {result1['rub_paid']:,.2f} ₽")
     print(f"Клиент получает: {result1['thb_received']:,.2f} ฿")
     print(f"Курс для клиента: {result1['final_rate']:.4f} ₽/฿")
-    print(f"Комиссия брокера USDT-THB: {result1['commission_percent']}%")
-    print(f"Комиссия за выдачу: {result1['withdrawal_fees']:.2f} ฿")
+    print(f"Комиссия брокера USDT-THB: {result1['usdt_thb_commission']}%")
+    print(f"Комиссия за выдачу: {result1['withdrawal_percent'] + result1['withdrawal_fixed']:.2f} ฿")
     print(f"Прибыль (USDT): {result1['profit_usdt']:.2f}\n")
     
     # Тест 2: Хочет получить 150,000 батов
@@ -879,12 +959,12 @@ async def test_calculator():
     print("=" * 60)
     result2 = calculator.thb_to_rub(150_000)
     print(f"Сценарий: {result2['scenario']}")
-    print(f"Уровень комиссий: {result2['level']}")
+    print(f"Уровень комиссий: {result2['commission_level']}")
     print(f"Клиент хочет: {result2['thb_target']:,.2f} ฿")
     print(f"Клиент должен внести: {result2['rub_to_pay']:,.2f} ₽")
     print(f"Курс для клиента: {result2['final_rate']:.4f} ₽/฿")
-    print(f"Комиссия брокера USDT-THB: {result2['commission_percent']}%")
-    print(f"Комиссия за выдачу: {result2['withdrawal_fees']:.2f} ฿")
+    print(f"Комиссия брокера USDT-THB: {result2['usdt_thb_commission']}%")
+    print(f"Комиссия за выдачу: {result2['withdrawal_percent'] + result2['withdrawal_fixed']:.2f} ฿")
     print(f"Прибыль (USDT): {result2['profit_usdt']:.2f}\n")
 
 
@@ -0,0 +1,327 @@
+"""
+Запись и воспроизведение HTTP к внешним API (requests и aiohttp)
+В режиме record реальные ответы Binance, Doverka и TronScan складываются в сжатую кассету,
+в режиме replay отдаются из неё детерминированно - с исходными, масштабированными или нулевыми задержками.
+
+    CASSETTE_MODE=record CASSETTE_PATH=cassettes/tronscan.json.gz python app.py
+    CASSETTE_MODE=replay CASSETTE_PATH=cassettes/tronscan.json.gz CASSETTE_TIMING=0 python benchmarks.py ...
+"""
+
+import asyncio
+import atexit
+import base64
+import gzip
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import aiohttp
+import requests
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
+
+MODES = ('off', 'record', 'replay')
+CASSETTE_VERSION = 1
+
+# Параметры запроса, которые меняются от вызова к вызову и не должны влиять на сопоставление
+IGNORED_PARAMS = {'t', '_'}
+# Секреты в пути (токен Telegram-бота) не пишем в кассету
+REDACT_PATH = [(re.compile(r'/bot[^/]+/'), '/bot<token>/')]
+# Заголовки ответа, которые не сохраняем
+SKIP_RESPONSE_HEADERS = {'set-cookie', 'content-encoding', 'transfer-encoding', 'content-length', 'connection'}
+
+
+def request_key(method: str, url, params=None) -> str:
+    """Ключ сопоставления: метод + адрес без изменчивых параметров, параметры отсортированы"""
+    parts = urlsplit(str(url))
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)]
+    if params:
+        items = params.items() if hasattr(params, 'items') else params
+        query += [(str(k), str(v)) for k, v in items]
+    query = sorted((k, v) for k, v in query if k not in IGNORED_PARAMS)
+    path = parts.path
+    for pattern, replacement in REDACT_PATH:
+        path = pattern.sub(replacement, path)
+    key = f'{method.upper()} {parts.scheme}://{parts.netloc}{path}'
+    return f'{key}?{urlencode(query)}' if query else key
+
+
+class Cassette:
+    """
+    Записанные ответы: ключ запроса -> список ответов в порядке записи
+
+    При воспроизведении повторные запросы с тем же ключом получают ответы по очереди,
+    после последнего - снова последний. Промахи считаются в stats['misses'].
+    """
+
+    def __init__(self, path: str, mode: str = 'replay', timing: float = 1.0):
+        if mode not in MODES:
+            raise ValueError(f'Unknown cassette mode: {mode}')
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self.meta = {}
+        self.interactions = {}
+        self.stats = {'recorded': 0, 'replayed': 0, 'misses': 0}
+        self._cursor = {}
+        self._lock = threading.Lock()
+        if mode == 'replay':
+            self.load()
+
+    def load(self):
+        with gzip.open(self.path, 'rt', encoding='utf-8') as f:
+            data = json.load(f)
+        if data.get('version') != CASSETTE_VERSION:
+            raise ValueError(f"Unsupported cassette version: {data.get('version')}")
+        self.meta = data.get('meta', {})
+        self.interactions = {}
+        for item in data['interactions']:
+            self.interactions.setdefault(item['key'], []).append(item)
+        self._cursor = {}
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            items = [item for responses in self.interactions.values() for item in responses]
+        items.sort(key=lambda item: item['seq'])
+        with gzip.open(self.path, 'wt', encoding='utf-8') as f:
+            json.dump({'version': CASSETTE_VERSION, 'meta': self.meta, 'interactions': items}, f)
+
+    def record(self, key: str, status: int, headers, body: bytes, elapsed: float):
+        item = {
+            'key': key, 'status': status, 'elapsed': round(elapsed, 6),
+            'headers': {k: v for k, v in headers.items() if k.lower() not in SKIP_RESPONSE_HEADERS},
+        }
+        try:
+            item['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            item['body_b64'] = base64.b64encode(body).decode('ascii')
+        with self._lock:
+            item['seq'] = self.stats['recorded']
+            self.interactions.setdefault(key, []).append(item)
+            self.stats['recorded'] += 1
+
+    def next_response(self, key: str) -> dict:
+        """Следующий записанный ответ по ключу (None - промах)"""
+        with self._lock:
+            responses = self.interactions.get(key)
+            if not responses:
+                self.stats['misses'] += 1
+                return None
+            index = self._cursor.get(key, 0)
+            self._cursor[key] = index + 1
+            self.stats['replayed'] += 1
+            return responses[min(index, len(responses) - 1)]
+
+    def delay(self, item: dict) -> float:
+        return item['elapsed'] * self.timing if self.timing else 0.0
+
+    @staticmethod
+    def body(item: dict) -> bytes:
+        if 'body_b64' in item:
+            return base64.b64decode(item['body_b64'])
+        return item['body'].encode('utf-8')
+
+
+# ---------- requests ----------
+
+_original_requests_send = requests.adapters.HTTPAdapter.send
+
+
+def _requests_send(cassette: Cassette):
+    def send(adapter, request, **kwargs):
+        key = request_key(request.method, request.url)
+        if cassette.mode == 'record':
+            started = time.perf_counter()
+            response = _original_requests_send(adapter, request, **kwargs)
+            cassette.record(key, response.status_code, response.headers, response.content,
+                            time.perf_counter() - started)
+            return response
+
+        item = cassette.next_response(key)
+        if item is None:
+            raise requests.exceptions.ConnectionError(f'No recorded response for {key}', request=request)
+        delay = cassette.delay(item)
+        if delay:
+            time.sleep(delay)
+        response = requests.Response()
+        response.status_code = item['status']
+        response.headers = requests.structures.CaseInsensitiveDict(item['headers'])
+        response._content = Cassette.body(item)
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers) or 'utf-8'
+        response.reason = 'Replayed'
+        return response
+    return send
+
+
+# ---------- aiohttp ----------
+
+_original_aiohttp_request = aiohttp.ClientSession._request
+
+
+class ReplayedClientResponse:
+    """Минимальная замена aiohttp.ClientResponse для воспроизведения"""
+
+    def __init__(self, method: str, url, item: dict):
+        self.method = method
+        self.url = URL(str(url))
+        self.status = item['status']
+        self.reason = 'Replayed'
+        self.headers = CIMultiDictProxy(CIMultiDict(item['headers']))
+        self._body = Cassette.body(item)
+
+    @property
+    def ok(self) -> bool:
+        return self.status < 400
+
+    async def read(self) -> bytes:
+        return self._body
+
+    async def text(self, encoding: str = None, errors: str = 'strict') -> str:
+        return self._body.decode(encoding or 'utf-8', errors)
+
+    async def json(self, *, encoding: str = None, loads=json.loads, content_type: str = 'application/json'):
+        return loads(self._body.decode(encoding or 'utf-8'))
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status, message=self.reason)
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+    async def wait_for_close(self):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def _aiohttp_request(cassette: Cassette):
+    async def _request(session, method, str_or_url, *, params=None, **kwargs):
+        url = session._build_url(str_or_url) if hasattr(session, '_build_url') else str_or_url
+        key = request_key(method, url, params)
+        if cassette.mode == 'record':
+            started = time.perf_counter()
+            response = await _original_aiohttp_request(session, method, str_or_url, params=params, **kwargs)
+            body = await response.read()
+            cassette.record(key, response.status, response.headers, body, time.perf_counter() - started)
+            return response
+
+        item = cassette.next_response(key)
+        if item is None:
+            raise aiohttp.ClientConnectionError(f'No recorded response for {key}')
+        delay = cassette.delay(item)
+        if delay:
+            await asyncio.sleep(delay)
+        return ReplayedClientResponse(method, url, item)
+    return _request
+
+
+# ---------- установка ----------
+
+_active = None
+
+
+def install(cassette: Cassette) -> Cassette:
+    """Перехватить requests и aiohttp (одна активная кассета на процесс)"""
+    global _active
+    uninstall()
+    if cassette.mode != 'off':
+        requests.adapters.HTTPAdapter.send = _requests_send(cassette)
+        aiohttp.ClientSession._request = _aiohttp_request(cassette)
+    _active = cassette
+    return cassette
+
+
+def uninstall():
+    """Вернуть настоящий транспорт; записанная кассета сохраняется"""
+    global _active
+    requests.adapters.HTTPAdapter.send = _original_requests_send
+    aiohttp.ClientSession._request = _original_aiohttp_request
+    if _active is not None and _active.mode == 'record':
+        _active.save()
+    _active = None
+
+
+def active() -> Cassette:
+    return _active
+
+
+@contextmanager
+def use_cassette(path: str, mode: str = 'replay', timing: float = 1.0):
+    """with use_cassette('cassettes/x.json.gz', 'record'): ... - запись сохраняется при выходе"""
+    cassette = install(Cassette(path, mode, timing))
+    try:
+        yield cassette
+    finally:
+        uninstall()
+
+
+def install_from_env() -> Cassette:
+    """
+    CASSETTE_MODE=record|replay, CASSETTE_PATH, CASSETTE_TIMING (множитель задержек, 0 - без задержек)
+    В режиме record кассета сохраняется при выходе процесса.
+    """
+    mode = os.getenv('CASSETTE_MODE', 'off').strip().lower() or 'off'
+    if mode == 'off':
+        return None
+    path = os.getenv('CASSETTE_PATH', 'cassettes/upstreams.json.gz')
+    cassette = install(Cassette(path, mode, float(os.getenv('CASSETTE_TIMING', 1.0))))
+    if mode == 'record':
+        atexit.register(cassette.save)
+    print(f"📼 Cassette {mode}: {path}")
+    return cassette
+
+
+if __name__ == '__main__':
+    # Запись с локальных заглушек и воспроизведение: ответы совпадают, сеть не нужна
+    import tempfile
+
+    import fake_upstreams
+
+    fakes, base_url, stop = fake_upstreams.start_in_thread(behaviour={'tronscan': {'latency_ms': 40, 'jitter_ms': 0}})
+    tronscan = f'{base_url}/tronscan/api'
+    binance = f'{base_url}/binance-th/api/v1'
+    path = os.path.join(tempfile.mkdtemp(), 'demo.json.gz')
+
+    def fetch_all():
+        out = [requests.get(f'{tronscan}/token_trc20/transfers',
+                            params={'relatedAddress': 'TDemo', 'limit': 50, 'start': start, 't': time.time()}).json()
+               for start in (0, 50)]
+        out.append(requests.get(f'{tronscan}/account', params={'address': 'TDemo'}).json())
+
+        async def rates():
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f'{binance}/ticker/price', params={'symbol': 'USDTTHB'}) as response:
+                    return await response.json()
+        out.append(asyncio.run(rates()))
+        return out
+
+    with use_cassette(path, 'record') as cassette:
+        recorded = fetch_all()
+    print(f"📼 recorded {cassette.stats['recorded']} responses, {os.path.getsize(path)} bytes")
+    stop()
+
+    for timing in (1.0, 0.0):
+        with use_cassette(path, 'replay', timing) as cassette:
+            started = time.perf_counter()
+            replayed = fetch_all()
+            elapsed = time.perf_counter() - started
+        ok = replayed == recorded and cassette.stats['misses'] == 0
+        print(f"{'✅' if ok else '❌'} replay timing={timing}: {cassette.stats['replayed']} responses "
+              f"in {elapsed * 1000:.0f} ms, {cassette.stats['misses']} misses")
@@ -0,0 +1,303 @@
+"""
+Локальные заглушки внешних API: Binance TH/Global, Doverka, TronScan, Telegram
+Один aiohttp-сервер, у каждого апстрима свой префикс пути, задержка, доля ошибок и размер страницы.
+Данные синтетические и детерминированные: переводы кошелька зависят только от адреса.
+
+    python fake_upstreams.py --port 8900 --latency tronscan=150 --error-rate binance_th=0.2
+    # затем запустить app.py с напечатанными переменными окружения
+"""
+
+import argparse
+import asyncio
+import hashlib
+import random
+import threading
+import time
+import zlib
+
+from aiohttp import web
+
+USDT_CONTRACT = 'TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t'
+
+# Апстрим -> (префикс пути, переменная окружения приложения с базовым адресом)
+UPSTREAMS = {
+    'binance_th': ('/binance-th/api/v1', 'BINANCE_API_URL'),
+    'binance_global': ('/binance/api/v3', 'BINANCE_GLOBAL_API_URL'),
+    'doverka': ('/doverka', 'DOVERKA_API_URL'),
+    'tronscan': ('/tronscan/api', 'TRONSCAN_API_URL'),
+    'telegram': ('/telegram', 'TELEGRAM_API_URL'),
+}
+
+# Поведение по умолчанию: задержка (мс), разброс (мс), доля ошибок, код ошибки
+DEFAULT_BEHAVIOUR = {'latency_ms': 20.0, 'jitter_ms': 10.0, 'error_rate': 0.0, 'error_status': 500}
+# TronScan при перегрузке отвечает 429 - так заглушка проверяет и обработку лимитов
+ERROR_STATUS = {'tronscan': 429}
+
+# Синтетический рынок
+USDT_THB = 35.20
+RUB_USDT = 86.50
+TRANSFERS_PER_WALLET = 120
+TRANSFER_INTERVAL_MS = 15 * 60 * 1000
+PAGE_LIMIT = 50
+
+
+class FakeUpstreams:
+    """Состояние заглушек: поведение апстримов, счётчики запросов и кэш сгенерированных переводов"""
+
+    def __init__(self, behaviour: dict = None, transfers_per_wallet: int = TRANSFERS_PER_WALLET,
+                 page_limit: int = PAGE_LIMIT, seed: int = 0):
+        self.behaviour = {}
+        for name in UPSTREAMS:
+            self.behaviour[name] = dict(DEFAULT_BEHAVIOUR, error_status=ERROR_STATUS.get(name, 500))
+            self.behaviour[name].update((behaviour or {}).get(name, {}))
+        self.transfers_per_wallet = transfers_per_wallet
+        self.page_limit = page_limit
+        self.random = random.Random(seed)
+        # Переводы привязаны к моменту старта, чтобы страницы не «ехали» во время теста
+        self.now_ms = int(time.time() * 1000)
+        self.stats = {name: {'requests': 0, 'errors': 0} for name in UPSTREAMS}
+        self.messages = []
+        self._ledgers = {}
+        self._by_hash = {}
+
+    # ---------- данные ----------
+
+    def ledger(self, address: str) -> list:
+        """Переводы USDT кошелька, от новых к старым (половина входящих)"""
+        if address not in self._ledgers:
+            rnd = random.Random(zlib.crc32(address.encode()))
+            transfers = []
+            for i in range(self.transfers_per_wallet):
+                counterparty = 'T' + hashlib.sha1(f'{address}:peer:{rnd.randrange(50)}'.encode()).hexdigest()[:33]
+                incoming = rnd.random() < 0.5
+                tx = {
+                    'transaction_id': hashlib.sha256(f'{address}:{i}'.encode()).hexdigest(),
+                    'block_ts': self.now_ms - i * TRANSFER_INTERVAL_MS - rnd.randrange(TRANSFER_INTERVAL_MS // 2),
+                    'from_address': counterparty if incoming else address,
+                    'to_address': address if incoming else counterparty,
+                    'quant': str(rnd.randrange(10, 20_000) * 1_000_000 + rnd.randrange(1_000_000)),
+                    'confirmed': i > 0,
+                    'tokenInfo': {'tokenId': USDT_CONTRACT, 'tokenAbbr': 'USDT', 'tokenDecimal': 6},
+                }
+                transfers.append(tx)
+                self._by_hash[tx['transaction_id']] = tx
+            self._ledgers[address] = transfers
+        return self._ledgers[address]
+
+    def add_transfer(self, address: str, amount_usdt: float, incoming: bool = True, confirmed: bool = False) -> dict:
+        """Новый перевод «сейчас» в начало истории кошелька (для проверки инкрементальной синхронизации)"""
+        transfers = self.ledger(address)
+        counterparty = 'T' + hashlib.sha1(f'{address}:new:{len(transfers)}'.encode()).hexdigest()[:33]
+        tx = {
+            'transaction_id': hashlib.sha256(f'{address}:new:{len(transfers)}'.encode()).hexdigest(),
+            'block_ts': max(int(time.time() * 1000), transfers[0]['block_ts'] + 1 if transfers else 0),
+            'from_address': counterparty if incoming else address,
+            'to_address': address if incoming else counterparty,
+            'quant': str(int(round(amount_usdt * 1_000_000))),
+            'confirmed': confirmed,
+            'tokenInfo': {'tokenId': USDT_CONTRACT, 'tokenAbbr': 'USDT', 'tokenDecimal': 6},
+        }
+        transfers.insert(0, tx)
+        self._by_hash[tx['transaction_id']] = tx
+        return tx
+
+    def balance(self, address: str) -> tuple:
+        """(USDT, TRX) в минимальных единицах"""
+        rnd = random.Random(zlib.crc32(address.encode()) ^ 0xBA1)
+        return rnd.randrange(0, 50_000) * 1_000_000, rnd.randrange(1, 5_000) * 1_000_000
+
+    # ---------- поведение ----------
+
+    async def _behave(self, name: str):
+        """Задержка и, с заданной вероятностью, ответ с ошибкой (None - отвечаем нормально)"""
+        behaviour = self.behaviour[name]
+        self.stats[name]['requests'] += 1
+        delay = behaviour['latency_ms'] + self.random.uniform(-1, 1) * behaviour['jitter_ms']
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        if self.random.random() < behaviour['error_rate']:
+            self.stats[name]['errors'] += 1
+            headers = {'Retry-After': '1'} if behaviour['error_status'] == 429 else None
+            return web.json_response({'error': 'injected failure'}, status=behaviour['error_status'], headers=headers)
+        return None
+
+    def _price(self, base: float) -> str:
+        return f'{base * (1 + self.random.uniform(-0.001, 0.001)):.2f}'
+
+    # ---------- обработчики ----------
+
+    async def binance_th_price(self, request):
+        error = await self._behave('binance_th')
+        if error is not None:
+            return error
+        symbol = request.query.get('symbol', 'USDTTHB')
+        return web.json_response({'code': 0, 'msg': 'success', 'data': {'symbol': symbol, 'price': self._price(USDT_THB)}})
+
+    async def binance_global_price(self, request):
+        error = await self._behave('binance_global')
+        if error is not None:
+            return error
+        return web.json_response({'symbol': request.query.get('symbol', 'USDTTHB'), 'price': self._price(USDT_THB)})
+
+    async def doverka_currencies(self, request):
+        error = await self._behave('doverka')
+        if error is not None:
+            return error
+        if not request.headers.get('Authorization', '').startswith('Bearer '):
+            return web.json_response({'error': 'unauthorized'}, status=401)
+        rate = self._price(RUB_USDT)
+        return web.json_response([
+            {'symbol': 'USDT', 'rate_to_rub': rate, 'rate_from_rub': rate},
+            {'symbol': 'BTC', 'rate_to_rub': '8100000.00', 'rate_from_rub': '8100000.00'},
+        ])
+
+    async def tronscan_transfers(self, request):
+        error = await self._behave('tronscan')
+        if error is not None:
+            return error
+        address = request.query.get('relatedAddress', '')
+        start = int(request.query.get('start', 0))
+        limit = min(int(request.query.get('limit', 20)), self.page_limit)
+        transfers = self.ledger(address) if address else []
+        start_ts = request.query.get('start_timestamp')
+        if start_ts:
+            transfers = [tx for tx in transfers if tx['block_ts'] >= int(start_ts)]
+        end_ts = request.query.get('end_timestamp')
+        if end_ts:
+            transfers = [tx for tx in transfers if tx['block_ts'] <= int(end_ts)]
+        return web.json_response({'total': len(transfers), 'rangeTotal': len(transfers),
+                                  'token_transfers': transfers[start:start + limit]})
+
+    async def tronscan_account(self, request):
+        error = await self._behave('tronscan')
+        if error is not None:
+            return error
+        usdt, trx = self.balance(request.query.get('address', ''))
+        return web.json_response({'balance': trx, 'trc20token_balances': [
+            {'tokenId': USDT_CONTRACT, 'tokenAbbr': 'USDT', 'balance': str(usdt), 'tokenDecimal': 6}]})
+
+    async def tronscan_account_tokens(self, request):
+        error = await self._behave('tronscan')
+        if error is not None:
+            return error
+        usdt, _ = self.balance(request.query.get('address', ''))
+        return web.json_response({'data': [{'tokenId': USDT_CONTRACT, 'tokenAbbr': 'USDT', 'balance': str(usdt)}]})
+
+    async def tronscan_transaction_info(self, request):
+        error = await self._behave('tronscan')
+        if error is not None:
+            return error
+        tx = self._by_hash.get(request.query.get('hash', ''))
+        if tx is None:
+            return web.json_response({})
+        return web.json_response({
+            'hash': tx['transaction_id'], 'timestamp': tx['block_ts'], 'confirmed': tx['confirmed'],
+            'trc20TransferInfo': [{'from_address': tx['from_address'], 'to_address': tx['to_address'],
+                                   'amount_str': tx['quant'], 'contract_address': USDT_CONTRACT}]
+        })
+
+    async def telegram_send(self, request):
+        error = await self._behave('telegram')
+        if error is not None:
+            return error
+        payload = await request.json()
+        self.messages.append(payload)
+        return web.json_response({'ok': True, 'result': {'message_id': len(self.messages), 'text': payload.get('text')}})
+
+    async def stats_view(self, request):
+        return web.json_response({'upstreams': self.stats, 'telegram_messages': len(self.messages)})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        prefix = {name: value[0] for name, value in UPSTREAMS.items()}
+        app.router.add_get(f"{prefix['binance_th']}/ticker/price", self.binance_th_price)
+        app.router.add_get(f"{prefix['binance_global']}/ticker/price", self.binance_global_price)
+        app.router.add_get(f"{prefix['doverka']}/v1/currencies", self.doverka_currencies)
+        app.router.add_get(f"{prefix['tronscan']}/token_trc20/transfers", self.tronscan_transfers)
+        app.router.add_get(f"{prefix['tronscan']}/account", self.tronscan_account)
+        app.router.add_get(f"{prefix['tronscan']}/account/tokens", self.tronscan_account_tokens)
+        app.router.add_get(f"{prefix['tronscan']}/transaction-info", self.tronscan_transaction_info)
+        app.router.add_post(f"{prefix['telegram']}/bot{{token}}/sendMessage", self.telegram_send)
+        app.router.add_get('/_stats', self.stats_view)
+        return app
+
+
+def upstream_env(base_url: str) -> dict:
+    """Переменные окружения, которые направляют приложение на заглушки"""
+    env = {var: f'{base_url}{prefix}' for prefix, var in UPSTREAMS.values()}
+    env['DOVERKA_API_KEY'] = 'fake-doverka-key'
+    return env
+
+
+def start_in_thread(host: str = '127.0.0.1', port: int = 0, **options):
+    """
+    Поднять заглушки в фоновом потоке
+
+    Returns:
+        tuple: (FakeUpstreams, базовый URL, stop() - остановить сервер)
+    """
+    fakes = FakeUpstreams(**options)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(fakes.app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    bound_port = site._server.sockets[0].getsockname()[1]
+    thread = threading.Thread(target=loop.run_forever, name='fake-upstreams', daemon=True)
+    thread.start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=5)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(timeout=5)
+
+    return fakes, f'http://{host}:{bound_port}', stop
+
+
+def parse_overrides(items: list, cast=float) -> dict:
+    """['tronscan=150', 'binance_th=20'] -> {'tronscan': 150.0, ...}; имя 'all' - для всех апстримов"""
+    out = {}
+    for item in items or []:
+        name, _, value = item.partition('=')
+        names = list(UPSTREAMS) if name == 'all' else [name]
+        for upstream in names:
+            if upstream not in UPSTREAMS:
+                raise SystemExit(f'Unknown upstream: {upstream} (expected one of {", ".join(UPSTREAMS)})')
+            out[upstream] = cast(value)
+    return out
+
+
+def behaviour_from_args(args) -> dict:
+    behaviour = {name: {} for name in UPSTREAMS}
+    for key, items, cast in (('latency_ms', args.latency, float), ('jitter_ms', args.jitter, float),
+                             ('error_rate', args.error_rate, float), ('error_status', args.error_status, int)):
+        for name, value in parse_overrides(items, cast).items():
+            behaviour[name][key] = value
+    return behaviour
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    """Параметры заглушек (общие с loadtest.py)"""
+    parser.add_argument('--latency', action='append', metavar='UPSTREAM=MS', help='response latency, e.g. tronscan=150')
+    parser.add_argument('--jitter', action='append', metavar='UPSTREAM=MS', help='latency jitter (±ms)')
+    parser.add_argument('--error-rate', action='append', metavar='UPSTREAM=P', help='share of failed responses 0..1')
+    parser.add_argument('--error-status', action='append', metavar='UPSTREAM=CODE', help='HTTP status for failures')
+    parser.add_argument('--transfers', type=int, default=TRANSFERS_PER_WALLET, help='TronScan transfers per wallet')
+    parser.add_argument('--page-limit', type=int, default=PAGE_LIMIT, help='max TronScan page size')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-ins for Binance, Doverka, TronScan and Telegram')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    fakes = FakeUpstreams(behaviour_from_args(args), args.transfers, args.page_limit)
+    base_url = f'http://{args.host}:{args.port}'
+    print(f'🧪 Fake upstreams on {base_url} (stats: {base_url}/_stats)')
+    print('   Запустите приложение с переменными:')
+    for var, value in upstream_env(base_url).items():
+        print(f'   export {var}={value}')
+    print('   export TRONSCAN_RATE=off TELEGRAM_BOT_TOKEN=fake TELEGRAM_CHAT_ID=1')
+    web.run_app(fakes.app(), host=args.host, port=args.port, print=None, access_log=None)
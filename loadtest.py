@@ -0,0 +1,195 @@
+"""
+Нагрузочный тест сервиса: p50/p95/p99 и пропускная способность по эндпоинтам
+при растущей конкуррентности. С --serve поднимает заглушки апстримов (fake_upstreams.py)
+и само приложение в этом процессе, так что реальные API не трогаются.
+
+    python loadtest.py --serve --wallets 5 --concurrency 1,4,16 --duration 5
+    python loadtest.py --base-url http://127.0.0.1:5000 --endpoints rates,calculate
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+
+import aiohttp
+import numpy as np
+
+import fake_upstreams
+
+# Эндпоинт -> (метод, путь, тело); calculate чередует сценарии
+ENDPOINTS = {
+    'rates': ('GET', '/api/rates', None),
+    'calculate': ('POST', '/api/calculate', [
+        {'method': 'doverka', 'scenario': 'rub-to-thb', 'direction': 'amount', 'amount': 100_000},
+        {'method': 'doverka', 'scenario': 'usdt-to-thb', 'direction': 'target', 'amount': 150_000},
+        {'method': 'broker', 'scenario': 'rub-to-thb', 'direction': 'amount', 'amount': 100_000,
+         'custom_rub_usdt': 80.9, 'profit_margin': 4.0},
+        {'method': 'broker', 'scenario': 'thb-to-usdt', 'direction': 'target', 'amount': 3_000,
+         'custom_rub_usdt': 80.9, 'profit_margin': 3.7},
+    ]),
+    'incoming': ('GET', '/api/transactions/incoming', None),
+    'wallets': ('GET', '/api/wallets', None),
+}
+PERCENTILES = (50, 95, 99)
+
+
+def fake_wallet(i: int) -> str:
+    return 'T' + hashlib.sha1(f'loadtest-wallet-{i}'.encode()).hexdigest()[:33]
+
+
+def serve_app(options: dict, wallets: int):
+    """
+    Заглушки апстримов + приложение (werkzeug, многопоточный) в фоновых потоках
+
+    Returns:
+        tuple: (базовый URL приложения, FakeUpstreams, stop())
+    """
+    fakes, upstream_url, stop_fakes = fake_upstreams.start_in_thread(**options)
+    for var, value in fake_upstreams.upstream_env(upstream_url).items():
+        os.environ[var] = value
+    os.environ.setdefault('TRONSCAN_RATE', 'off')
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', 'fake')
+    os.environ.setdefault('TELEGRAM_CHAT_ID', '1')
+    workdir = tempfile.mkdtemp(prefix='calccrm_loadtest_')
+    os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(workdir, 'loadtest.db')}")
+    os.environ.setdefault('SHARED_CACHE_PATH', os.path.join(workdir, 'shared_cache.db'))
+
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app as app_module
+
+    class QuietHandler(WSGIRequestHandler):
+        # Лог каждого запроса под нагрузкой только мешает и сам стоит времени
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, name='loadtest-app', daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+
+    client = app_module.app.test_client()
+    for i in range(wallets):
+        client.post('/api/wallets', json={'address': fake_wallet(i), 'label': f'loadtest {i}', 'is_monitored': True})
+
+    def stop():
+        server.shutdown()
+        thread.join(timeout=5)
+        stop_fakes()
+
+    return base_url, fakes, stop
+
+
+async def _worker(session, base_url, endpoints, deadline, offset, samples, force_refresh):
+    i = offset
+    while time.perf_counter() < deadline:
+        name = endpoints[i % len(endpoints)]
+        method, path, bodies = ENDPOINTS[name]
+        body = bodies[i % len(bodies)] if bodies else None
+        params = {'force_refresh': 'true'} if force_refresh and name in ('incoming', 'wallets') else None
+        started = time.perf_counter()
+        try:
+            async with session.request(method, base_url + path, json=body, params=params) as response:
+                await response.read()
+                ok = response.status < 400
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            ok = False
+        samples.append((name, time.perf_counter() - started, ok))
+        i += 1
+
+
+async def run_level(base_url: str, endpoints: list, concurrency: int, duration: float,
+                    force_refresh: bool = False, timeout: float = 60) -> dict:
+    """Один уровень нагрузки: concurrency клиентов крутят запросы duration секунд"""
+    samples = []
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        started = time.perf_counter()
+        deadline = started + duration
+        await asyncio.gather(*(_worker(session, base_url, endpoints, deadline, n, samples, force_refresh)
+                               for n in range(concurrency)))
+        elapsed = time.perf_counter() - started
+    return summarize(samples, elapsed)
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    """Перцентили задержки (мс), пропускная способность и ошибки по эндпоинтам и в целом"""
+    groups = {}
+    for name, latency, ok in samples:
+        groups.setdefault(name, []).append((latency, ok))
+    groups['total'] = [(latency, ok) for _, latency, ok in samples]
+    report = {}
+    for name, items in groups.items():
+        latencies = np.array([latency for latency, _ in items]) * 1000
+        errors = sum(1 for _, ok in items if not ok)
+        stats = {'requests': len(items), 'errors': errors, 'rps': round(len(items) / elapsed, 1)}
+        for p, value in zip(PERCENTILES, np.percentile(latencies, PERCENTILES) if len(items) else [None] * 3):
+            stats[f'p{p}_ms'] = None if value is None else round(float(value), 1)
+        report[name] = stats
+    return report
+
+
+def print_level(concurrency: int, report: dict):
+    print(f"\n👥 concurrency={concurrency}")
+    print(f"   {'endpoint':<10} {'req':>7} {'err':>5} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for name, s in report.items():
+        print(f"   {name:<10} {s['requests']:>7} {s['errors']:>5} {s['rps']:>8.1f} "
+              f"{s['p50_ms'] or 0:>9.1f} {s['p95_ms'] or 0:>9.1f} {s['p99_ms'] or 0:>9.1f}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Load test /api/rates, /api/calculate, /api/transactions/incoming, /api/wallets')
+    parser.add_argument('--base-url', default=None, help='running service (default: --serve)')
+    parser.add_argument('--serve', action='store_true', help='start fake upstreams and the app in-process')
+    parser.add_argument('--wallets', type=int, default=5, help='wallets to create with --serve')
+    parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help='comma-separated: ' + ', '.join(ENDPOINTS))
+    parser.add_argument('--concurrency', default='1,4,16,64', help='comma-separated concurrency levels')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds per level')
+    parser.add_argument('--force-refresh', action='store_true', help='bypass TronScan caches on incoming/wallets')
+    parser.add_argument('--json', default=None, help='write the report to this file')
+    fake_upstreams.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    endpoints = [name.strip() for name in args.endpoints.split(',') if name.strip()]
+    unknown = [name for name in endpoints if name not in ENDPOINTS]
+    if unknown:
+        print(f"❌ Unknown endpoints: {', '.join(unknown)}")
+        return 2
+    levels = [int(level) for level in args.concurrency.split(',')]
+
+    stop = fakes = None
+    base_url = args.base_url
+    if args.serve or not base_url:
+        options = {'behaviour': fake_upstreams.behaviour_from_args(args),
+                   'transfers_per_wallet': args.transfers, 'page_limit': args.page_limit}
+        base_url, fakes, stop = serve_app(options, args.wallets)
+        print(f"🧪 App on {base_url} with fake upstreams, {args.wallets} wallets")
+
+    report = {'base_url': base_url, 'endpoints': endpoints, 'duration': args.duration, 'levels': {}}
+    try:
+        for level in levels:
+            result = asyncio.run(run_level(base_url, endpoints, level, args.duration, args.force_refresh))
+            report['levels'][str(level)] = result
+            print_level(level, result)
+        if fakes is not None:
+            report['upstreams'] = fakes.stats
+            calls = ', '.join(f"{name} {s['requests']} ({s['errors']} err)" for name, s in fakes.stats.items())
+            print(f"\n🌐 Upstream calls: {calls}")
+    finally:
+        if stop:
+            stop()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Report saved to {args.json}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
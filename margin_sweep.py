@@ -0,0 +1,233 @@
+"""
+Свип маржи брокера и подбор маржи под курс клиента
+Сетка маржа × курс USDT-THB × кастомный курс RUB-USDT × сумма считается векторными
+операциями batch_calculator: один проход NumPy на операцию вместо тысяч вызовов калькулятора.
+"""
+
+import numpy as np
+
+from batch_calculator import OPERATIONS as VECTOR_OPERATIONS
+from broker_detailed import BrokerCalculatorDetailed
+from operations import resolve
+
+# Операции брокера в порядке реестра: 'rub-to-thb/target' -> векторная функция
+BROKER_OPERATIONS = {f'{scenario}/{direction}': func
+                     for (method, scenario, direction), func in VECTOR_OPERATIONS.items() if method == 'broker'}
+
+AXES = ('profit_margin', 'usdt_thb', 'custom_rub_usdt', 'amount')
+
+# Ограничения сетки маржи для подбора (в %, шаг - точность ответа)
+SOLVE_MIN_MARGIN = 0.0
+SOLVE_MAX_MARGIN = 10.0
+SOLVE_STEP = 0.001
+
+
+def grid_axis(value, name: str) -> np.ndarray:
+    """
+    Ось сетки: число, список или диапазон {'from', 'to', 'step'} -> отсортированные уникальные значения
+
+    Raises:
+        ValueError: Пустая ось, нечисловые значения или слишком мелкий шаг
+    """
+    if isinstance(value, dict):
+        try:
+            start, stop, step = float(value['from']), float(value['to']), float(value['step'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"'{name}' range needs numeric 'from', 'to' and 'step'")
+        if not step > 0 or not stop >= start:
+            raise ValueError(f"'{name}' range is invalid")
+        if (stop - start) / step > 10 ** 6:
+            raise ValueError(f"'{name}' range has too many points")
+        # Округляем узлы, чтобы 0.1 + 0.2 не превращалось в 0.30000000000000004 (пресеты брокера сравниваются с допуском)
+        values = np.round(start + step * np.arange(int(round((stop - start) / step)) + 1), 10)
+    else:
+        items = value if isinstance(value, (list, tuple)) else [value]
+        try:
+            values = np.array([float(v) for v in items], dtype=np.float64)
+        except (TypeError, ValueError):
+            raise ValueError(f"'{name}' must be numeric")
+    if values.size == 0 or not np.all(np.isfinite(values)):
+        raise ValueError(f"'{name}' must contain finite numbers")
+    return np.unique(values)
+
+
+def _evaluate(func, margins, usdt_thb, custom_rub_usdt, amounts):
+    """(final_rate, profit_usdt, profit_percent_actual, failed) для плоских массивов одинаковой длины"""
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        columns = func(usdt_thb, custom_rub_usdt, amounts, margins)
+    profit_percent_actual = columns['profit_percent_actual']
+    if isinstance(profit_percent_actual, tuple):
+        # Скалярный код возвращает 0, если база для процента не положительна
+        profit_percent_actual = profit_percent_actual[0]
+    final_rate = columns['final_rate']
+    profit_usdt = columns['profit_usdt']
+    failed = ~(np.isfinite(final_rate) & np.isfinite(profit_usdt) & np.isfinite(profit_percent_actual))
+    return final_rate, profit_usdt, profit_percent_actual, failed
+
+
+def _first_index(condition: np.ndarray, axis: int) -> np.ndarray:
+    """Индекс первого True вдоль оси, -1 если его нет"""
+    return np.where(condition.any(axis=axis), condition.argmax(axis=axis), -1)
+
+
+def _to_list(values: np.ndarray, missing: np.ndarray = None):
+    """Массив -> вложенные списки, None на месте ошибок"""
+    if missing is None or not missing.any():
+        return values.tolist()
+    out = values.astype(object)
+    out[missing] = None
+    return out.tolist()
+
+
+def sweep(margins, usdt_thb, custom_rub_usdt, amounts, operations=None, max_size: int = None) -> dict:
+    """
+    Свип сетки для операций брокера
+
+    Args:
+        margins, usdt_thb, custom_rub_usdt, amounts: Оси сетки (см. grid_axis)
+        operations: Список 'scenario/direction' (по умолчанию все 8)
+        max_size: Ограничение на число узлов сетки
+
+    Returns:
+        dict: axes - значения осей; operations[op] - массивы формы (маржа, USDT-THB, RUB-USDT, сумма):
+              final_rate, profit_usdt, profit_percent_actual (None - расчёт невозможен);
+              breakeven_margin (форма без оси маржи) - минимальная маржа сетки с profit_usdt >= 0;
+              breakeven_amount (форма без оси суммы) - минимальная сумма сетки с profit_usdt >= 0
+
+    Raises:
+        ValueError: Некорректные оси, неизвестная операция или слишком большая сетка
+    """
+    axes = [grid_axis(margins, 'profit_margin'), grid_axis(usdt_thb, 'usdt_thb'),
+            grid_axis(custom_rub_usdt, 'custom_rub_usdt'), grid_axis(amounts, 'amount')]
+    if not np.all(axes[3] > 0):
+        raise ValueError("'amount' must be positive")
+    shape = tuple(len(axis) for axis in axes)
+    size = int(np.prod(shape))
+    if max_size is not None and size > max_size:
+        raise ValueError(f'Grid too large ({size} points, max {max_size})')
+    names = list(operations) if operations else list(BROKER_OPERATIONS)
+    unknown = [name for name in names if name not in BROKER_OPERATIONS]
+    if unknown:
+        raise ValueError(f"Unknown operations: {', '.join(unknown)}")
+
+    M, U, R, A = (grid.ravel() for grid in np.meshgrid(*axes, indexing='ij'))
+    results = {}
+    for name in names:
+        final_rate, profit_usdt, profit_percent_actual, failed = _evaluate(BROKER_OPERATIONS[name], M, U, R, A)
+        final_rate, profit_usdt, profit_percent_actual, failed = (
+            a.reshape(shape) for a in (final_rate, profit_usdt, profit_percent_actual, failed))
+        profitable = ~failed & (profit_usdt >= 0)
+        margin_index = _first_index(profitable, axis=0)
+        amount_index = _first_index(profitable, axis=3)
+        results[name] = {
+            'final_rate': _to_list(final_rate, failed),
+            'profit_usdt': _to_list(profit_usdt, failed),
+            'profit_percent_actual': _to_list(profit_percent_actual, failed),
+            'breakeven_margin': _to_list(axes[0][margin_index], margin_index < 0),
+            'breakeven_amount': _to_list(axes[3][amount_index], amount_index < 0),
+        }
+    return {
+        'shape': list(shape),
+        'axes': dict(zip(AXES, (axis.tolist() for axis in axes))),
+        'operations': results
+    }
+
+
+def solve_margin(operation: str, usdt_thb: float, custom_rub_usdt: float, amount: float, target_rate: float,
+                 min_margin: float = SOLVE_MIN_MARGIN, max_margin: float = SOLVE_MAX_MARGIN,
+                 step: float = SOLVE_STEP) -> dict:
+    """
+    Максимальная маржа, при которой итоговый курс клиента не хуже target_rate
+
+    Все маржи диапазона с шагом step считаются одним векторным проходом.
+    Курс «хуже» для клиента в ту сторону, куда он движется с ростом маржи.
+    Если курс недостижим в диапазоне, возвращается маржа с ближайшим курсом (reached=False).
+
+    Returns:
+        dict: profit_margin, final_rate, profit_usdt, profit_percent_actual, reached, exact,
+              result - полный расчёт калькулятора брокера при найденной марже
+
+    Raises:
+        ValueError: Неизвестная операция или некорректные параметры
+    """
+    if operation not in BROKER_OPERATIONS:
+        raise ValueError(f'Unknown operation: {operation}')
+    if not amount > 0 or not target_rate > 0:
+        raise ValueError('amount and target_rate must be positive')
+    margins = grid_axis({'from': min_margin, 'to': max_margin, 'step': step}, 'profit_margin')
+    n = len(margins)
+    final_rate, profit_usdt, profit_percent_actual, failed = _evaluate(
+        BROKER_OPERATIONS[operation], margins, np.full(n, float(usdt_thb)), np.full(n, float(custom_rub_usdt)),
+        np.full(n, float(amount)))
+    valid = np.flatnonzero(~failed)
+    if valid.size == 0:
+        raise ValueError('Calculation error for every margin in range')
+
+    rising = final_rate[valid[-1]] >= final_rate[valid[0]]
+    acceptable = ~failed & ((final_rate <= target_rate) if rising else (final_rate >= target_rate))
+    if acceptable.any():
+        i = int(np.flatnonzero(acceptable)[-1])
+    else:
+        i = int(valid[np.argmin(np.abs(final_rate[valid] - target_rate))])
+
+    margin = float(margins[i])
+    scenario, direction = operation.split('/')
+    calculator = BrokerCalculatorDetailed(float(usdt_thb), float(custom_rub_usdt), margin)
+    return {
+        'profit_margin': margin,
+        'final_rate': float(final_rate[i]),
+        'profit_usdt': float(profit_usdt[i]),
+        'profit_percent_actual': float(profit_percent_actual[i]),
+        'reached': bool(acceptable[i]),
+        'exact': bool(final_rate[i] == target_rate),
+        'result': resolve('broker', scenario, direction).func(calculator, float(amount))
+    }
+
+
+if __name__ == '__main__':
+    # Сверка свипа со скалярным калькулятором и замер скорости
+    import random
+    import time
+
+    rnd = random.Random(3)
+    margins = {'from': 0.5, 'to': 6.0, 'step': 0.05}
+    rates = [30.5, 31.12, 33.8]
+    customs = [78.0, 80.9, 84.25]
+    amounts = sorted({round(rnd.uniform(1, 2_000_000), rnd.randint(0, 2)) for _ in range(200)} | {10, 50, 100, 1000})
+
+    started = time.perf_counter()
+    result = sweep(margins, rates, customs, amounts)
+    elapsed = time.perf_counter() - started
+    axes = result['axes']
+    points = int(np.prod(result['shape'])) * len(result['operations'])
+
+    mismatches = checked = 0
+    for name, data in result['operations'].items():
+        scenario, direction = name.split('/')
+        func = resolve('broker', scenario, direction).func
+        for _ in range(500):
+            idx = [rnd.randrange(len(axes[axis])) for axis in AXES]
+            m, u, r, a = (axes[axis][j] for axis, j in zip(AXES, idx))
+            try:
+                expected = func(BrokerCalculatorDetailed(u, r, m), a)
+            except ZeroDivisionError:
+                expected = None
+            cell = data['final_rate'][idx[0]][idx[1]][idx[2]][idx[3]]
+            pct = data['profit_percent_actual'][idx[0]][idx[1]][idx[2]][idx[3]]
+            checked += 1
+            if expected is None:
+                mismatches += cell is not None
+            elif cell != expected['final_rate'] or pct != expected['profit_percent_actual']:
+                mismatches += 1
+    print(f"{'✅' if not mismatches else '❌'} {points} grid points in {elapsed * 1000:.0f} ms, "
+          f"{checked} checked, {mismatches} mismatches")
+
+    for name in BROKER_OPERATIONS:
+        base = BrokerCalculatorDetailed(31.12, 80.9, 3.3)
+        scenario, direction = name.split('/')
+        target = resolve('broker', scenario, direction).func(base, 100000)['final_rate']
+        started = time.perf_counter()
+        solved = solve_margin(name, 31.12, 80.9, 100000, target)
+        print(f"  {name}: rate {target} -> margin {solved['profit_margin']} "
+              f"(rate {solved['final_rate']}, reached={solved['reached']}, "
+              f"{(time.perf_counter() - started) * 1000:.1f} ms)")
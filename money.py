@@ -0,0 +1,131 @@
+"""
+Денежное округление для всех калькуляторов
+Округление как в Excel (0.5 всегда вверх, от нуля) на масштабированных целых числах
+"""
+
+import math
+from decimal import Decimal, ROUND_HALF_UP
+
+import numpy as np
+
+# 10^d для допустимых знаков после запятой (точные степени десяти в float)
+_SCALES = [10.0 ** d for d in range(16)]
+# Дальше 2^52 у float нет дробной части - округлять нечего, решает десятичная запись
+_MAX_SCALED = 2.0 ** 52
+
+
+def excel_round_decimal(value, decimals=2) -> float:
+    """
+    Эталонное округление через десятичную запись числа (как исторически в калькуляторах)
+    Медленное, используется только для пограничных значений
+    """
+    d = Decimal(str(value))
+    if decimals == 0:
+        return float(d.quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    else:
+        places = Decimal(10) ** -decimals
+        return float(d.quantize(places, rounding=ROUND_HALF_UP))
+
+
+def _is_tie(scaled: float, frac: float) -> bool:
+    # Дробная часть в пределах погрешности от 0.5: результат зависит от десятичной записи числа
+    return abs(frac - 0.5) <= scaled * 1e-12 + 1e-9
+
+
+def excel_round(value, decimals=2) -> float:
+    """
+    Округление как в Excel (коммерческое округление)
+    0.5 всегда округляется вверх
+
+    |value|·10^d раскладывается на целую часть и остаток, половина решается явно.
+    Целое до 2^52, делённое на точную степень десяти, даёт тот же float,
+    что и Decimal.quantize, поэтому результат совпадает с excel_round_decimal побитово.
+    """
+    if decimals >= len(_SCALES):
+        return excel_round_decimal(value, decimals)
+    scale = _SCALES[decimals]
+    scaled = abs(value) * scale
+    if not scaled < _MAX_SCALED:
+        # Огромные числа, inf и nan - как раньше (Decimal поднимет ошибку для inf/nan)
+        return excel_round_decimal(value, decimals)
+    units = math.floor(scaled)
+    frac = scaled - units
+    if _is_tie(scaled, frac):
+        return excel_round_decimal(value, decimals)
+    if frac > 0.5:
+        units += 1
+    return math.copysign(units / scale, value)
+
+
+def excel_round_array(values, decimals=2) -> np.ndarray:
+    """
+    excel_round для массива NumPy
+
+    Пограничные значения считаются скалярным эталоном, inf/nan остаются nan.
+    """
+    x = np.asarray(values, dtype=np.float64)
+    scale = _SCALES[decimals]
+    with np.errstate(invalid='ignore', over='ignore'):
+        scaled = np.abs(x) * scale
+        units = np.floor(scaled)
+        frac = scaled - units
+        result = np.copysign((units + (frac > 0.5)) / scale, x)
+        finite = np.isfinite(scaled)
+        ambiguous = finite & ((np.abs(frac - 0.5) <= scaled * 1e-12 + 1e-9) | (scaled >= _MAX_SCALED))
+    result[~finite] = np.nan
+    for i in np.flatnonzero(ambiguous):
+        result.flat[i] = excel_round_decimal(float(x.flat[i]), decimals)
+    return result
+
+
+if __name__ == '__main__':
+    # Эталонная сверка: все операции калькуляторов с новым и старым округлением
+    import random
+    import time
+
+    import broker_detailed
+    import calculator
+
+    rnd = random.Random(7)
+    values = [rnd.randint(-10 ** 9, 10 ** 9) / 10 ** rnd.randint(0, 7) for _ in range(200000)]
+    values += [v + 0.005 for v in values[:50000]] + [0.125, 2.675, 1.005, 0.0, -0.0, -0.004, 1e17]
+    for d in (0, 2, 4, 6):
+        bad = [v for v in values if repr(excel_round(v, d)) != repr(excel_round_decimal(v, d))]
+        print(f"{'✅' if not bad else '❌'} decimals={d}: {len(bad)} mismatches {bad[:3]}")
+
+    # Эталонные случаи из CSV брокера + случайные суммы
+    rates = [(31.12, 80.90), (32.45, 78.3), (35.20, 86.50)]
+    amounts = [2741.18, 979.21, 1000, 5000, 10000, 100000, 500000, 1000000]
+    amounts += [round(rnd.uniform(10, 2_000_000), 2) for _ in range(500)]
+    margins = [None, 1.5, 2.0, 2.4, 3.0, 3.5, 4.0, 4.5, 5.0, 2.7, 6.0]
+
+    def run_all():
+        out = []
+        for usdt_thb, rub_usdt in rates:
+            calc = calculator.ExchangeCalculator(usdt_thb, rub_usdt)
+            broker = calculator.BrokerCalculator(usdt_thb, rub_usdt)
+            for amount in amounts:
+                for margin in margins:
+                    for name in ('rub_to_thb', 'rub_to_thb_target', 'thb_to_usdt', 'thb_to_usdt_target',
+                                 'usdt_to_thb', 'usdt_to_thb_target', 'rub_to_usdt_target', 'rub_to_usdt_amount'):
+                        out.append(getattr(calc, name)(amount, custom_profit_margin=margin))
+                    detailed = broker_detailed.BrokerCalculatorDetailed(usdt_thb, rub_usdt, margin or 4.0)
+                    for name in ('rub_to_thb_target', 'rub_to_thb_amount', 'thb_to_usdt_target',
+                                 'thb_to_usdt_amount', 'usdt_to_thb_target', 'usdt_to_thb_amount',
+                                 'rub_to_usdt_target', 'rub_to_usdt_amount'):
+                        out.append(getattr(detailed, name)(amount))
+                for name in ('rub_to_thb_target', 'rub_to_thb_amount', 'thb_to_usdt_target', 'thb_to_usdt_amount',
+                             'usdt_to_thb_target', 'usdt_to_thb_amount'):
+                    out.append(getattr(broker, name)(amount))
+        return out
+
+    started = time.perf_counter()
+    fast = run_all()
+    fast_time = time.perf_counter() - started
+    calculator.excel_round = broker_detailed.excel_round = excel_round_decimal
+    started = time.perf_counter()
+    reference = run_all()
+    reference_time = time.perf_counter() - started
+    mismatches = sum(1 for a, b in zip(fast, reference) if repr(a) != repr(b))
+    print(f"{'✅' if not mismatches else '❌'} {len(fast)} operations: {mismatches} mismatches, "
+          f"{fast_time:.2f}s vs {reference_time:.2f}s (Decimal)")
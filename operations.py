@@ -0,0 +1,114 @@
+"""
+Реестр операций калькулятора
+(method, scenario, direction) -> операция с объявленными входами и выходами.
+Калькуляторы кэшируются по версии курсов, кастомному курсу и марже.
+"""
+
+from functools import lru_cache
+
+from batch_calculator import OPERATIONS as VECTOR_OPERATIONS
+from broker_detailed import BrokerCalculatorDetailed
+from calculator import ExchangeCalculator
+
+METHODS = ('doverka', 'broker')
+DIRECTIONS = ('amount', 'target')
+
+
+class Operation:
+    """Одна операция калькулятора"""
+
+    __slots__ = ('method', 'scenario', 'direction', 'func', 'inputs', 'amount_field', 'result_field',
+                 'vectorized')
+
+    def __init__(self, method: str, scenario: str, direction: str, func, amount_field: str, result_field: str):
+        """
+        Args:
+            method: 'doverka' или 'broker'
+            scenario: Пара обмена, например 'rub-to-thb'
+            direction: 'amount' (клиент вносит сумму) или 'target' (клиент хочет получить сумму)
+            func: Метод калькулятора
+            amount_field: Поле результата, в которое попадает введённая сумма
+            result_field: Поле результата со второй стороной сделки (что клиент получит или заплатит)
+        """
+        self.method = method
+        self.scenario = scenario
+        self.direction = direction
+        self.func = func
+        self.inputs = ('amount', 'profit_margin', 'custom_rub_usdt') if method == 'broker' else ('amount', 'profit_margin')
+        self.amount_field = amount_field
+        self.result_field = result_field
+        self.vectorized = VECTOR_OPERATIONS[(method, scenario, direction)]
+
+    @property
+    def key(self) -> tuple:
+        return self.method, self.scenario, self.direction
+
+    def calculator(self, snapshot, custom_rub_usdt: float = None, profit_margin: float = None, tables=None):
+        """Калькулятор для снапшота курсов (из кэша); с tables - отдельный, на этих таблицах комиссий"""
+        if self.method == 'broker':
+            return _broker_calculator(snapshot.version, snapshot.usdt_thb, custom_rub_usdt, profit_margin)
+        if tables is not None:
+            return ExchangeCalculator(snapshot.usdt_thb, snapshot.rub_usdt, tables)
+        return _exchange_calculator(snapshot.version, snapshot.usdt_thb, snapshot.rub_usdt)
+
+    def run(self, calculator, amount: float, profit_margin: float = None) -> dict:
+        # У брокера маржа заложена в калькулятор, у Doverka передаётся в операцию
+        if self.method == 'broker':
+            return self.func(calculator, amount)
+        return self.func(calculator, amount, custom_profit_margin=profit_margin)
+
+
+@lru_cache(maxsize=64)
+def _exchange_calculator(version: int, usdt_thb: float, rub_usdt: float) -> ExchangeCalculator:
+    return ExchangeCalculator(usdt_thb, rub_usdt)
+
+
+@lru_cache(maxsize=1024)
+def _broker_calculator(version: int, usdt_thb: float, custom_rub_usdt: float,
+                       profit_margin: float) -> BrokerCalculatorDetailed:
+    return BrokerCalculatorDetailed(usdt_thb, custom_rub_usdt, profit_margin)
+
+
+OPERATIONS = {}
+
+
+def register(operation: Operation):
+    OPERATIONS[operation.key] = operation
+    return operation
+
+
+for _method, _calc, _table in (
+    ('doverka', ExchangeCalculator, [
+        ('rub-to-thb', 'amount', 'rub_to_thb', 'rub_amount', 'thb_received'),
+        ('rub-to-thb', 'target', 'rub_to_thb_target', 'thb_target', 'rub_amount'),
+        ('thb-to-usdt', 'amount', 'thb_to_usdt', 'thb_amount', 'usdt_received'),
+        ('thb-to-usdt', 'target', 'thb_to_usdt_target', 'usdt_target', 'thb_amount'),
+        ('usdt-to-thb', 'amount', 'usdt_to_thb', 'usdt_amount', 'thb_received'),
+        ('usdt-to-thb', 'target', 'usdt_to_thb_target', 'thb_target', 'usdt_amount'),
+        ('rub-to-usdt', 'amount', 'rub_to_usdt_amount', 'rub_amount', 'usdt_received'),
+        ('rub-to-usdt', 'target', 'rub_to_usdt_target', 'usdt_target', 'rub_amount'),
+    ]),
+    ('broker', BrokerCalculatorDetailed, [
+        ('rub-to-thb', 'amount', 'rub_to_thb_amount', 'rub_amount', 'thb_received'),
+        ('rub-to-thb', 'target', 'rub_to_thb_target', 'thb_target', 'rub_amount'),
+        ('thb-to-usdt', 'amount', 'thb_to_usdt_amount', 'thb_amount', 'usdt_received'),
+        ('thb-to-usdt', 'target', 'thb_to_usdt_target', 'usdt_target', 'thb_amount'),
+        ('usdt-to-thb', 'amount', 'usdt_to_thb_amount', 'usdt_amount', 'thb_received'),
+        ('usdt-to-thb', 'target', 'usdt_to_thb_target', 'thb_target', 'usdt_amount'),
+        ('rub-to-usdt', 'amount', 'rub_to_usdt_amount', 'rub_amount', 'usdt_received'),
+        ('rub-to-usdt', 'target', 'rub_to_usdt_target', 'usdt_target', 'rub_amount'),
+    ]),
+):
+    for _scenario, _direction, _name, _amount_field, _result_field in _table:
+        register(Operation(_method, _scenario, _direction, getattr(_calc, _name), _amount_field, _result_field))
+
+
+def resolve(method: str, scenario: str, direction: str) -> Operation:
+    """
+    Операция по параметрам запроса или None, если сценарий не поддерживается
+
+    Как и раньше, всё кроме 'broker' считается Doverka, всё кроме 'target' - amount.
+    """
+    method = 'broker' if method == 'broker' else 'doverka'
+    direction = 'target' if direction == 'target' else 'amount'
+    return OPERATIONS.get((method, scenario, direction))
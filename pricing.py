@@ -0,0 +1,191 @@
+"""
+Таблицы ценообразования Doverka
+Уровни комиссий по сумме и кривая маржа -> комиссия USDT-THB компилируются один раз
+в отсортированные массивы (поиск через bisect) и подменяются атомарно при изменении в БД
+"""
+
+import math
+import os
+import threading
+import time
+from bisect import bisect_right
+from functools import lru_cache
+
+import numpy as np
+
+from money import excel_round
+
+# Выдача THB: процент от суммы обмена + фиксированная комиссия
+THB_WITHDRAWAL_PERCENT = 0.0025
+THB_WITHDRAWAL_FIXED = 20
+
+
+@lru_cache(maxsize=1024)
+def thb_payout_leg(thb_target: float):
+    """
+    Сколько THB нужно обменять, чтобы после комиссий выдачи клиент получил thb_target
+
+    Общая часть всех операций «хочу получить THB» (Doverka и брокер),
+    поэтому результат запоминается по сумме.
+
+    Returns:
+        tuple: (thb_to_exchange, withdrawal_percent_fee)
+    """
+    thb_to_exchange = (thb_target + THB_WITHDRAWAL_FIXED) / (1 - THB_WITHDRAWAL_PERCENT)
+    return thb_to_exchange, excel_round(thb_to_exchange - thb_target - THB_WITHDRAWAL_FIXED, 2)
+
+
+class PricingTables:
+    """Скомпилированные таблицы (неизменяемые, заменяются целиком)"""
+
+    __slots__ = ('version', 'levels', 'margin_curve', 'level_names', 'level_params', 'level_mins', 'level_maxs',
+                 'curve_xs', 'curve_ys', 'above', 'below', 'arrays')
+
+    def __init__(self, levels: dict, margin_curve: dict, version: int = 0):
+        """
+        Args:
+            levels: {название: {'min', 'max', 'usdt_thb_commission', 'bonus_percent', ...}}, max=None - без границы
+            margin_curve: {маржа %: комиссия USDT-THB}, между точками - линейная интерполяция
+            version: Версия таблиц (id строки в pricing_versions, 0 - значения из кода)
+
+        Raises:
+            ValueError: Таблицы пустые, уровни пересекаются или не хватает полей
+        """
+        if not levels or len(margin_curve) < 2:
+            raise ValueError('Pricing needs at least one level and two margin curve points')
+        items = []
+        for name, params in levels.items():
+            params = dict(params)
+            for field in ('min', 'usdt_thb_commission', 'bonus_percent'):
+                if not isinstance(params.get(field), (int, float)):
+                    raise ValueError(f"Level '{name}': '{field}' must be a number")
+            if params.get('max') is None:
+                params['max'] = float('inf')
+            if not params['min'] < params['max']:
+                raise ValueError(f"Level '{name}': min must be below max")
+            items.append((name, params))
+        items.sort(key=lambda item: item[1]['min'])
+        for (name, params), (next_name, next_params) in zip(items, items[1:]):
+            if params['max'] > next_params['min']:
+                raise ValueError(f"Levels '{name}' and '{next_name}' overlap")
+
+        curve = {float(x): float(y) for x, y in margin_curve.items()}
+        if not all(math.isfinite(x) and math.isfinite(y) for x, y in curve.items()):
+            raise ValueError('Margin curve must contain finite numbers')
+
+        self.version = version
+        self.levels = dict(items)
+        self.margin_curve = curve
+        self.level_names = [name for name, _ in items]
+        self.level_params = [params for _, params in items]
+        self.level_mins = [params['min'] for params in self.level_params]
+        self.level_maxs = [params['max'] for params in self.level_params]
+        points = sorted(curve.items())
+        self.curve_xs = [x for x, _ in points]
+        self.curve_ys = [y for _, y in points]
+        # За пределами кривой - крайние значения
+        self.above = self.curve_ys[-1]
+        self.below = self.curve_ys[0]
+        # Те же таблицы для пакетного расчёта
+        self.arrays = {
+            'level_mins': np.array(self.level_mins, dtype=np.float64),
+            'level_maxs': np.array(self.level_maxs, dtype=np.float64),
+            'level_usdt_thb_commission': np.array([p['usdt_thb_commission'] for p in self.level_params]),
+            'level_bonus_percent': np.array([p['bonus_percent'] for p in self.level_params]),
+            'curve_xs': np.array(self.curve_xs),
+            'curve_ys': np.array(self.curve_ys),
+        }
+
+    def level(self, rub_amount: float):
+        """
+        Уровень комиссий по сумме в рублях
+
+        Returns:
+            tuple: (название_уровня, параметры_комиссий); вне всех уровней - последний
+        """
+        i = bisect_right(self.level_mins, rub_amount) - 1
+        if i >= 0 and rub_amount < self.level_maxs[i]:
+            return self.level_names[i], self.level_params[i]
+        return self.level_names[-1], self.level_params[-1]
+
+    def usdt_commission(self, target_profit: float) -> float:
+        """Комиссия USDT-THB для желаемой маржи (точная точка кривой или интерполяция)"""
+        commission = self.margin_curve.get(target_profit)
+        if commission is not None:
+            return commission
+        xs = self.curve_xs
+        i = bisect_right(xs, target_profit) - 1
+        if 0 <= i < len(xs) - 1:
+            x1, y1 = xs[i], self.curve_ys[i]
+            x2, y2 = xs[i + 1], self.curve_ys[i + 1]
+            return y1 + (y2 - y1) * (target_profit - x1) / (x2 - x1)
+        return self.above if target_profit > xs[-1] else self.below
+
+    def to_dict(self) -> dict:
+        levels = {}
+        for name, params in self.levels.items():
+            params = dict(params)
+            if params['max'] == float('inf'):
+                params['max'] = None
+            levels[name] = params
+        return {
+            'version': self.version,
+            'levels': levels,
+            'margin_curve': {str(x): y for x, y in sorted(self.margin_curve.items())}
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict, version: int = 0) -> 'PricingTables':
+        return cls(data['levels'], data['margin_curve'], version)
+
+
+class PricingStore:
+    """Текущие таблицы воркера + периодическая сверка версии с БД"""
+
+    def __init__(self, tables: PricingTables, reload_interval: float = None):
+        """
+        Args:
+            tables: Таблицы по умолчанию (из кода)
+            reload_interval: Как часто проверять новую версию в БД (PRICING_RELOAD_INTERVAL, по умолчанию 10 с)
+        """
+        self.defaults = tables
+        self.reload_interval = reload_interval if reload_interval is not None else \
+            float(os.getenv('PRICING_RELOAD_INTERVAL', 10))
+        self._tables = tables
+        self._loader = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def set_loader(self, loader):
+        """
+        loader(version) -> (version, data) если в БД есть другая версия, иначе None
+        Без загрузчика работают таблицы из кода
+        """
+        self._loader = loader
+        self._checked_at = 0.0
+
+    def current(self) -> PricingTables:
+        """Актуальные таблицы; версия в БД сверяется не чаще reload_interval"""
+        if self._loader is not None and time.monotonic() - self._checked_at > self.reload_interval:
+            self.reload()
+        return self._tables
+
+    def reload(self):
+        # Сверяет один поток, остальные работают с текущими таблицами
+        if not self._lock.acquire(blocking=False):
+            return
+        try:
+            self._checked_at = time.monotonic()
+            found = self._loader(self._tables.version)
+            if found is not None:
+                version, data = found
+                self._tables = PricingTables.from_dict(data, version)
+                print(f"💱 Pricing tables v{version} loaded")
+        except Exception as e:
+            print(f"⚠️ Pricing reload error: {e}")
+        finally:
+            self._lock.release()
+
+    def publish(self, tables: PricingTables):
+        """Сразу переключить этот воркер (остальные подхватят из БД)"""
+        self._tables = tables
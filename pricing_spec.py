@@ -0,0 +1,499 @@
+"""
+Спецификация ценообразования для расчёта в браузере
+Формулы не переписываются руками: исходный код методов калькуляторов переводится
+в JSON-дерево выражений, к нему добавляются таблицы комиссий, округление и снапшот курсов.
+calculator.js считает по спецификации локально, сервер перепроверяет результат при создании сделки.
+"""
+
+import ast
+import hashlib
+import inspect
+import json
+import textwrap
+import time
+from functools import lru_cache
+
+from broker_detailed import BrokerCalculatorDetailed
+from calculator import ExchangeCalculator
+from money import excel_round
+from operations import OPERATIONS
+
+SPEC_FORMAT = 1
+
+# Функции, которые реализованы в самих вычислителях (Python ниже и calculator.js)
+PRIMITIVES = {
+    'excel_round': 'round',              # excel_round(x, d)
+    'pricing_store.current': 'tables',   # текущие таблицы Doverka
+    'level': 'level',                    # tables.level(rub_amount) -> (название, параметры)
+    'usdt_commission': 'usdt_commission',  # tables.usdt_commission(маржа)
+    'self.commissions': 'commissions',   # пресеты брокера из CSV или default_commissions
+}
+
+_BINARY = {ast.Add: '+', ast.Sub: '-', ast.Mult: '*', ast.Div: '/'}
+_COMPARE = {ast.Gt: '>', ast.GtE: '>=', ast.Lt: '<', ast.LtE: '<=', ast.Eq: '==', ast.NotEq: '!='}
+
+# Как входы калькулятора попадают в конструктор и в операцию (см. Operation.calculator/run)
+CALCULATORS = {
+    'doverka': {'class': ExchangeCalculator, 'init_args': ['rates.usdt_thb', 'rates.rub_usdt'],
+                'op_args': ['amount', 'profit_margin']},
+    'broker': {'class': BrokerCalculatorDetailed, 'init_args': ['rates.usdt_thb', 'custom_rub_usdt', 'profit_margin'],
+               'op_args': ['amount']},
+}
+
+
+class SpecError(ValueError):
+    """Конструкция в коде калькулятора, которую спецификация не умеет выразить"""
+
+
+class _Translator:
+    """Переводит методы калькуляторов (и всё, что они вызывают) в функции спецификации"""
+
+    def __init__(self):
+        self.functions = {}
+
+    def function(self, name: str, func, owner=None) -> str:
+        """Перевести функцию и вернуть её имя в спецификации"""
+        if name in self.functions:
+            return name
+        func = inspect.unwrap(func)
+        tree = ast.parse(textwrap.dedent(inspect.getsource(func))).body[0]
+        args = [a.arg for a in tree.args.args if a.arg not in ('self', 'cls')]
+        defaults = [self._literal(d) for d in tree.args.defaults]
+        self.functions[name] = None  # защита от рекурсии
+        scope = {'name': name, 'owner': owner, 'globals': func.__globals__, 'locals': set(args)}
+        body = self._block(tree.body, scope)
+        self.functions[name] = {
+            'params': args,
+            'defaults': dict(zip(args[len(args) - len(defaults):], defaults)),
+            'body': body
+        }
+        return name
+
+    def _literal(self, node):
+        if isinstance(node, ast.Constant) and (node.value is None or isinstance(node.value, (int, float))):
+            return node.value
+        raise SpecError(f'Unsupported default value at line {node.lineno}')
+
+    def _fail(self, node, scope):
+        raise SpecError(f"{scope['name']}: unsupported {type(node).__name__} at line {getattr(node, 'lineno', '?')}")
+
+    # --- Инструкции ---
+
+    def _block(self, statements, scope) -> list:
+        out = []
+        for node in statements:
+            if isinstance(node, ast.Expr) and isinstance(node.value, ast.Constant):
+                continue  # docstring
+            out.append(self._statement(node, scope))
+        return out
+
+    def _statement(self, node, scope):
+        if isinstance(node, ast.Assign) and len(node.targets) == 1:
+            target = node.targets[0]
+            value = self._expr(node.value, scope)
+            if isinstance(target, ast.Tuple):
+                names = [self._target(t, scope) for t in target.elts]
+                return ['set', names, value]
+            return ['set', self._target(target, scope), value]
+        if isinstance(node, ast.Return):
+            return ['return', self._expr(node.value, scope)]
+        if isinstance(node, ast.If):
+            return ['when', self._expr(node.test, scope), self._block(node.body, scope),
+                    self._block(node.orelse, scope)]
+        self._fail(node, scope)
+
+    def _target(self, node, scope) -> str:
+        if isinstance(node, ast.Name):
+            scope['locals'].add(node.id)
+            return node.id
+        if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'self':
+            return f'self.{node.attr}'
+        self._fail(node, scope)
+
+    # --- Выражения ---
+
+    def _expr(self, node, scope):
+        if isinstance(node, ast.Constant):
+            if node.value is None:
+                return ['null']
+            if isinstance(node.value, str):
+                return ['str', node.value]
+            if isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+                return node.value
+        elif isinstance(node, ast.Name):
+            if node.id in scope['locals']:
+                return node.id
+            value = scope['globals'].get(node.id)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                return value  # константа модуля
+        elif isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id == 'self':
+            return f'self.{node.attr}'
+        elif isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            return [_BINARY[type(node.op)], self._expr(node.left, scope), self._expr(node.right, scope)]
+        elif isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return ['neg', self._expr(node.operand, scope)]
+        elif isinstance(node, ast.Compare) and len(node.ops) == 1:
+            op, right = node.ops[0], node.comparators[0]
+            left = self._expr(node.left, scope)
+            if isinstance(op, (ast.Is, ast.IsNot)) and isinstance(right, ast.Constant) and right.value is None:
+                return ['is_null' if isinstance(op, ast.Is) else 'not_null', left]
+            if type(op) in _COMPARE:
+                return [_COMPARE[type(op)], left, self._expr(right, scope)]
+        elif isinstance(node, ast.IfExp):
+            return ['if', self._expr(node.test, scope), self._expr(node.body, scope), self._expr(node.orelse, scope)]
+        elif isinstance(node, ast.JoinedStr):
+            parts = []
+            for value in node.values:
+                if isinstance(value, ast.FormattedValue) and value.conversion == -1 and value.format_spec is None:
+                    parts.append(['fmt', self._expr(value.value, scope)])
+                elif isinstance(value, ast.Constant):
+                    parts.append(['str', value.value])
+                else:
+                    self._fail(value, scope)
+            return ['concat'] + parts
+        elif isinstance(node, ast.Tuple):
+            return ['tuple'] + [self._expr(e, scope) for e in node.elts]
+        elif isinstance(node, ast.Dict) and all(isinstance(k, ast.Constant) for k in node.keys):
+            return ['dict', [[k.value, self._expr(v, scope)] for k, v in zip(node.keys, node.values)]]
+        elif isinstance(node, ast.Subscript):
+            return ['get', self._expr(node.value, scope), self._expr(node.slice, scope)]
+        elif isinstance(node, ast.Call) and not node.keywords:
+            return self._call(node, scope)
+        self._fail(node, scope)
+
+    def _call(self, node, scope):
+        args = [self._expr(a, scope) for a in node.args]
+        func = node.func
+        if isinstance(func, ast.Name):
+            if func.id in PRIMITIVES:
+                return ['call', PRIMITIVES[func.id]] + args
+            target = scope['globals'].get(func.id)
+            if callable(target):
+                return ['call', self.function(func.id, target)] + args
+        elif isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name):
+            dotted = f'{func.value.id}.{func.attr}'
+            if dotted in PRIMITIVES:
+                return ['call', PRIMITIVES[dotted]] + args
+            if func.value.id in scope['locals'] and func.attr in PRIMITIVES:
+                # Метод таблиц: первым аргументом идёт сам объект
+                return ['call', PRIMITIVES[func.attr], func.value.id] + args
+            owner = scope['owner']
+            if func.value.id in ('self', 'cls') and owner is not None and hasattr(owner, func.attr):
+                name = f'{owner.__name__}.{func.attr}'
+                return ['call', self.function(name, getattr(owner, func.attr), owner)] + args
+        self._fail(node, scope)
+
+
+@lru_cache(maxsize=1)
+def formulas() -> dict:
+    """Функции, калькуляторы и операции (зависят только от кода, переводятся один раз)"""
+    translator = _Translator()
+    calculators = {}
+    for method, info in CALCULATORS.items():
+        cls = info['class']
+        calculators[method] = {
+            'init': translator.function(f'{cls.__name__}.__init__', cls.__init__, cls),
+            'init_args': info['init_args'],
+            'op_args': info['op_args']
+        }
+    # Пресеты брокера выбирает примитив commissions, общая формула - из кода
+    translator.function('BrokerCalculatorDetailed.default_commissions',
+                        BrokerCalculatorDetailed.default_commissions, BrokerCalculatorDetailed)
+    operations = {}
+    for operation in OPERATIONS.values():
+        cls = CALCULATORS[operation.method]['class']
+        operations['/'.join(operation.key)] = {
+            'function': translator.function(f'{cls.__name__}.{operation.func.__name__}', operation.func, cls),
+            'amount_field': operation.amount_field,
+            'result_field': operation.result_field
+        }
+    return {'functions': translator.functions, 'calculators': calculators, 'operations': operations}
+
+
+@lru_cache(maxsize=8)
+def compile_spec(tables) -> dict:
+    """
+    Спецификация без курсов для версии таблиц (PricingTables неизменяемы - кэш по объекту)
+
+    Перед выдачей спецификация сверяется с калькуляторами на контрольных суммах:
+    расхождение означает, что в коде появилась конструкция, которую вычислитель понимает иначе.
+    """
+    spec = dict(formulas())
+    spec['tables'] = tables.to_dict()
+    spec['broker_presets'] = {
+        'levels': [[level, list(values)] for level, values in BrokerCalculatorDetailed.PRESETS.items()],
+        'tolerance': BrokerCalculatorDetailed.PRESET_TOLERANCE,
+        'default': 'BrokerCalculatorDetailed.default_commissions'
+    }
+    spec['primitives'] = sorted(set(PRIMITIVES.values()))
+    spec['rounding'] = {
+        'mode': 'half_up',
+        'reference': 'Decimal(repr(x)).quantize(10**-d, ROUND_HALF_UP)',
+        'tie_tolerance': 'abs(frac - 0.5) <= scaled * 1e-12 + 1e-9',
+        'max_scaled': 2.0 ** 52
+    }
+    spec['format'] = SPEC_FORMAT
+    digest = hashlib.sha1(json.dumps(spec, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+    spec['spec_version'] = digest[:16]
+    drift = self_check(spec, tables)
+    if drift:
+        raise SpecError(f'Pricing spec drift: {drift[:5]}')
+    return spec
+
+
+@lru_cache(maxsize=8)
+def available_spec(tables):
+    """
+    compile_spec или None, если спецификацию собрать нельзя (клиент тогда считает через API)
+
+    Ошибка перевода или сверки тоже кэшируется: калькуляторы не переводятся заново на каждый запрос.
+    """
+    try:
+        return compile_spec(tables)
+    except Exception as e:
+        print(f"⚠️ Pricing spec disabled for tables v{tables.version}: {e}")
+        return None
+
+
+def build_pricing_spec(snapshot, tables, ttl: float, stale: bool = False):
+    """Спецификация для клиента: формулы и таблицы + снапшот курсов и срок действия (None - недоступна)"""
+    compiled = available_spec(tables)
+    if compiled is None:
+        return None
+    now = time.time()
+    spec = dict(compiled)
+    spec['rates'] = {
+        'usdt_thb': snapshot.usdt_thb, 'rub_usdt': snapshot.rub_usdt,
+        'version': snapshot.version, 'fetched_at': snapshot.fetched_at, 'stale': stale
+    }
+    spec['issued_at'] = now
+    spec['expires_at'] = now + ttl
+    return spec
+
+
+def compare_results(client: dict, server: dict) -> list:
+    """Числовые поля, в которых результат клиента расходится с пересчётом на сервере"""
+    mismatched = []
+    for field, value in server.items():
+        if field not in client or isinstance(value, (str, bool)) or value is None:
+            continue
+        theirs = client[field]
+        if not isinstance(theirs, (int, float)) or isinstance(theirs, bool) or float(theirs) != float(value):
+            mismatched.append(field)
+    return mismatched
+
+
+# ==================== ВЫЧИСЛИТЕЛЬ ====================
+# Эталон для calculator.js (evaluateSpec): та же семантика, что в браузере
+
+def py_float_str(value) -> str:
+    """Числа в строках форматируются как float в Python (3.0, а не 3)"""
+    return repr(float(value))
+
+
+class _Return(Exception):
+    def __init__(self, value):
+        self.value = value
+
+
+class SpecEvaluator:
+    """Выполняет операции спецификации"""
+
+    def __init__(self, spec: dict):
+        self.spec = spec
+        self.functions = spec['functions']
+        levels = sorted(spec['tables']['levels'].items(), key=lambda item: item[1]['min'])
+        self.levels = [(name, params) for name, params in levels]
+        self.curve = sorted((float(x), y) for x, y in spec['tables']['margin_curve'].items())
+
+    def calculate(self, method: str, scenario: str, direction: str, inputs: dict) -> dict:
+        """
+        Args:
+            inputs: amount, profit_margin, custom_rub_usdt (как после разбора запроса /api/calculate)
+        """
+        calculator = self.spec['calculators'][method]
+        operation = self.spec['operations'][f'{method}/{scenario}/{direction}']
+        values = dict(inputs)
+        values['rates.usdt_thb'] = self.spec['rates']['usdt_thb']
+        values['rates.rub_usdt'] = self.spec['rates']['rub_usdt']
+        state = self.call(calculator['init'], {}, [values[name] for name in calculator['init_args']])
+        return self.call(operation['function'], state, [values[name] for name in calculator['op_args']])
+
+    def call(self, name: str, state: dict, args: list):
+        """Вызов функции спецификации; state - поля self калькулятора. Для __init__ возвращает новые поля"""
+        func = self.functions[name]
+        env = dict(state)
+        for i, param in enumerate(func['params']):
+            env[param] = args[i] if i < len(args) else func['defaults'][param]
+        try:
+            self.run(func['body'], env)
+        except _Return as result:
+            return result.value
+        return {k: v for k, v in env.items() if k.startswith('self.')}
+
+    def run(self, statements: list, env: dict):
+        for statement in statements:
+            kind = statement[0]
+            if kind == 'set':
+                value = self.eval(statement[2], env)
+                if isinstance(statement[1], list):
+                    for target, item in zip(statement[1], value):
+                        env[target] = item
+                else:
+                    env[statement[1]] = value
+            elif kind == 'return':
+                raise _Return(self.eval(statement[1], env))
+            elif kind == 'when':
+                self.run(statement[2] if self.eval(statement[1], env) else statement[3], env)
+
+    def eval(self, node, env):
+        if isinstance(node, (int, float)):
+            return node
+        if isinstance(node, str):
+            return env[node]
+        op, args = node[0], node[1:]
+        if op == 'str':
+            return args[0]
+        if op == 'null':
+            return None
+        if op == 'if':
+            return self.eval(args[1] if self.eval(args[0], env) else args[2], env)
+        if op == 'dict':
+            return {key: self.eval(value, env) for key, value in args[0]}
+        if op == 'call':
+            values = [self.eval(a, env) for a in args[1:]]
+            if args[0] in PRIMITIVES.values():
+                return self.primitive(args[0], values)
+            return self.call(args[0], {k: v for k, v in env.items() if k.startswith('self.')}, values)
+        values = [self.eval(a, env) for a in args]
+        if op == '+':
+            return values[0] + values[1]
+        if op == '-':
+            return values[0] - values[1]
+        if op == '*':
+            return values[0] * values[1]
+        if op == '/':
+            return values[0] / values[1]
+        if op == 'neg':
+            return -values[0]
+        if op in ('>', '>=', '<', '<=', '==', '!='):
+            a, b = values
+            return {'>': a > b, '>=': a >= b, '<': a < b, '<=': a <= b, '==': a == b, '!=': a != b}[op]
+        if op == 'is_null':
+            return values[0] is None
+        if op == 'not_null':
+            return values[0] is not None
+        if op == 'fmt':
+            return py_float_str(values[0])
+        if op == 'concat':
+            return ''.join(values)
+        if op == 'tuple':
+            return tuple(values)
+        if op == 'get':
+            return values[0][values[1]]
+        raise SpecError(f'Unknown spec node: {op}')
+
+    def primitive(self, name: str, args: list):
+        if name == 'round':
+            return excel_round(*args)
+        if name == 'tables':
+            return 'tables'
+        if name == 'level':
+            # Последний уровень с min <= x, если x ниже его max (max=None - без границы), иначе последний
+            x = args[1]
+            i = sum(1 for _, params in self.levels if params['min'] <= x) - 1
+            if i >= 0 and (self.levels[i][1]['max'] is None or x < self.levels[i][1]['max']):
+                return self.levels[i]
+            return self.levels[-1]
+        if name == 'usdt_commission':
+            t = args[1]
+            for x, y in self.curve:
+                if x == t:
+                    return y
+            xs = [x for x, _ in self.curve]
+            i = sum(1 for x in xs if x <= t) - 1
+            if 0 <= i < len(xs) - 1:
+                (x1, y1), (x2, y2) = self.curve[i], self.curve[i + 1]
+                return y1 + (y2 - y1) * (t - x1) / (x2 - x1)
+            return self.curve[-1][1] if t > xs[-1] else self.curve[0][1]
+        if name == 'commissions':
+            presets = self.spec['broker_presets']
+            for level, values in presets['levels']:
+                if abs(args[0] - level) < presets['tolerance']:
+                    return tuple(values)
+            return self.call(presets['default'], {}, args)
+        raise SpecError(f'Unknown primitive: {name}')
+
+
+def self_check(spec: dict, tables, amounts=(1000, 2741.18, 979.21, 150000, 2000000),
+               margins=(None, 1.5, 2.7, 4.0, 5.0)) -> list:
+    """Сверка вычислителя спецификации с калькуляторами; возвращает список расхождений"""
+    from rate_refresher import RateSnapshot
+
+    spec = dict(spec)
+    spec['rates'] = {'usdt_thb': 35.2, 'rub_usdt': 86.5}
+    snapshot = RateSnapshot(35.2, 86.5, 0, {}, -1)
+    evaluator = SpecEvaluator(spec)
+    drift = []
+    # Калькуляторам Doverka проверяемые таблицы передаются явно - общий pricing_store не трогаем
+    for operation in OPERATIONS.values():
+        for amount in amounts:
+            for margin in margins:
+                if operation.method == 'broker':
+                    inputs = {'amount': float(amount), 'profit_margin': margin or 4.0, 'custom_rub_usdt': 80.9}
+                else:
+                    inputs = {'amount': float(amount), 'profit_margin': margin}
+                calc = operation.calculator(snapshot, inputs.get('custom_rub_usdt'), inputs['profit_margin'],
+                                            tables=tables)
+                try:
+                    expected = operation.run(calc, inputs['amount'], inputs['profit_margin'])
+                except ZeroDivisionError:
+                    expected = 'error'
+                try:
+                    actual = evaluator.calculate(*operation.key, inputs)
+                except ZeroDivisionError:
+                    actual = 'error'
+                if json.dumps(expected, sort_keys=True) != json.dumps(actual, sort_keys=True):
+                    drift.append(('/'.join(operation.key), amount, margin))
+    return drift
+
+
+if __name__ == '__main__':
+    # Сверка на случайных суммах, маржах и курсах (то же самое делает calculator.js)
+    import random
+
+    from calculator import pricing_store
+    from rate_refresher import RateSnapshot
+
+    tables = pricing_store.current()
+    spec = compile_spec(tables)
+    print(f"✅ Spec {spec['spec_version']}: {len(spec['functions'])} functions, "
+          f"{len(json.dumps(spec))} bytes")
+    rnd = random.Random(13)
+    checked = bad = 0
+    for _ in range(3000):
+        usdt_thb, rub_usdt = round(rnd.uniform(30, 38), 2), round(rnd.uniform(75, 100), 2)
+        snapshot = RateSnapshot(usdt_thb, rub_usdt, 0, {}, rnd.randint(1, 10 ** 6))
+        spec_rates = build_pricing_spec(snapshot, tables, 300)
+        evaluator = SpecEvaluator(spec_rates)
+        amount = round(rnd.choice([rnd.uniform(1, 100), rnd.uniform(100, 10 ** 4), rnd.uniform(10 ** 4, 3 * 10 ** 6)]), 2)
+        margin = rnd.choice([None, 1.5, 2.0, 2.4, 3.0, 4.0, 5.0, round(rnd.uniform(0.5, 6), 1)])
+        custom = round(rnd.uniform(75, 100), 2)
+        for operation in OPERATIONS.values():
+            inputs = {'amount': amount, 'profit_margin': margin or 4.0, 'custom_rub_usdt': custom} \
+                if operation.method == 'broker' else {'amount': amount, 'profit_margin': margin}
+            calc = operation.calculator(snapshot, inputs.get('custom_rub_usdt'), inputs['profit_margin'])
+            try:
+                expected = operation.run(calc, amount, inputs['profit_margin'])
+            except ZeroDivisionError:
+                expected = 'error'
+            try:
+                actual = evaluator.calculate(*operation.key, inputs)
+            except ZeroDivisionError:
+                actual = 'error'
+            checked += 1
+            if json.dumps(expected, sort_keys=True) != json.dumps(actual, sort_keys=True):
+                bad += 1
+                if bad <= 3:
+                    print('❌', operation.key, amount, margin, usdt_thb, rub_usdt)
+    print(f"{'✅' if not bad else '❌'} {checked} operations: {bad} mismatches")
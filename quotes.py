@@ -0,0 +1,97 @@
+"""
+Котировки калькулятора
+Результат /api/calculate фиксируется вместе с версией курсов и живёт ограниченное время,
+чтобы сделку можно было создать ровно по тем цифрам, которые видел клиент
+"""
+
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class QuoteStore:
+    """Ограниченное по размеру хранилище котировок с TTL"""
+
+    CACHE_PREFIX = 'quote:'
+
+    def __init__(self, ttl: float = None, max_size: int = None, cache=None):
+        """
+        Args:
+            ttl: Время жизни котировки в секундах (QUOTE_TTL, по умолчанию 600)
+            max_size: Сколько котировок держать в памяти воркера (QUOTE_STORE_SIZE)
+            cache: Общий кэш воркеров, чтобы котировку видел любой воркер
+        """
+        self.ttl = ttl if ttl is not None else float(os.getenv('QUOTE_TTL', 600))
+        self.max_size = max_size if max_size is not None else int(os.getenv('QUOTE_STORE_SIZE', 10000))
+        self.cache = cache
+        self._quotes = OrderedDict()
+        self._lock = threading.Lock()
+        self._issued = 0
+
+    def issue(self, params: dict, result: dict, rates_version: int) -> dict:
+        """Зафиксировать результат расчёта и вернуть котировку"""
+        now = time.time()
+        quote = {
+            'quote_id': uuid.uuid4().hex,
+            'created_at': now,
+            'expires_at': now + self.ttl,
+            'rates_version': rates_version,
+            'params': params,
+            'result': dict(result)
+        }
+        with self._lock:
+            self._quotes[quote['quote_id']] = quote
+            while len(self._quotes) > self.max_size:
+                self._quotes.popitem(last=False)
+            self._issued += 1
+            purge = self._issued % 100 == 0
+        if self.cache is not None:
+            self.cache.set(self.CACHE_PREFIX + quote['quote_id'], quote)
+            if purge:
+                self.cache.purge(self.CACHE_PREFIX, now - self.ttl)
+        return quote
+
+    def get(self, quote_id: str) -> dict:
+        """Действующая котировка или None (не найдена / истекла)"""
+        if not quote_id:
+            return None
+        quote = self._quotes.get(quote_id)
+        if quote is None and self.cache is not None:
+            quote, _ = self.cache.get(self.CACHE_PREFIX + quote_id)
+        if quote is None or quote['expires_at'] < time.time():
+            return None
+        return quote
+
+
+def quote_deal_fields(quote: dict) -> tuple:
+    """
+    Поля сделки из котировки
+
+    Returns:
+        tuple: (locked, defaults) - суммы и курс клиента фиксируются котировкой,
+               себестоимость и прибыль - значения по умолчанию, которые менеджер может уточнить
+    """
+    result = quote['result']
+    scenario = quote['params'].get('scenario')
+    payin_currency, payout_currency = scenario.split('-to-') if scenario else (None, None)
+
+    locked = {
+        'payin_amount_usdt': result.get('incoming_usdt'),
+        'exchange_rate': result.get('final_rate')
+    }
+    if payin_currency == 'rub':
+        locked['payin_amount_rub'] = result.get('rub_amount')
+        locked['payin_rate_rub_usdt'] = result.get('rub_usdt_rate_sell')
+    elif payin_currency == 'thb':
+        locked['payin_amount_thb'] = result.get('thb_amount')
+    if payout_currency == 'thb':
+        locked['payout_amount_thb'] = result.get('thb_received', result.get('thb_target'))
+
+    defaults = {
+        'payout_amount_usdt': result.get('outgoing_usdt'),
+        'profit_usdt': result.get('profit_usdt'),
+        'profit_percent': result.get('profit_percent_actual')
+    }
+    return locked, defaults
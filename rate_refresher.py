@@ -0,0 +1,202 @@
+"""
+Фоновое обновление курсов валют
+Держит в памяти версионированный снапшот курсов и отдаёт его по stale-while-revalidate
+"""
+
+import os
+import threading
+import time
+
+from async_runtime import run_sync
+from calculator import ExchangeRateProvider
+from shared_cache import LocalCache
+
+# Фоллбэк курсы, если API ни разу не ответил
+DEFAULT_USDT_THB = 35.20
+DEFAULT_RUB_USDT = 86.50
+
+
+class RateSnapshot:
+    """Неизменяемый снапшот курсов"""
+
+    __slots__ = ('usdt_thb', 'rub_usdt', 'fetched_at', 'source', 'version', 'pair_fetched_at')
+
+    def __init__(self, usdt_thb: float, rub_usdt: float, fetched_at: float, source: dict, version: int,
+                 pair_fetched_at: dict = None):
+        """
+        Args:
+            usdt_thb: Курс USDT-THB
+            rub_usdt: Курс RUB-USDT
+            fetched_at: Время получения самой старой из пар (unix timestamp)
+            source: Источник по каждой паре, например {'usdt_thb': 'binance', 'rub_usdt': 'doverka'}
+            version: Номер версии, растёт при каждом изменении курсов
+            pair_fetched_at: Время получения по каждой паре (по умолчанию у обеих fetched_at)
+        """
+        self.usdt_thb = usdt_thb
+        self.rub_usdt = rub_usdt
+        self.fetched_at = fetched_at
+        self.source = source
+        self.version = version
+        self.pair_fetched_at = pair_fetched_at or {'usdt_thb': fetched_at, 'rub_usdt': fetched_at}
+
+    def age(self, now: float = None) -> float:
+        return (now or time.time()) - self.fetched_at
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'RateSnapshot':
+        return cls(data['usdt_thb'], data['rub_usdt'], data['fetched_at'], data['source'], data['version'],
+                   data.get('pair_fetched_at'))
+
+    def to_dict(self):
+        return {
+            'usdt_thb': self.usdt_thb,
+            'rub_usdt': self.rub_usdt,
+            'fetched_at': self.fetched_at,
+            'source': dict(self.source),
+            'version': self.version,
+            'pair_fetched_at': dict(self.pair_fetched_at)
+        }
+
+
+class RateRefresher:
+    """Фоновый поток, который периодически обновляет снапшот курсов"""
+
+    # Ключ снапшота в общем кэше воркеров
+    CACHE_KEY = 'rates:snapshot'
+
+    def __init__(self, interval: float = None, fetch_timeout: float = None, cache=None):
+        """
+        Args:
+            interval: Период обновления в секундах (RATES_REFRESH_INTERVAL, по умолчанию 30)
+            fetch_timeout: Сколько ждать первый снапшот при холодном старте (RATES_FETCH_TIMEOUT)
+            cache: Общий кэш воркеров (shared_cache); курсы из API запрашивает только один воркер
+        """
+        self.interval = interval if interval is not None else float(os.getenv('RATES_REFRESH_INTERVAL', 30))
+        self.fetch_timeout = fetch_timeout if fetch_timeout is not None else float(os.getenv('RATES_FETCH_TIMEOUT', 12))
+        # Общий кэш дешево проверять чаще, чем ходить в API
+        self.poll_interval = max(self.interval / 4, 1.0)
+        self.cache = cache or LocalCache()
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._wakeup = threading.Event()
+        self._ready = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._fetch_listeners = []
+
+    def add_fetch_listener(self, callback):
+        """
+        callback(rates, fetched_at) вызывается после каждого запроса курсов к API
+
+        Срабатывает только в воркере, который реально ходил в API (по одному разу на хост),
+        rates содержит только пары, которые ответили в этот раз.
+        """
+        self._fetch_listeners.append(callback)
+
+    def start(self):
+        """Запустить фоновый поток (идемпотентно, отдельно в каждом воркере gunicorn)"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='rate-refresher', daemon=True)
+            self._thread.start()
+
+    def get(self) -> RateSnapshot:
+        """
+        Текущий снапшот курсов без сетевых запросов
+
+        Если снапшот устарел, отдаём его как есть и будим фоновый поток.
+        Блокируемся только при холодном старте, пока не придёт первый ответ.
+        """
+        self.start()
+        snapshot = self._snapshot
+        if snapshot is None:
+            self._ready.wait(self.fetch_timeout)
+            snapshot = self._snapshot
+            if snapshot is None:
+                return RateSnapshot(DEFAULT_USDT_THB, DEFAULT_RUB_USDT, time.time(),
+                                    {'usdt_thb': 'fallback', 'rub_usdt': 'fallback'}, 0)
+        if snapshot.age() > self.interval:
+            self._wakeup.set()
+        return snapshot
+
+    def is_stale(self, snapshot: RateSnapshot) -> bool:
+        """Снапшот собран из фоллбэков или давно не обновлялся"""
+        return 'fallback' in snapshot.source.values() or snapshot.age() > self.interval * 2
+
+    def refresh(self) -> RateSnapshot:
+        """Взять снапшот из общего кэша, а если он устарел - получить курсы (один воркер на хост)"""
+        try:
+            data, _, _ = self.cache.get_or_refresh(self.CACHE_KEY, self.interval, self._load,
+                                                   wait=self.fetch_timeout)
+        except Exception as e:
+            print(f"⚠️ Rate refresh error: {e}")
+            data = self._load(None)
+        snapshot = RateSnapshot.from_dict(data)
+        with self._changed:
+            previous = self._snapshot
+            self._snapshot = snapshot
+            if previous is None or previous.version != snapshot.version:
+                self._changed.notify_all()
+        self._ready.set()
+        return snapshot
+
+    def wait_for_change(self, version: int, timeout: float) -> RateSnapshot:
+        """Дождаться снапшота с версией, отличной от version (или таймаута), и вернуть текущий"""
+        self.start()
+        with self._changed:
+            self._changed.wait_for(
+                lambda: self._snapshot is not None and self._snapshot.version != version, timeout)
+        return self.get()
+
+    def _load(self, previous_data: dict) -> dict:
+        try:
+            rates = run_sync(ExchangeRateProvider.get_all_rates(), timeout=self.fetch_timeout)
+        except Exception as e:
+            print(f"⚠️ Rate fetch error: {e}")
+            rates = {}
+        fetched_at = time.time()
+        for callback in self._fetch_listeners:
+            try:
+                callback(rates, fetched_at)
+            except Exception as e:
+                print(f"⚠️ Rate listener error: {e}")
+        previous = RateSnapshot.from_dict(previous_data) if previous_data else self._snapshot
+        return self._build(rates, previous).to_dict()
+
+    def _build(self, rates: dict, previous: RateSnapshot) -> RateSnapshot:
+        usdt_thb = rates.get('usdt_thb')
+        rub_usdt = rates.get('rub_usdt')
+        if not usdt_thb and not rub_usdt and previous is not None:
+            # Оба источника недоступны - оставляем прошлый снапшот, его возраст покажет устаревание
+            return previous
+        source = dict(rates.get('sources') or {})
+        now = time.time()
+        pair_fetched_at = {'usdt_thb': now, 'rub_usdt': now}
+
+        # Если одна из пар не ответила, оставляем её прошлое значение и время получения (stale)
+        if not usdt_thb:
+            usdt_thb = previous.usdt_thb if previous else DEFAULT_USDT_THB
+            source['usdt_thb'] = previous.source['usdt_thb'] if previous else 'fallback'
+            if previous:
+                pair_fetched_at['usdt_thb'] = previous.pair_fetched_at['usdt_thb']
+        if not rub_usdt:
+            rub_usdt = previous.rub_usdt if previous else DEFAULT_RUB_USDT
+            source['rub_usdt'] = previous.source['rub_usdt'] if previous else 'fallback'
+            if previous:
+                pair_fetched_at['rub_usdt'] = previous.pair_fetched_at['rub_usdt']
+
+        version = previous.version if previous else 0
+        if previous is None or previous.usdt_thb != usdt_thb or previous.rub_usdt != rub_usdt:
+            version += 1
+
+        # Возраст снапшота - по самой старой паре, чтобы устаревший курс не выглядел свежим
+        return RateSnapshot(usdt_thb, rub_usdt, min(pair_fetched_at.values()), source, version, pair_fetched_at)
+
+    def _run(self):
+        while True:
+            self.refresh()
+            self._wakeup.clear()
+            self._wakeup.wait(self.poll_interval)
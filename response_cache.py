@@ -0,0 +1,89 @@
+"""
+LRU-кэш ответов калькулятора
+Один и тот же расчёт (метод, сценарий, направление, сумма, маржа, кастомный курс) при той же
+версии курсов и таблиц отдаётся готовым телом ответа с ETag, без пересчёта и новой котировки.
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """Ограниченный LRU-кэш тел ответов, сбрасывается при смене версии данных"""
+
+    def __init__(self, max_size: int = None, min_quote_life: float = None):
+        """
+        Args:
+            max_size: Сколько ответов держать (CALC_CACHE_SIZE, по умолчанию 2000; 0 - кэш выключен)
+            min_quote_life: Сколько секунд жизни котировки должно остаться, чтобы ответ ещё отдавался
+                            из кэша (CALC_CACHE_MIN_QUOTE_LIFE, по умолчанию 60)
+        """
+        self.max_size = max_size if max_size is not None else int(os.getenv('CALC_CACHE_SIZE', 2000))
+        self.min_quote_life = min_quote_life if min_quote_life is not None else \
+            float(os.getenv('CALC_CACHE_MIN_QUOTE_LIFE', 60))
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0, 'invalidations': 0}
+
+    @staticmethod
+    def etag(body: bytes) -> str:
+        return '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+
+    def _check_version(self, version):
+        # Под блокировкой: новая версия курсов/таблиц делает все записи недействительными
+        if version != self._version:
+            if self._entries:
+                self._stats['invalidations'] += 1
+            self._entries.clear()
+            self._version = version
+
+    def get(self, key, version):
+        """
+        Закэшированный ответ или None
+
+        Returns:
+            dict: {'body': bytes, 'etag': str, 'expires_at': float} - срок котировки в ответе
+        """
+        if self.max_size <= 0:
+            return None
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] - time.time() < self.min_quote_life:
+                # Котировка в ответе скоро истечёт - пусть клиент получит новую
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    def put(self, key, version, body: bytes, expires_at: float) -> dict:
+        entry = {'body': body, 'etag': self.etag(body), 'expires_at': expires_at}
+        if self.max_size <= 0:
+            return entry
+        with self._lock:
+            self._check_version(version)
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return entry
+
+    def not_modified(self):
+        """Учесть ответ 304 по If-None-Match"""
+        with self._lock:
+            self._stats['not_modified'] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return dict(self._stats, size=len(self._entries), max_size=self.max_size,
+                        hit_ratio=round(self._stats['hits'] / lookups, 4) if lookups else None)
@@ -0,0 +1,194 @@
+"""
+Риск по незакрытым сделкам: Монте-Карло по курсам USDT-THB и RUB-USDT
+Пути курсов бутстрепятся из истории (rate_bars) или генерируются параметрически,
+каждая сделка переоценивается на каждом пути одним проходом NumPy, по итогам - VaR/ES.
+"""
+
+import math
+
+import numpy as np
+
+from money import excel_round_array
+
+PAIRS = ('usdt_thb', 'rub_usdt')
+# Валюта ноги сделки -> индекс множителя стоимости в USDT
+CURRENCIES = {'THB': 0, 'RUB': 1, 'USDT': 2}
+
+# Минимум совместных доходностей в истории для бутстрепа
+MIN_HISTORY_RETURNS = 30
+# Сколько шагов бутстрепа выбирать за раз (ограничивает память на больших горизонтах)
+BOOTSTRAP_CHUNK = 64
+
+
+def history_returns(closes: dict) -> np.ndarray:
+    """
+    Совместные лог-доходности пар по бакетам, которые есть у обеих пар
+
+    Args:
+        closes: {'usdt_thb': [(bucket_ts, close), ...], 'rub_usdt': [...]}, по возрастанию времени
+
+    Returns:
+        np.ndarray: Форма (n, 2), столбцы в порядке PAIRS
+    """
+    series = [dict(closes.get(pair) or []) for pair in PAIRS]
+    common = sorted(set(series[0]) & set(series[1]))
+    if len(common) < 2:
+        return np.empty((0, 2))
+    levels = np.array([[s[ts] for s in series] for ts in common], dtype=np.float64)
+    returns = np.diff(np.log(levels), axis=0)
+    return returns[np.all(np.isfinite(returns), axis=1)]
+
+
+def simulate_factors(paths: int, steps: int, returns: np.ndarray = None, volatility: tuple = None,
+                     correlation: float = None, seed: int = None) -> np.ndarray:
+    """
+    Множители курсов на горизонте: S_T / S_0 по каждой паре
+
+    Если переданы volatility (σ за шаг по каждой паре) - параметрическая модель (логнормальная,
+    корреляция из correlation или из истории); иначе - бутстреп совместных доходностей истории.
+
+    Returns:
+        np.ndarray: Форма (paths, 2), столбцы в порядке PAIRS
+
+    Raises:
+        ValueError: Нет истории для бутстрепа
+    """
+    rng = np.random.default_rng(seed)
+    steps = max(int(steps), 1)
+    if volatility is not None:
+        sigma = np.asarray(volatility, dtype=np.float64)
+        if correlation is None:
+            correlation = float(np.corrcoef(returns.T)[0, 1]) if returns is not None and len(returns) > 2 else 0.0
+        rho = min(max(correlation if math.isfinite(correlation) else 0.0, -0.999), 0.999)
+        z = rng.standard_normal((paths, 2))
+        z[:, 1] = rho * z[:, 0] + math.sqrt(1 - rho * rho) * z[:, 1]
+        log_moves = z * sigma * math.sqrt(steps) - 0.5 * sigma * sigma * steps
+        return np.exp(log_moves)
+
+    if returns is None or len(returns) < MIN_HISTORY_RETURNS:
+        raise ValueError(f'Not enough rate history for bootstrap (need {MIN_HISTORY_RETURNS} returns)')
+    log_moves = np.zeros((paths, 2))
+    for start in range(0, steps, BOOTSTRAP_CHUNK):
+        chunk = min(BOOTSTRAP_CHUNK, steps - start)
+        log_moves += returns[rng.integers(0, len(returns), size=(paths, chunk))].sum(axis=1)
+    return np.exp(log_moves)
+
+
+def position_from_result(result: dict, scenario: str, manager: str = None, method: str = None) -> dict:
+    """Позиция по результату калькулятора: ноги в USDT по текущим курсам и их валюты"""
+    payin, payout = scenario.upper().split('-TO-')
+    return {
+        'incoming_usdt': result['incoming_usdt'], 'incoming_currency': payin,
+        'outgoing_usdt': result['outgoing_usdt'], 'outgoing_currency': payout,
+        'manager': manager, 'method': method
+    }
+
+
+def _stats(pnl: np.ndarray, base: np.ndarray, confidence) -> list:
+    """Статистики по столбцам pnl (пути × группы): среднее, перцентили, VaR/ES относительно base"""
+    ordered = np.sort(pnl, axis=0)
+    paths = len(ordered)
+    out = [{
+        'expected_pnl': round(float(mean), 2), 'booked_pnl': round(float(booked), 2), 'std': round(float(std), 2),
+        'p5': round(float(p5), 2), 'p50': round(float(p50), 2), 'p95': round(float(p95), 2)
+    } for mean, booked, std, p5, p50, p95 in zip(
+        ordered.mean(axis=0), base, ordered.std(axis=0),
+        *np.quantile(ordered, [0.05, 0.5, 0.95], axis=0))]
+    for level in confidence:
+        tail = max(int(math.ceil((1 - level) * paths)), 1)
+        var = base - ordered[tail - 1]
+        es = base - ordered[:tail].mean(axis=0)
+        label = f'{level * 100:g}'
+        for item, v, e in zip(out, var, es):
+            item[f'var_{label}'] = round(float(v), 2)
+            item[f'es_{label}'] = round(float(e), 2)
+    return out
+
+
+def simulate_book(positions: list, factors: np.ndarray, confidence=(0.95, 0.99)) -> dict:
+    """
+    P&L книги на каждом пути
+
+    Клиентские суммы зафиксированы, ноги в RUB и THB переоцениваются в USDT по курсам пути
+    (USDT за единицу валюты обратно пропорционален курсу), ноги в USDT не меняются.
+    VaR/ES - потеря относительно прибыли по текущим курсам (booked_pnl).
+
+    Args:
+        positions: Позиции (см. position_from_result)
+        factors: Множители курсов (paths, 2) из simulate_factors
+        confidence: Уровни VaR/ES
+
+    Returns:
+        dict: total, by_manager, by_method - статистики P&L в USDT
+    """
+    incoming = np.array([p['incoming_usdt'] for p in positions], dtype=np.float64)
+    outgoing = np.array([p['outgoing_usdt'] for p in positions], dtype=np.float64)
+    incoming_idx = np.array([CURRENCIES[p['incoming_currency']] for p in positions])
+    outgoing_idx = np.array([CURRENCIES[p['outgoing_currency']] for p in positions])
+
+    # Стоимость единицы USDT-ноги на пути: THB и RUB дешевеют при росте курса
+    value = np.empty((len(factors), 3))
+    value[:, :2] = 1.0 / factors
+    value[:, 2] = 1.0
+    pnl = excel_round_array(incoming * value[:, incoming_idx], 2) - \
+        excel_round_array(outgoing * value[:, outgoing_idx], 2)
+    # Те же ноги по текущим курсам (округлены так же, как на путях)
+    booked = excel_round_array(incoming, 2) - excel_round_array(outgoing, 2)
+
+    report = {'deals': len(positions), 'paths': len(factors)}
+    report['total'] = _stats(pnl.sum(axis=1, keepdims=True), booked.sum(keepdims=True), confidence)[0]
+    for key, field in (('by_manager', 'manager'), ('by_method', 'method')):
+        names = sorted({p[field] or '—' for p in positions})
+        index = {name: i for i, name in enumerate(names)}
+        groups = np.zeros((len(positions), len(names)))
+        groups[np.arange(len(positions)), [index[p[field] or '—'] for p in positions]] = 1.0
+        stats = _stats(pnl @ groups, booked @ groups, confidence)
+        report[key] = dict(zip(names, stats))
+    return report
+
+
+if __name__ == '__main__':
+    # Замер: 10k путей × 300 сделок, бутстреп по синтетической истории
+    import random
+    import time
+
+    from calculator import ExchangeCalculator
+    from broker_detailed import BrokerCalculatorDetailed
+
+    rnd = random.Random(1)
+    ts = list(range(0, 3600 * 24 * 30, 3600))
+    thb, rub, closes = 35.2, 86.5, {'usdt_thb': [], 'rub_usdt': []}
+    for t in ts:
+        thb *= math.exp(rnd.gauss(0, 0.001))
+        rub *= math.exp(rnd.gauss(0, 0.003))
+        closes['usdt_thb'].append((t, thb))
+        closes['rub_usdt'].append((t, rub))
+    returns = history_returns(closes)
+
+    doverka = ExchangeCalculator(35.2, 86.5)
+    positions = []
+    for i in range(300):
+        scenario = rnd.choice(['rub-to-thb', 'thb-to-usdt', 'usdt-to-thb', 'rub-to-usdt'])
+        amount = round(rnd.uniform(10_000, 500_000) if scenario.startswith('rub') else rnd.uniform(100, 20_000), 2)
+        if rnd.random() < 0.5:
+            func = {'rub-to-thb': doverka.rub_to_thb, 'thb-to-usdt': doverka.thb_to_usdt,
+                    'usdt-to-thb': doverka.usdt_to_thb, 'rub-to-usdt': doverka.rub_to_usdt_amount}[scenario]
+            result, method = func(amount), 'doverka'
+        else:
+            broker = BrokerCalculatorDetailed(35.2, 80.9, rnd.choice([1.5, 3.0, 4.0, 5.0]))
+            result, method = getattr(broker, scenario.replace('-', '_') + '_amount')(amount), 'broker'
+        positions.append(position_from_result(result, scenario, f'manager {i % 5}', method))
+
+    started = time.perf_counter()
+    factors = simulate_factors(10_000, 24, returns, seed=7)
+    report = simulate_book(positions, factors)
+    elapsed = time.perf_counter() - started
+    total = report['total']
+    print(f"{'✅' if elapsed < 1 else '❌'} {report['paths']} paths × {report['deals']} deals: {elapsed * 1000:.0f} ms")
+    print(f"   booked {total['booked_pnl']:.2f}, expected {total['expected_pnl']:.2f}, "
+          f"VaR95 {total['var_95']}, ES95 {total['es_95']}, VaR99 {total['var_99']}, ES99 {total['es_99']}")
+
+    # Без движения курсов P&L совпадает с прибылью калькулятора
+    flat = simulate_book(positions, np.ones((10, 2)))
+    assert abs(flat['total']['expected_pnl'] - flat['total']['booked_pnl']) < 1e-6
+    print('✅ Flat rates reproduce booked profit')
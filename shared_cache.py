@@ -0,0 +1,165 @@
+"""
+Общий кэш для всех воркеров gunicorn на одном хосте
+SQLite-файл в режиме WAL + аренды (lease), чтобы ключ обновлял ровно один воркер
+"""
+
+import json
+import os
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+
+
+class LocalCache:
+    """Кэш в памяти процесса с тем же интерфейсом (если общий файл выключен или недоступен)"""
+
+    def __init__(self):
+        self._data = {}
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        """Вернуть (value, updated_at) или (None, 0)"""
+        return self._data.get(key, (None, 0))
+
+    def set(self, key: str, value, updated_at: float = None):
+        self._data[key] = (value, updated_at or time.time())
+
+    def delete(self, key: str):
+        self._data.pop(key, None)
+
+    def purge(self, prefix: str, older_than: float):
+        """Удалить ключи с префиксом, обновлённые раньше older_than"""
+        for key, (_, updated_at) in list(self._data.items()):
+            if key.startswith(prefix) and updated_at < older_than:
+                self._data.pop(key, None)
+
+    def acquire(self, key: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            if self._leases.get(key, 0) > now:
+                return False
+            self._leases[key] = now + ttl
+            return True
+
+    def release(self, key: str):
+        self._leases.pop(key, None)
+
+    def get_or_refresh(self, key: str, max_age: float, loader, force: bool = False, wait: float = 10.0,
+                       lease_ttl: float = 60.0):
+        """
+        Отдать свежее значение из кэша или обновить его
+
+        Обновляет только тот, кто взял аренду на ключ; остальные отдают
+        устаревшее значение (stale-while-revalidate) или ждут результат до wait секунд.
+        loader(previous) получает прошлое значение и возвращает новое (None - не кэшировать).
+
+        Returns:
+            tuple: (value, updated_at, from_cache)
+        """
+        value, updated_at = self.get(key)
+        if not force and value is not None and time.time() - updated_at < max_age:
+            return value, updated_at, True
+
+        if self.acquire(key, ttl=lease_ttl):
+            try:
+                new_value = loader(value)
+                if new_value is None:
+                    return value, updated_at, value is not None
+                self.set(key, new_value)
+                return new_value, time.time(), False
+            finally:
+                self.release(key)
+
+        # Ключ обновляет другой воркер
+        if value is not None and not force:
+            return value, updated_at, True
+        deadline = time.time() + wait
+        while time.time() < deadline:
+            time.sleep(0.1)
+            fresh, fresh_at = self.get(key)
+            if fresh is not None and fresh_at > updated_at:
+                return fresh, fresh_at, True
+        if value is not None:
+            return value, updated_at, True
+        # Не дождались - считаем сами, чтобы не оставить запрос без ответа
+        new_value = loader(None)
+        return new_value, time.time(), False
+
+
+class SharedCache(LocalCache):
+    """Кэш в SQLite-файле, видимый всем процессам хоста"""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # Отдельное соединение на поток (и заново после fork)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _owner(self) -> str:
+        return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+    def get(self, key: str):
+        row = self._conn().execute("SELECT value, updated_at FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None, 0
+        return json.loads(row[0]), row[1]
+
+    def set(self, key: str, value, updated_at: float = None):
+        self._conn().execute(
+            "INSERT INTO cache (key, value, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at",
+            (key, json.dumps(value), updated_at or time.time())
+        )
+
+    def delete(self, key: str):
+        self._conn().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def purge(self, prefix: str, older_than: float):
+        self._conn().execute("DELETE FROM cache WHERE key >= ? AND key < ? AND updated_at < ?",
+                             (prefix, prefix + '\uffff', older_than))
+
+    def acquire(self, key: str, ttl: float) -> bool:
+        """Взять аренду на обновление ключа (атомарно для всех процессов)"""
+        owner = self._owner()
+        now = time.time()
+        cursor = self._conn().execute(
+            "INSERT INTO leases (key, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.expires_at < ?",
+            (key, owner, now + ttl, now)
+        )
+        return cursor.rowcount == 1
+
+    def release(self, key: str):
+        self._conn().execute("DELETE FROM leases WHERE key = ? AND owner = ?", (key, self._owner()))
+
+
+def cache_from_env():
+    """
+    Общий кэш по SHARED_CACHE_PATH (по умолчанию файл во временной папке хоста)
+    SHARED_CACHE_PATH=off - кэш только в памяти процесса
+    """
+    path = os.getenv('SHARED_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'calccrm_shared_cache.db'))
+    if path.strip().lower() in ('', 'off', 'none'):
+        return LocalCache()
+    try:
+        return SharedCache(path)
+    except Exception as e:
+        print(f"⚠️ Shared cache unavailable ({e}), using in-process cache")
+        return LocalCache()
@@ -52,16 +52,70 @@ let state = {
     infoOpen: false,
     applyDiscount: false,
     lastResult: null, // Храним последний результат для создания платежа
+    quotePending: null, // Запрос котировки для результата, посчитанного в браузере
+    matrix: null, // Все сценарии для последней суммы (/api/calculate/matrix)
+    spec: null, // Спецификация ценообразования (/api/pricing/spec) для расчёта в браузере
+    specTimer: null,
     lastUpdateTimestamp: 0 // Время последнего обновления курсов
 };
 
 // Инициализация
 document.addEventListener('DOMContentLoaded', () => {
     refreshRates();
-    // Фоновое обновление курсов каждые 5 минут
-    setInterval(refreshRates, 5 * 60 * 1000);
+    subscribeRates();
+    loadPricingSpec();
 });
 
+// Опрос курсов, пока сервер не даёт поток, и через сколько пробовать поток снова
+const RATES_POLL_INTERVAL = 30 * 1000;
+const RATES_STREAM_RETRY = 5 * 60 * 1000;
+
+// Подписка на поток курсов (SSE): сервер присылает снапшот и изменения сам
+function subscribeRates() {
+    if (!CONFIG.USE_API || typeof EventSource === 'undefined') {
+        // Фоновое обновление курсов каждые 5 минут
+        setInterval(refreshRates, 5 * 60 * 1000);
+        return;
+    }
+    
+    const source = new EventSource(`${CONFIG.API_URL}/rates/stream`);
+    
+    source.addEventListener('snapshot', (event) => {
+        state.rates = JSON.parse(event.data);
+        state.lastUpdateTimestamp = Date.now();
+        updateRatesDisplay();
+    });
+    
+    source.addEventListener('delta', (event) => {
+        state.rates = { ...state.rates, ...JSON.parse(event.data) };
+        state.lastUpdateTimestamp = Date.now();
+        updateRatesDisplay();
+        hideResults();
+        // Новые курсы - спецификация с прежним снапшотом больше не годится
+        loadPricingSpec();
+    });
+    
+    // Курсы не менялись, но поток жив - значит они актуальны
+    source.addEventListener('heartbeat', () => {
+        state.lastUpdateTimestamp = Date.now();
+    });
+    
+    // При обрыве EventSource переподключается сам; если сервер отказал (503 - потоков слишком много),
+    // соединение закрыто насовсем - опрашиваем /api/rates и позже пробуем подписаться снова
+    source.onerror = () => {
+        if (source.readyState !== EventSource.CLOSED) {
+            console.warn('Rates stream disconnected, reconnecting...');
+            return;
+        }
+        console.warn('Rates stream refused, falling back to polling');
+        const poll = setInterval(refreshRates, RATES_POLL_INTERVAL);
+        setTimeout(() => {
+            clearInterval(poll);
+            subscribeRates();
+        }, RATES_STREAM_RETRY);
+    };
+}
+
 // Очистка результатов при изменении ввода
 function hideResults() {
     document.getElementById('resultsSection').style.display = 'none';
@@ -117,14 +171,291 @@ function switchMethod(method) {
         updateScenarioUI();
     }
     
-    hideResults();
+    if (!showFromMatrix()) hideResults();
 }
 
 // Переключение сценария
 function switchScenario(scenario) {
     state.scenario = scenario;
     updateScenarioUI();
-    hideResults();
+    if (!showFromMatrix()) hideResults();
+}
+
+// Матрица всех сценариев для текущей суммы: переключение вида без запросов к серверу
+function matrixKey(amount) {
+    return [amount, state.profitMargin, state.applyDiscount, state.customRubUsdt].join('|');
+}
+
+async function prefetchMatrix(amount) {
+    const key = matrixKey(amount);
+    if (state.matrix && state.matrix.key === key && state.matrix.version === state.rates.version) return;
+    try {
+        const response = await fetch(`${CONFIG.API_URL}/calculate/matrix`, {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                amount: amount,
+                custom_rub_usdt: state.customRubUsdt,
+                profit_margin: state.profitMargin,
+                doverka_profit_margin: state.applyDiscount ? state.profitMargin : null
+            })
+        });
+        if (response.ok) {
+            const data = await response.json();
+            state.matrix = { key, version: data.rates_version, results: data.results };
+        }
+    } catch (error) {
+        console.warn('Matrix prefetch error:', error);
+    }
+}
+
+function showFromMatrix() {
+    const amount = getAmount();
+    if (!state.matrix || amount <= 0 || state.matrix.key !== matrixKey(amount)
+        || state.matrix.version !== state.rates.version) {
+        return false;
+    }
+    let scenario = state.scenario;
+    let direction = state.direction;
+    if (state.method === 'doverka' && scenario === 'thb-to-rub') {
+        scenario = 'rub-to-thb';
+        direction = 'target';
+    }
+    const cell = ((state.matrix.results[state.method] || {})[scenario] || {})[direction];
+    if (!cell || cell.error) return false;
+    displayResult(cell);
+    document.getElementById('resultsSection').style.display = 'block';
+    return true;
+}
+
+// ==================== Расчёт по спецификации ценообразования ====================
+// /api/pricing/spec отдаёт формулы калькуляторов (переведённые из кода сервера), таблицы и курсы.
+// Расчёт идёт в браузере без запросов; при создании сделки сервер пересчитывает его (поле pricing).
+
+// 10^d для округления (точные степени десяти, как _SCALES в money.py)
+const ROUND_SCALES = [1, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9, 1e10, 1e11, 1e12, 1e13, 1e14, 1e15];
+const ROUND_MAX_SCALED = 2 ** 52;
+
+// Эталонное округление по десятичной записи числа (как Decimal(str(x)).quantize в Python)
+function excelRoundDecimal(value, decimals) {
+    if (!Number.isFinite(value)) throw new Error('Cannot round ' + value);
+    const negative = value < 0 || Object.is(value, -0);
+    // toExponential() без аргумента - кратчайшая запись, те же цифры, что repr() в Python
+    const [mantissa, exp] = Math.abs(value).toExponential().split('e');
+    const digits = mantissa.replace('.', '');
+    const power = parseInt(exp, 10) - (digits.length - 1);  // value = digits * 10^power
+    if (power >= -decimals) return value;
+    const drop = BigInt(10) ** BigInt(-decimals - power);
+    let units = BigInt(digits) / drop;
+    if (BigInt(digits) % drop * BigInt(2) >= drop) units += BigInt(1);
+    let text = units.toString().padStart(decimals + 1, '0');
+    if (decimals > 0) text = text.slice(0, -decimals) + '.' + text.slice(-decimals);
+    return parseFloat((negative ? '-' : '') + text);
+}
+
+// Округление как в Excel (0.5 вверх), побитово совпадает с excel_round на сервере
+function excelRound(value, decimals = 2) {
+    if (decimals >= ROUND_SCALES.length) return excelRoundDecimal(value, decimals);
+    const scale = ROUND_SCALES[decimals];
+    const scaled = Math.abs(value) * scale;
+    if (!(scaled < ROUND_MAX_SCALED)) return excelRoundDecimal(value, decimals);
+    let units = Math.floor(scaled);
+    const frac = scaled - units;
+    if (Math.abs(frac - 0.5) <= scaled * 1e-12 + 1e-9) return excelRoundDecimal(value, decimals);
+    if (frac > 0.5) units += 1;
+    const result = units / scale;
+    return (value < 0 || Object.is(value, -0)) ? -result : result;
+}
+
+// Число в строке как float в Python: 3.0, 1e+16, 1e-05
+function pyFloatStr(value) {
+    if (Number.isNaN(value)) return 'nan';
+    if (!Number.isFinite(value)) return value > 0 ? 'inf' : '-inf';
+    if (Object.is(value, -0)) return '-0.0';
+    const abs = Math.abs(value);
+    if (abs !== 0 && (abs >= 1e16 || abs < 1e-4)) {
+        return value.toExponential().replace(/e([+-])(\d)$/, 'e$10$2');
+    }
+    const text = String(value);
+    return text.includes('.') ? text : text + '.0';
+}
+
+function specPrimitive(spec, name, args) {
+    const tables = spec.tables;
+    if (name === 'round') return excelRound(args[0], args[1]);
+    if (name === 'tables') return 'tables';
+    if (name === 'level') {
+        // Последний уровень с min <= x, если x ниже его max (null - без границы), иначе последний
+        const levels = Object.entries(tables.levels).sort((a, b) => a[1].min - b[1].min);
+        const x = args[1];
+        const i = levels.filter(([, params]) => params.min <= x).length - 1;
+        if (i >= 0 && (levels[i][1].max === null || x < levels[i][1].max)) return levels[i];
+        return levels[levels.length - 1];
+    }
+    if (name === 'usdt_commission') {
+        const t = args[1];
+        const curve = Object.entries(tables.margin_curve).map(([x, y]) => [parseFloat(x), y])
+            .sort((a, b) => a[0] - b[0]);
+        const exact = curve.find(([x]) => x === t);
+        if (exact) return exact[1];
+        const i = curve.filter(([x]) => x <= t).length - 1;
+        if (i >= 0 && i < curve.length - 1) {
+            const [x1, y1] = curve[i];
+            const [x2, y2] = curve[i + 1];
+            return y1 + (y2 - y1) * (t - x1) / (x2 - x1);
+        }
+        return t > curve[curve.length - 1][0] ? curve[curve.length - 1][1] : curve[0][1];
+    }
+    if (name === 'commissions') {
+        const presets = spec.broker_presets;
+        const preset = presets.levels.find(([level]) => Math.abs(args[0] - level) < presets.tolerance);
+        return preset ? preset[1] : specCall(spec, presets.default, {}, args);
+    }
+    throw new Error('Unknown primitive: ' + name);
+}
+
+function selfFields(env) {
+    return Object.fromEntries(Object.entries(env).filter(([key]) => key.startsWith('self.')));
+}
+
+function specEval(spec, node, env) {
+    if (typeof node === 'number') return node;
+    if (typeof node === 'string') {
+        if (!(node in env)) throw new Error('Unknown name: ' + node);
+        return env[node];
+    }
+    const [op, ...args] = node;
+    switch (op) {
+        case 'str': return args[0];
+        case 'null': return null;
+        case 'if': return specEval(spec, specEval(spec, args[0], env) ? args[1] : args[2], env);
+        case 'dict': return Object.fromEntries(args[0].map(([key, value]) => [key, specEval(spec, value, env)]));
+        case 'call': {
+            const values = args.slice(1).map(arg => specEval(spec, arg, env));
+            if (spec.primitives.includes(args[0])) return specPrimitive(spec, args[0], values);
+            return specCall(spec, args[0], selfFields(env), values);
+        }
+    }
+    const v = args.map(arg => specEval(spec, arg, env));
+    switch (op) {
+        case '+': return v[0] + v[1];
+        case '-': return v[0] - v[1];
+        case '*': return v[0] * v[1];
+        case '/':
+            // Как в Python: деление на ноль - ошибка, а не Infinity
+            if (v[1] === 0) throw new Error('Division by zero');
+            return v[0] / v[1];
+        case 'neg': return -v[0];
+        case '>': return v[0] > v[1];
+        case '>=': return v[0] >= v[1];
+        case '<': return v[0] < v[1];
+        case '<=': return v[0] <= v[1];
+        case '==': return v[0] === v[1];
+        case '!=': return v[0] !== v[1];
+        case 'is_null': return v[0] === null;
+        case 'not_null': return v[0] !== null;
+        case 'fmt': return pyFloatStr(v[0]);
+        case 'concat': return v.join('');
+        case 'tuple': return v;
+        case 'get': return v[0][v[1]];
+    }
+    throw new Error('Unknown spec node: ' + op);
+}
+
+function specRun(spec, statements, env) {
+    for (const statement of statements) {
+        const [kind, target, value] = statement;
+        if (kind === 'set') {
+            const result = specEval(spec, value, env);
+            if (Array.isArray(target)) target.forEach((name, i) => { env[name] = result[i]; });
+            else env[target] = result;
+        } else if (kind === 'return') {
+            return { value: specEval(spec, target, env) };
+        } else if (kind === 'when') {
+            const branch = specRun(spec, specEval(spec, target, env) ? statement[2] : statement[3], env);
+            if (branch) return branch;
+        }
+    }
+    return null;
+}
+
+// Вызов функции спецификации; для __init__ возвращает поля self калькулятора
+function specCall(spec, name, fields, args) {
+    const func = spec.functions[name];
+    const env = { ...fields };
+    func.params.forEach((param, i) => { env[param] = i < args.length ? args[i] : func.defaults[param]; });
+    const result = specRun(spec, func.body, env);
+    return result ? result.value : selfFields(env);
+}
+
+// Операция спецификации с теми же входами, что /api/calculate после разбора запроса
+function evaluateSpec(spec, method, scenario, direction, inputs) {
+    const calculator = spec.calculators[method];
+    const operation = spec.operations[`${method}/${scenario}/${direction}`];
+    if (!calculator || !operation) throw new Error('Unknown operation');
+    const values = { ...inputs, 'rates.usdt_thb': spec.rates.usdt_thb, 'rates.rub_usdt': spec.rates.rub_usdt };
+    const fields = specCall(spec, calculator.init, {}, calculator.init_args.map(name => values[name]));
+    return specCall(spec, operation.function, fields, calculator.op_args.map(name => values[name]));
+}
+
+async function loadPricingSpec() {
+    if (!CONFIG.USE_API) return;
+    clearTimeout(state.specTimer);
+    try {
+        const response = await fetch(`${CONFIG.API_URL}/pricing/spec`);
+        const data = await response.json();
+        if (response.ok && data.success) {
+            state.spec = data.spec;
+            // Обновляем заранее, чтобы расчёт не упирался в истёкшую спецификацию
+            const refreshIn = Math.max((state.spec.expires_at - state.spec.issued_at - 15) * 1000, 5000);
+            state.specTimer = setTimeout(loadPricingSpec, refreshIn);
+        } else {
+            // Сервер не отдаёт спецификацию - считаем через /api/calculate и проверяем позже
+            state.spec = null;
+            state.specTimer = setTimeout(loadPricingSpec, 60000);
+        }
+    } catch (error) {
+        console.warn('Pricing spec error:', error);
+        state.specTimer = setTimeout(loadPricingSpec, 30000);
+    }
+}
+
+// Спецификация действует и посчитана по тем же курсам, что показаны на экране
+function specValid() {
+    const spec = state.spec;
+    return Boolean(spec) && Date.now() / 1000 < spec.expires_at - 5
+        && (state.rates.version === undefined || state.rates.version === spec.rates.version);
+}
+
+// Результат по спецификации или null (тогда считаем через API)
+function calculateFromSpec(amount) {
+    if (!specValid()) return null;
+    let scenario = state.scenario;
+    let direction = state.direction;
+    if (state.method === 'doverka' && scenario === 'thb-to-rub') {
+        scenario = 'rub-to-thb';
+        direction = 'target';
+    }
+    // Входы как в operation_inputs на сервере
+    const inputs = state.method === 'broker'
+        ? { amount, profit_margin: state.profitMargin, custom_rub_usdt: state.customRubUsdt }
+        : { amount, profit_margin: state.applyDiscount && state.profitMargin ? state.profitMargin : null };
+    try {
+        const result = evaluateSpec(state.spec, state.method, scenario, direction, inputs);
+        result.rates_version = state.spec.rates.version;
+        // Для POST /api/deals: сервер пересчитает и выпустит котировку
+        result.pricing = {
+            spec_version: state.spec.spec_version,
+            rates_version: state.spec.rates.version,
+            method: state.method, scenario, direction,
+            ...inputs,
+            result: { ...result }
+        };
+        return result;
+    } catch (error) {
+        console.warn('Spec calculation error:', error);
+        return null;
+    }
 }
 
 // Обновление UI сценария
@@ -345,7 +676,7 @@ function setDirection(direction) {
     
     // Обновляем метки в зависимости от direction
     updateScenarioUI();
-    hideResults();
+    if (!showFromMatrix()) hideResults();
 }
 
 // Получение курсов
@@ -518,63 +849,27 @@ async function calculate() {
 
         calculateBtn.innerHTML = '⏳ РАСЧЕТ...';
         
-        if (CONFIG.USE_API && state.method === 'broker') {
-            // Используем API для расчета через брокера
-            const requestData = {
-                method: 'broker',
-                scenario: state.scenario,
-                direction: state.direction,
-                amount: amount,
-                custom_rub_usdt: state.customRubUsdt,
-                profit_margin: state.profitMargin
-            };
-            
-            const response = await fetch(`${CONFIG.API_URL}/calculate`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(requestData)
-            });
-            
-            if (response.ok) {
-                const result = await response.json();
-                displayResult(result);
-            } else {
-                throw new Error('Calculation API error');
-            }
-            
-        } else if (CONFIG.USE_API && state.method === 'doverka') {
-            // Для Doverka сценарии rub-to-thb и thb-to-rub - это direction amount/target для одного сценария
-            let effectiveScenario = state.scenario;
-            let effectiveDirection = state.direction;
-
-            if (state.scenario === 'thb-to-rub') {
-                effectiveScenario = 'rub-to-thb';
-                effectiveDirection = 'target';
-            }
+        const requestData = calculateRequest(amount);
+        state.quotePending = null;
 
-            const requestData = {
-                method: 'doverka',
-                scenario: effectiveScenario,
-                direction: effectiveDirection,
-                amount: amount,
-                // Передаем маржу только если включена "скидка" (ручной режим)
-                profit_margin: state.applyDiscount ? state.profitMargin : null
-            };
-            
-            console.log('📤 Sending Doverka request:', requestData);
-            
-            const response = await fetch(`${CONFIG.API_URL}/calculate`, {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(requestData)
-            });
-            
-            if (response.ok) {
-                const result = await response.json();
-                displayResult(result);
-            } else {
-                throw new Error('Calculation API error');
+        // Спецификация загружена - показываем расчёт из браузера сразу,
+        // котировку и матрицу сценариев всё равно берём у сервера в фоне
+        const specResult = CONFIG.USE_API ? calculateFromSpec(amount) : null;
+        if (specResult) {
+            displayResult(specResult);
+            resultsSection.style.display = 'block';
+            state.quotePending = issueQuote(requestData, specResult);
+            prefetchMatrix(amount);
+            return;
+        }
+        
+        if (CONFIG.USE_API) {
+            if (state.method === 'doverka') {
+                console.log('📤 Sending Doverka request:', requestData);
             }
+            const result = await postCalculate(requestData);
+            displayResult(result);
+            prefetchMatrix(amount);
             
         } else {
             // Локальный расчет (фоллбэк)
@@ -596,6 +891,77 @@ async function calculate() {
     }
 }
 
+// Запрос /api/calculate для текущего сценария
+function calculateRequest(amount) {
+    if (state.method === 'broker') {
+        return {
+            method: 'broker',
+            scenario: state.scenario,
+            direction: state.direction,
+            amount: amount,
+            custom_rub_usdt: state.customRubUsdt,
+            profit_margin: state.profitMargin
+        };
+    }
+    // Для Doverka сценарии rub-to-thb и thb-to-rub - это direction amount/target для одного сценария
+    let effectiveScenario = state.scenario;
+    let effectiveDirection = state.direction;
+    if (state.scenario === 'thb-to-rub') {
+        effectiveScenario = 'rub-to-thb';
+        effectiveDirection = 'target';
+    }
+    return {
+        method: 'doverka',
+        scenario: effectiveScenario,
+        direction: effectiveDirection,
+        amount: amount,
+        // Передаем маржу только если включена "скидка" (ручной режим)
+        profit_margin: state.applyDiscount ? state.profitMargin : null
+    };
+}
+
+// Котировка сервера для результата из спецификации: дописываем quote_id в показанный результат
+async function issueQuote(requestData, result) {
+    try {
+        const serverResult = await postCalculate(requestData);
+        result.quote_id = serverResult.quote_id;
+        result.quote_expires_at = serverResult.quote_expires_at;
+        return result;
+    } catch (error) {
+        console.warn('Quote error:', error);
+        return null;
+    }
+}
+
+// Последние ответы /api/calculate с ETag: повторный запрос сервер подтверждает ответом 304 без тела
+const CALC_RESPONSES_MAX = 50;
+const calcResponses = new Map();
+
+async function postCalculate(requestData) {
+    const body = JSON.stringify(requestData);
+    const known = calcResponses.get(body);
+    const headers = { 'Content-Type': 'application/json' };
+    if (known) headers['If-None-Match'] = known.etag;
+
+    const response = await fetch(`${CONFIG.API_URL}/calculate`, { method: 'POST', headers, body });
+    if (response.status === 304 && known) {
+        return known.result;
+    }
+    if (!response.ok) {
+        throw new Error('Calculation API error');
+    }
+    const result = await response.json();
+    const etag = response.headers.get('ETag');
+    calcResponses.delete(body);
+    if (etag) {
+        calcResponses.set(body, { etag, result });
+        if (calcResponses.size > CALC_RESPONSES_MAX) {
+            calcResponses.delete(calcResponses.keys().next().value);
+        }
+    }
+    return result;
+}
+
 // Локальный расчет (фоллбэк)
 function calculateLocal(amount) {
     // В локальном режиме (file://) берем профит из стейта, если включена скидка,
@@ -1040,6 +1406,13 @@ async function createPayment() {
     createBtn.innerText = '⏳ СОЗДАНИЕ...';
 
     try {
+        // Расчёт из браузера (или из матрицы) без котировки: сначала получаем её у сервера
+        if (CONFIG.USE_API && !state.lastResult.quote_id) {
+            if (state.quotePending) await state.quotePending;
+            if (!state.lastResult.quote_id) await issueQuote(calculateRequest(getAmount()), state.lastResult);
+            if (!state.lastResult.quote_id) throw new Error('Котировка не получена, повторите расчет');
+        }
+
         // Берем сумму из "Поступление" (incoming_usdt), если она есть, иначе usdt_amount
         const amount = state.lastResult.incoming_usdt || state.lastResult.usdt_amount;
         const rubAmount = state.lastResult.rub_paid || state.lastResult.rub_to_pay || 0;
@@ -0,0 +1,233 @@
+"""
+Кэш окон USDT-переводов по кошелькам
+Для каждого кошелька хранятся покрытые отрезки времени [lo, hi] со всеми переводами внутри.
+Запрос с любым кошельком и диапазоном дат собирается из уже скачанных отрезков,
+из TronScan докачиваются только дыры (start_timestamp/end_timestamp).
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+PAGE_SIZE = 50
+# Сколько переводов на кошелёк отдавать без start_date (как раньше: 2 страницы)
+LATEST_LIMIT = 100
+# Сколько страниц докачивать за одну дыру; остаток догрузится следующим запросом
+MAX_GAP_PAGES = 10
+# Неподтверждённые переводы младше этого (мс) перечитываются при обновлении головы
+CONFIRM_LOOKBACK_MS = 60 * 60 * 1000
+# TronScan может отдать перевод позже, чем наступил его block_ts: голова считается покрытой
+# не дальше «сейчас» минус это окно (мс), и при каждом дописывании головы окно перечитывается
+HEAD_OVERLAP_MS = 5 * 60 * 1000
+
+
+def classify(tx: dict, address: str) -> dict:
+    """Перевод TronScan в формат ответа; is_incoming - относительно этого кошелька"""
+    block_ts = int(tx.get('block_ts', 0))
+    return {
+        'tx_hash': tx.get('transaction_id'),
+        'from_address': tx.get('from_address'),
+        'to_address': tx.get('to_address'),
+        'amount_usdt': float(tx.get('quant', 0)) / 1_000_000,
+        'timestamp': datetime.fromtimestamp(block_ts / 1000).isoformat(),
+        'block_ts': block_ts,
+        'confirmed': tx.get('confirmed', False),
+        'is_incoming': (tx.get('to_address') or '').lower() == address.lower()
+    }
+
+
+class _Segment:
+    """Покрытый отрезок [lo, hi] (мс, включительно): в transfers все переводы кошелька из него"""
+
+    __slots__ = ('lo', 'hi', 'transfers')
+
+    def __init__(self, lo: int, hi: int, transfers: dict):
+        self.lo = lo
+        self.hi = hi
+        self.transfers = transfers  # tx_hash -> перевод
+
+
+class _WalletEntry:
+    __slots__ = ('segments', 'checked_at', 'lock')
+
+    def __init__(self):
+        self.segments = []      # по убыванию hi, не пересекаются
+        self.checked_at = 0.0   # когда голова (последние переводы) проверялась в TronScan
+        self.lock = threading.Lock()
+
+    def size(self) -> int:
+        return sum(len(segment.transfers) for segment in self.segments)
+
+
+class TransferWindowCache:
+    """LRU по кошелькам с ограничением общего числа переводов в памяти воркера"""
+
+    def __init__(self, fetch_page, ttl: float, max_transfers: int = None):
+        """
+        Args:
+            fetch_page: fetch_page(address, start, limit, start_ts=None, end_ts=None) -> переводы TronScan
+                        от новых к старым (исключение - ошибка запроса)
+            ttl: Сколько секунд голова кошелька считается свежей (новые переводы не запрашиваются)
+            max_transfers: Сколько переводов держать всего (TRANSFER_CACHE_MAX_TRANSFERS, по умолчанию 50000);
+                           сверх - вытесняются давно не запрошенные кошельки
+        """
+        self.fetch_page = fetch_page
+        self.ttl = ttl
+        self.max_transfers = max_transfers if max_transfers is not None else \
+            int(os.getenv('TRANSFER_CACHE_MAX_TRANSFERS', 50_000))
+        self._wallets = OrderedDict()
+        self._lock = threading.Lock()
+        self._size = 0
+        self._stats = {'hits': 0, 'misses': 0, 'pages': 0, 'evictions': 0}
+
+    def _entry(self, address: str) -> _WalletEntry:
+        with self._lock:
+            entry = self._wallets.get(address)
+            if entry is None:
+                entry = self._wallets[address] = _WalletEntry()
+            self._wallets.move_to_end(address)
+            return entry
+
+    def invalidate(self, address: str):
+        with self._lock:
+            entry = self._wallets.pop(address, None)
+            if entry is not None:
+                self._size -= entry.size()
+
+    def _resize(self, address: str, entry: _WalletEntry, delta: int):
+        # Под общей блокировкой: учитываем рост и вытесняем самые старые кошельки, кроме текущего
+        with self._lock:
+            if self._wallets.get(address) is not entry:
+                return  # кошелёк уже вытеснили или сбросили, пока шла загрузка
+            self._size += delta
+            for victim in list(self._wallets):
+                if self._size <= self.max_transfers:
+                    break
+                if victim == address:
+                    continue
+                self._size -= self._wallets.pop(victim).size()
+                self._stats['evictions'] += 1
+
+    # ---------- запрос ----------
+
+    def window(self, address: str, start_ts: int = None, end_ts: int = None, force: bool = False) -> tuple:
+        """
+        Переводы кошелька в [start_ts, end_ts] (мс); без start_ts - последние LATEST_LIMIT до end_ts
+
+        Returns:
+            tuple: (переводы от новых к старым, когда голова проверялась в TronScan, всё ли взято из кэша)
+        """
+        if force:
+            self.invalidate(address)
+        entry = self._entry(address)
+        with entry.lock:
+            before = entry.size()
+            pages = self._collect_missing(entry, address, start_ts, end_ts)
+            transfers = self._read(entry, start_ts, end_ts)
+            delta = entry.size() - before
+            checked_at = entry.checked_at
+        if delta:
+            self._resize(address, entry, delta)
+        with self._lock:
+            self._stats['pages'] += pages
+            self._stats['hits' if not pages else 'misses'] += 1
+        return transfers, checked_at, not pages
+
+    def _hi(self, entry: _WalletEntry, end_ts: int) -> tuple:
+        """
+        Верхняя граница запроса и доходит ли он до «сейчас»
+
+        Пока голова свежая (моложе ttl), «сейчас» - это край уже скачанного.
+        """
+        now_ms = int(time.time() * 1000)
+        to_now = end_ts is None or end_ts >= now_ms
+        hi = now_ms if to_now else end_ts
+        if entry.segments and hi > entry.segments[0].hi and time.time() - entry.checked_at < self.ttl:
+            hi = entry.segments[0].hi
+        return hi, to_now
+
+    def _collect_missing(self, entry: _WalletEntry, address: str, start_ts, end_ts) -> int:
+        """Докачать дыры, пока [start_ts, hi] не покрыт (или не набрано LATEST_LIMIT); возвращает число страниц"""
+        hi, to_now = self._hi(entry, end_ts)
+        cursor, found, pages = hi, 0, 0
+        while cursor >= 0 and (cursor >= start_ts if start_ts is not None else found < LATEST_LIMIT):
+            segment = next((s for s in entry.segments if s.lo <= cursor <= s.hi), None)
+            if segment is not None:
+                found += sum(1 for tx in segment.transfers.values() if tx['block_ts'] <= cursor)
+                cursor = segment.lo - 1
+                continue
+
+            below = next((s for s in entry.segments if s.hi < cursor), None)
+            gap_lo = below.hi + 1 if below is not None else None
+            if start_ts is not None:
+                gap_lo = max(gap_lo or 0, start_ts)
+            head = not entry.segments or cursor > entry.segments[0].hi
+            if below is not None and below is entry.segments[0]:
+                # Дописываем голову: перечитываем последние HEAD_OVERLAP_MS и свежие неподтверждённые
+                # (чтобы обновить confirmed)
+                gap_lo = min(gap_lo, below.hi - HEAD_OVERLAP_MS)
+                pending = [tx['block_ts'] for tx in below.transfers.values()
+                           if not tx['confirmed'] and tx['block_ts'] >= below.hi - CONFIRM_LOOKBACK_MS]
+                if pending:
+                    gap_lo = min(gap_lo, min(pending))
+            max_pages = MAX_GAP_PAGES if start_ts is not None else \
+                min(MAX_GAP_PAGES, -(-(LATEST_LIMIT - found) // PAGE_SIZE))
+            try:
+                fetched, covered_lo, used = self._fetch_gap(address, gap_lo, cursor, max_pages)
+            except Exception as e:
+                print(f"[DEBUG] TronScan request error for {address}: {e}")
+                break
+            pages += used
+            if cursor == hi and to_now:
+                entry.checked_at = time.time()
+            covered_hi = cursor
+            if head:
+                # Голова покрыта до самого нового полученного перевода, но не дальше «сейчас» - HEAD_OVERLAP_MS
+                newest = max((tx['block_ts'] for tx in fetched), default=0)
+                covered_hi = min(cursor, max(newest, int(time.time() * 1000) - HEAD_OVERLAP_MS))
+            self._store(entry, min(covered_lo, covered_hi), covered_hi, fetched)
+            cursor = covered_hi
+        return pages
+
+    def _fetch_gap(self, address: str, lo, hi: int, max_pages: int) -> tuple:
+        """Переводы в [lo, hi] от новых к старым; если страниц не хватило - покрыто только до самого старого"""
+        transfers = []
+        for n in range(max_pages):
+            page = self.fetch_page(address, n * PAGE_SIZE, PAGE_SIZE, start_ts=lo, end_ts=hi)
+            transfers.extend(classify(tx, address) for tx in page)
+            if len(page) < PAGE_SIZE:
+                return transfers, lo or 0, n + 1
+        # Переводы с самым старым block_ts могли попасть не все - их отрезок не считаем покрытым
+        return transfers, min(tx['block_ts'] for tx in transfers) + 1, max_pages
+
+    @staticmethod
+    def _store(entry: _WalletEntry, lo: int, hi: int, fetched: list):
+        """Добавить отрезок и склеить его с пересекающимися и соседними"""
+        merged = _Segment(lo, hi, {tx['tx_hash']: tx for tx in fetched if tx['tx_hash']})
+        keep = []
+        for segment in entry.segments:
+            if segment.hi + 1 >= merged.lo and segment.lo - 1 <= merged.hi:
+                for tx_hash, tx in segment.transfers.items():
+                    # Новое скачанное главнее (confirmed мог измениться)
+                    merged.transfers.setdefault(tx_hash, tx)
+                merged.lo = min(merged.lo, segment.lo)
+                merged.hi = max(merged.hi, segment.hi)
+            else:
+                keep.append(segment)
+        keep.append(merged)
+        keep.sort(key=lambda s: s.hi, reverse=True)
+        entry.segments = keep
+
+    def _read(self, entry: _WalletEntry, start_ts, end_ts) -> list:
+        transfers = [tx for segment in entry.segments for tx in segment.transfers.values()
+                     if (start_ts is None or tx['block_ts'] >= start_ts)
+                     and (end_ts is None or tx['block_ts'] <= end_ts)]
+        transfers.sort(key=lambda tx: tx['block_ts'], reverse=True)
+        return transfers if start_ts is not None else transfers[:LATEST_LIMIT]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats, wallets=len(self._wallets), transfers=self._size,
+                        max_transfers=self.max_transfers)
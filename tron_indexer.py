@@ -0,0 +1,282 @@
+"""
+Инкрементальный индекс USDT-переводов TronScan
+Фоновый поток синхронизирует каждый отслеживаемый кошелёк по курсорам block_ts и складывает
+переводы в таблицу transactions; история старше первой страницы догружается порциями (backfill).
+"""
+
+import os
+import threading
+import time
+from datetime import datetime
+
+from shared_cache import LocalCache
+
+PAGE_SIZE = 50
+# Сколько страниц новых переводов за проход по кошельку (дальше - в следующий проход)
+MAX_FORWARD_PAGES = 20
+# Сколько страниц истории догружать за проход по кошельку
+BACKFILL_PAGES = 5
+# Неподтверждённые переводы младше этого (мс) перечитываются, пока TronScan их не подтвердит
+CONFIRM_LOOKBACK_MS = 60 * 60 * 1000
+# Индекс кошелька считается актуальным, пока с последней синхронизации прошло меньше стольких интервалов
+FRESH_INTERVALS = 5
+
+
+def transfer_fields(tx: dict) -> dict:
+    """Поля строки transactions из перевода TronScan"""
+    block_ts = int(tx.get('block_ts', 0))
+    return {
+        'tx_hash': tx.get('transaction_id'),
+        'from_address': tx.get('from_address'),
+        'to_address': tx.get('to_address'),
+        'amount_usdt': float(tx.get('quant', 0)) / 1_000_000,
+        'block_ts': block_ts,
+        'timestamp': datetime.fromtimestamp(block_ts / 1000),
+        'confirmed': bool(tx.get('confirmed', False)),
+    }
+
+
+class TransferIndexer:
+    """Фоновая синхронизация переводов кошельков в таблицу transactions"""
+
+    # Аренда в общем кэше: индексирует один воркер на хост
+    LEASE_KEY = 'tronscan:indexer'
+
+    def __init__(self, session_factory, wallet_model, transaction_model, fetch_page,
+                 interval: float = 60.0, cache=None):
+        """
+        Args:
+            session_factory: Фабрика сессий SQLAlchemy
+            wallet_model, transaction_model: Модели Wallet и Transaction
+            fetch_page: fetch_page(address, start, limit, start_ts=None, end_ts=None) -> список переводов
+                        TronScan от новых к старым (исключение - ошибка запроса)
+            interval: Период синхронизации в секундах (None - фоновый поток не запускается)
+            cache: Общий кэш воркеров для аренды
+        """
+        self.session_factory = session_factory
+        self.Wallet = wallet_model
+        self.Transaction = transaction_model
+        self.fetch_page = fetch_page
+        self.interval = interval
+        self.cache = cache or LocalCache()
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.last_run = None
+
+    def start(self):
+        """Запустить фоновый поток (идемпотентно, отдельно в каждом воркере gunicorn)"""
+        if not self.interval:
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='tronscan-indexer', daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Синхронизировать, не дожидаясь периода (например, после добавления кошелька)"""
+        self.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            if self.cache.acquire(self.LEASE_KEY, ttl=max(self.interval * 5, 300)):
+                try:
+                    self.sync_all()
+                except Exception as e:
+                    print(f"⚠️ TronScan indexer error: {e}")
+                finally:
+                    self.cache.release(self.LEASE_KEY)
+            self._wakeup.clear()
+            self._wakeup.wait(self.interval)
+
+    # ---------- синхронизация ----------
+
+    def is_fresh(self, wallet) -> bool:
+        """Можно ли отдавать переводы кошелька из индекса: фоновая синхронизация включена и недавно прошла"""
+        if not self.interval or wallet.indexed_block_ts is None or wallet.indexed_at is None:
+            return False
+        if wallet.forward_gap_ts is not None:
+            return False
+        age = (datetime.utcnow() - wallet.indexed_at).total_seconds()
+        return age < max(self.interval * FRESH_INTERVALS, 300)
+
+    def sync_all(self, address: str = None) -> dict:
+        """Один проход по отслеживаемым кошелькам (или одному адресу); возвращает счётчики по адресам"""
+        with self._sync_lock:
+            session = self.session_factory()
+            try:
+                query = session.query(self.Wallet).filter(self.Wallet.active == True)
+                if address:
+                    query = query.filter(self.Wallet.address == address)
+                else:
+                    query = query.filter(self.Wallet.is_monitored == True)
+                report = self._sync_wallets(session, query.all())
+                self.last_run = time.time()
+                return report
+            finally:
+                session.close()
+
+    def refresh(self, addresses: list, budget: float) -> dict:
+        """
+        Догнать новые переводы кошельков запроса (force_refresh), не дольше budget секунд
+
+        Идущий фоновый проход ждём не дольше budget, историю не догружаем; что не успели -
+        дочитает следующий проход (forward_gap_ts), а запрос отвечает тем, что уже в индексе.
+        """
+        deadline = time.time() + budget
+        if not addresses or not self._sync_lock.acquire(timeout=budget):
+            return {}
+        try:
+            session = self.session_factory()
+            try:
+                wallets = session.query(self.Wallet).filter(self.Wallet.active == True,
+                                                            self.Wallet.address.in_(addresses)).all()
+                return self._sync_wallets(session, wallets, forward_only=True, deadline=deadline)
+            finally:
+                session.close()
+        finally:
+            self._sync_lock.release()
+
+    def _sync_wallets(self, session, wallets, forward_only: bool = False, deadline: float = None) -> dict:
+        report = {}
+        for wallet in wallets:
+            if deadline is not None and time.time() >= deadline:
+                break
+            try:
+                report[wallet.address] = self.sync_wallet(session, wallet, forward_only, deadline)
+                session.commit()
+            except Exception as e:
+                session.rollback()
+                report[wallet.address] = {'error': str(e)}
+                print(f"⚠️ TronScan index error for {wallet.address}: {e}")
+        return report
+
+    def sync_wallet(self, session, wallet, forward_only: bool = False, deadline: float = None) -> dict:
+        """
+        Новые переводы (block_ts >= курсора) и порция истории (block_ts <= курсора backfill)
+
+        forward_only - без истории; deadline (time.time()) - после него новые страницы не запрашиваются.
+
+        Курсоры двигаются только после записи страниц, поэтому прерванный проход
+        просто повторится со старого места (upsert по tx_hash идемпотентен).
+        """
+        stats = {'new': 0, 'updated': 0, 'backfilled': 0, 'pages': 0}
+
+        if wallet.indexed_block_ts is None:
+            # Первый проход: последняя страница задаёт оба курсора, остальное догрузит backfill
+            page = self.fetch_page(wallet.address, 0, PAGE_SIZE)
+            stats['pages'] += 1
+            self._count(stats, 'new', self.upsert(session, page))
+            if page:
+                timestamps = [int(tx.get('block_ts', 0)) for tx in page]
+                wallet.indexed_block_ts = max(timestamps)
+                wallet.backfill_block_ts = min(timestamps)
+            else:
+                wallet.indexed_block_ts = 0
+            wallet.backfill_done = len(page) < PAGE_SIZE
+            complete = True
+        else:
+            complete = self._forward(session, wallet, stats, deadline)
+
+        if not wallet.backfill_done and not forward_only:
+            self._backfill(session, wallet, stats)
+        # Пока новые переводы не дочитаны, в индексе дыра - кошелёк не считается актуальным
+        if complete:
+            wallet.indexed_at = datetime.utcnow()
+        stats['complete'] = complete
+        return stats
+
+    def _forward(self, session, wallet, stats, deadline: float = None) -> bool:
+        """
+        Новые переводы от самых свежих вниз до курсора; True - окно дочитано и курсор сдвинут
+
+        Если окно больше MAX_FORWARD_PAGES страниц (простой индексатора, кошелёк снова отслеживается),
+        место остановки сохраняется в forward_gap_ts и следующий проход продолжает с него вниз
+        через end_ts, как backfill; indexed_block_ts остаётся нижней границей окна, пока оно не дочитано.
+        """
+        window_start = wallet.indexed_block_ts
+        # Перечитываем окно с неподтверждёнными переводами, чтобы обновить confirmed
+        Transaction = self.Transaction
+        pending = session.query(Transaction.block_ts).filter(
+            Transaction.confirmed == False,
+            Transaction.block_ts >= wallet.indexed_block_ts - CONFIRM_LOOKBACK_MS,
+            (Transaction.to_address == wallet.address) | (Transaction.from_address == wallet.address)
+        ).order_by(Transaction.block_ts).first()
+        if pending is not None:
+            window_start = min(window_start, pending[0])
+
+        end_ts = wallet.forward_gap_ts
+        newest = wallet.forward_head_ts if end_ts is not None else wallet.indexed_block_ts
+        for n in range(MAX_FORWARD_PAGES):
+            if n and deadline is not None and time.time() >= deadline:
+                break
+            page = self.fetch_page(wallet.address, 0, PAGE_SIZE, start_ts=window_start, end_ts=end_ts)
+            stats['pages'] += 1
+            self._count(stats, 'new', self.upsert(session, page))
+            if len(page) < PAGE_SIZE:
+                if page:
+                    newest = max(newest, max(int(tx.get('block_ts', 0)) for tx in page))
+                wallet.indexed_block_ts = newest
+                wallet.forward_gap_ts = wallet.forward_head_ts = None
+                return True
+            timestamps = [int(tx.get('block_ts', 0)) for tx in page]
+            newest = max(newest, max(timestamps))
+            oldest = min(timestamps)
+            # Целая страница с одним block_ts - сдвигаемся на миллисекунду, чтобы не зациклиться
+            end_ts = oldest if end_ts is None or oldest < end_ts else end_ts - 1
+        # Окно не дочитано - продолжим вниз со следующего прохода
+        wallet.forward_gap_ts = end_ts
+        wallet.forward_head_ts = newest
+        print(f"⚠️ TronScan index: window for {wallet.address} not read in one pass, "
+              f"continuing below {end_ts} next pass")
+        return False
+
+    def _backfill(self, session, wallet, stats):
+        for _ in range(BACKFILL_PAGES):
+            cursor = wallet.backfill_block_ts
+            page = self.fetch_page(wallet.address, 0, PAGE_SIZE, end_ts=cursor)
+            stats['pages'] += 1
+            self._count(stats, 'backfilled', self.upsert(session, page))
+            if len(page) < PAGE_SIZE:
+                wallet.backfill_done = True
+                return
+            oldest = min(int(tx.get('block_ts', 0)) for tx in page)
+            # Целая страница с одним block_ts - сдвигаемся на миллисекунду, чтобы не зациклиться
+            wallet.backfill_block_ts = oldest if oldest < cursor else cursor - 1
+
+    @staticmethod
+    def _count(stats, key, counts):
+        inserted, updated = counts
+        stats[key] += inserted
+        stats['updated'] += updated
+
+    def upsert(self, session, transfers: list) -> tuple:
+        """Вставить новые переводы и обновить confirmed у известных; привязку к сделкам не трогаем"""
+        rows = {}
+        for tx in transfers:
+            fields = transfer_fields(tx)
+            if fields['tx_hash']:
+                rows[fields['tx_hash']] = fields
+        if not rows:
+            return 0, 0
+        Transaction = self.Transaction
+        existing = {t.tx_hash: t for t in
+                    session.query(Transaction).filter(Transaction.tx_hash.in_(list(rows))).all()}
+        inserted = updated = 0
+        for tx_hash, fields in rows.items():
+            row = existing.get(tx_hash)
+            if row is None:
+                session.add(Transaction(blockchain='TRON', **fields))
+                inserted += 1
+            elif row.confirmed != fields['confirmed'] or row.block_ts != fields['block_ts']:
+                row.confirmed = fields['confirmed']
+                row.block_ts = fields['block_ts']
+                row.timestamp = fields['timestamp']
+                updated += 1
+        session.flush()
+        return inserted, updated
@@ -0,0 +1,314 @@
+"""
+Доступ к TronScan: HTTP-клиент с пулом соединений и повторами, общий лимит запросов процесса
+и параллельное обновление балансов
+Все запросы к TronScan идут через один клиент и берут токен из одного ведра (TRONSCAN_RATE запросов
+в секунду), поэтому параллельные запросы не превышают квоту, а время загрузки упирается в лимит,
+а не в сумму пауз и TLS-рукопожатий.
+"""
+
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TokenBucket:
+    """Token bucket: rate токенов в секунду, не больше burst про запас"""
+
+    def __init__(self, rate: float, burst: float = None):
+        """
+        Args:
+            rate: Запросов в секунду (None или 0 - без ограничения)
+            burst: Сколько запросов можно сделать подряд без ожидания (по умолчанию = rate, минимум 1)
+        """
+        self.rate = rate or None
+        self.burst = max(burst if burst is not None else (rate or 1), 1)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self._waited = 0.0
+        self._acquired = 0
+
+    def _reserve(self) -> float:
+        """Взять токен (в долг, если их нет); возвращает, сколько секунд ждать"""
+        with self._lock:
+            self._acquired += 1
+            if self.rate is None:
+                return 0.0
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self._waited += delay
+            return delay
+
+    def acquire(self):
+        """Дождаться своей очереди (ожидающие потоки выстраиваются в порядке вызова)"""
+        delay = self._reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'acquired': self._acquired,
+                    'waited_seconds': round(self._waited, 3)}
+
+
+def limiter_from_env() -> TokenBucket:
+    """
+    TRONSCAN_RATE=5 - запросов в секунду на процесс (off - без ограничения),
+    TRONSCAN_BURST - запас на всплеск (по умолчанию = TRONSCAN_RATE)
+    """
+    raw = os.getenv('TRONSCAN_RATE', '5').strip().lower()
+    rate = None if raw in ('', '0', 'off', 'none') else float(raw)
+    burst = os.getenv('TRONSCAN_BURST')
+    return TokenBucket(rate, float(burst) if burst else None)
+
+
+class TronScanClient:
+    """
+    Клиент TronScan API: keep-alive requests.Session с пулом, лимит запросов, повторы, счётчики
+
+    Повторяет 429/5xx и сетевые ошибки с экспоненциальной паузой (Retry-After, если TronScan его прислал).
+    Ответ с другим статусом возвращается как есть - вызывающий сам решает, что делать с 404 и т.п.
+    """
+
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    USER_AGENT = 'Mozilla/5.0 (Apple) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+    # Сколько последних задержек держать на эндпоинт для перцентилей
+    LATENCY_WINDOW = 500
+
+    def __init__(self, base_url: str, limiter: TokenBucket = None, pool_size: int = 16, retries: int = 3,
+                 backoff: float = 0.5, max_backoff: float = 10.0):
+        """
+        Args:
+            base_url: Адрес API (TRONSCAN_API_URL)
+            limiter: Общее ведро запросов (каждая попытка берёт токен)
+            pool_size: Соединений в пуле (не меньше числа потоков, одновременно ходящих в TronScan)
+            retries: Повторов после первой попытки
+            backoff: Пауза перед первым повтором, дальше удваивается (с разбросом ±25%)
+            max_backoff: Потолок паузы, в том числе для Retry-After
+        """
+        self.base_url = base_url.rstrip('/')
+        self.limiter = limiter
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def session(self) -> requests.Session:
+        # После fork сокеты родителя не переиспользуем - в каждом воркере свой пул
+        with self._lock:
+            if self._session is None or self._pid != os.getpid():
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                session.headers['User-Agent'] = self.USER_AGENT
+                self._session = session
+                self._pid = os.getpid()
+            return self._session
+
+    def _retry_delay(self, attempt: int, response=None) -> float:
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(max(float(retry_after), 0.0), self.max_backoff)
+            except ValueError:
+                pass  # HTTP-дата вместо секунд - считаем паузу сами
+        delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return delay * random.uniform(0.75, 1.25)
+
+    def _record(self, endpoint: str, elapsed: float, ok: bool, retries: int):
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = {'requests': 0, 'errors': 0, 'retries': 0,
+                                                 'latency': deque(maxlen=self.LATENCY_WINDOW)}
+            stats['requests'] += 1
+            stats['errors'] += 0 if ok else 1
+            stats['retries'] += retries
+            stats['latency'].append(elapsed)
+
+    def get(self, path: str, params: dict = None, timeout: float = 10) -> requests.Response:
+        """
+        GET {base_url}/{path}
+
+        Returns:
+            requests.Response: последний ответ (после повторов может быть и 429/5xx)
+
+        Raises:
+            requests.RequestException: сетевая ошибка после всех повторов
+        """
+        endpoint = '/' + path.lstrip('/')
+        url = self.base_url + endpoint
+        session = self.session()
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            if self.limiter is not None:
+                self.limiter.acquire()
+            try:
+                response = session.get(url, params=params, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    self._record(endpoint, time.perf_counter() - started, False, attempt)
+                    raise
+                time.sleep(self._retry_delay(attempt))
+                attempt += 1
+                continue
+            if response.status_code in self.RETRY_STATUSES and attempt < self.retries:
+                delay = self._retry_delay(attempt, response)
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self._record(endpoint, time.perf_counter() - started, response.status_code < 400, attempt)
+            return response
+
+    def stats(self) -> dict:
+        """Счётчики по эндпоинтам: запросы, ошибки, повторы, задержка p50/p95/max (мс, с учётом повторов)"""
+        with self._lock:
+            snapshot = {endpoint: (dict(s), list(s['latency'])) for endpoint, s in self._stats.items()}
+        report = {}
+        for endpoint, (s, latency) in snapshot.items():
+            latency_ms = np.array(latency) * 1000
+            report[endpoint] = {
+                'requests': s['requests'], 'errors': s['errors'], 'retries': s['retries'],
+                'p50_ms': round(float(np.percentile(latency_ms, 50)), 1),
+                'p95_ms': round(float(np.percentile(latency_ms, 95)), 1),
+                'max_ms': round(float(latency_ms.max()), 1),
+            }
+        return report
+
+
+def client_from_env(base_url: str, limiter: TokenBucket = None) -> TronScanClient:
+    """TRONSCAN_POOL_SIZE=16, TRONSCAN_RETRIES=3, TRONSCAN_BACKOFF=0.5 (секунды перед первым повтором)"""
+    return TronScanClient(base_url, limiter,
+                          pool_size=int(os.getenv('TRONSCAN_POOL_SIZE', 16)),
+                          retries=int(os.getenv('TRONSCAN_RETRIES', 3)),
+                          backoff=float(os.getenv('TRONSCAN_BACKOFF', 0.5)))
+
+
+class BalanceRefresher:
+    """
+    Фоновое параллельное обновление балансов кошельков
+
+    Устаревшие балансы ставятся в пул потоков (один запрос на адрес одновременно); темп запросов
+    задаёт общее ведро лимита внутри fetch_balance. Вызывающий ждёт не дольше wait секунд и получает
+    то, что успело прийти; остальное досчитывается в фоне и попадает в общий кэш к следующему запросу.
+    """
+
+    KEY_PREFIX = 'tronscan:balance:'
+
+    def __init__(self, fetch_balance, cache, ttl: float, max_workers: int = 8):
+        """
+        Args:
+            fetch_balance: fetch_balance(address) -> {'usdt', 'trx'} или None, если TronScan не ответил;
+                           сам берёт токен лимита перед каждым запросом
+            cache: Общий кэш воркеров (get / get_or_refresh)
+            ttl: Сколько секунд баланс считается свежим
+            max_workers: Потоков пула (параллельных запросов; темп всё равно задаёт лимит)
+        """
+        self.fetch_balance = fetch_balance
+        self.cache = cache
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self._executor = None
+        self._pid = None
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def _pool(self) -> ThreadPoolExecutor:
+        # После fork пул родителя не работает - создаём свой в каждом воркере
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='tronscan-balance')
+            self._pid = os.getpid()
+            self._inflight = {}
+        return self._executor
+
+    def _load(self, address: str, force: bool):
+        try:
+            return self.cache.get_or_refresh(self.KEY_PREFIX + address, self.ttl,
+                                             lambda previous: self.fetch_balance(address), force=force)[0]
+        finally:
+            with self._lock:
+                self._inflight.pop(address, None)
+
+    def refresh(self, addresses: list, force: bool = False) -> dict:
+        """Поставить в очередь устаревшие адреса; возвращает {адрес: Future} для поставленных"""
+        now = time.time()
+        futures = {}
+        with self._lock:
+            pool = self._pool()
+            for address in dict.fromkeys(addresses):
+                future = self._inflight.get(address)
+                if future is None:
+                    value, updated_at = self.cache.get(self.KEY_PREFIX + address)
+                    if not force and value is not None and now - updated_at < self.ttl:
+                        continue
+                    future = pool.submit(self._load, address, force)
+                    self._inflight[address] = future
+                futures[address] = future
+        return futures
+
+    def balances(self, addresses: list, wait: float, force: bool = False) -> dict:
+        """
+        Балансы адресов: свежие из кэша, устаревшие - обновляются параллельно до wait секунд
+
+        Returns:
+            dict: адрес -> {'balance': {'usdt', 'trx'} или None, 'cached': bool, 'pending': bool}
+                  pending - запрос ещё идёт, balance при этом - прошлое значение из кэша (если было)
+        """
+        futures = self.refresh(addresses, force)
+        if futures and wait > 0:
+            wait_futures(list(futures.values()), timeout=wait)
+
+        result = {}
+        for address in addresses:
+            future = futures.get(address)
+            if future is not None and future.done() and future.exception() is None:
+                balance = future.result()
+                result[address] = {'balance': balance, 'cached': False, 'pending': False}
+                continue
+            balance, _ = self.cache.get(self.KEY_PREFIX + address)
+            result[address] = {'balance': balance, 'cached': balance is not None,
+                               'pending': future is not None and not future.done()}
+        return result
+
+
+if __name__ == '__main__':
+    # 30 кошельков при 10 запросах/с и 100 мс на ответ: ~3 с вместо 30 × (0.1 + 0.3) = 12 с последовательно
+    from shared_cache import LocalCache
+
+    bucket = TokenBucket(10, burst=5)
+
+    def slow_balance(address):
+        bucket.acquire()
+        time.sleep(0.1)
+        return {'usdt': float(len(address)), 'trx': 0.0}
+
+    addresses = [f'TDemo{i:02d}' for i in range(30)]
+    refresher = BalanceRefresher(slow_balance, LocalCache(), ttl=300)
+
+    started = time.perf_counter()
+    first = refresher.balances(addresses, wait=1.0)
+    print(f"⏱ first response in {time.perf_counter() - started:.2f} s: "
+          f"{sum(1 for r in first.values() if r['balance'])} ready, {sum(r['pending'] for r in first.values())} pending")
+    while any(r['pending'] for r in refresher.balances(addresses, wait=0.5).values()):
+        pass
+    elapsed = time.perf_counter() - started
+    final = refresher.balances(addresses, wait=0)
+    ok = all(r['balance'] and r['cached'] for r in final.values()) and 2.0 < elapsed < 4.5
+    print(f"{'✅' if ok else '❌'} all {len(addresses)} balances in {elapsed:.2f} s, limiter {bucket.stats()}")